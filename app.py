@@ -1,4 +1,7 @@
 import dash
+import hashlib
+import json
+import os
 from dash import dcc
 from dash import html
 import pandas as pd
@@ -8,17 +11,49 @@ from dash.dependencies import Output, Input, State
 import plotly.express as px
 from model_operations import *
 from import_data import *
+from results import concat_results
+from delta_store import pack_runs, unpack_runs
+from input_grid import build_input_grid
+from input_store import InputStore, columns_frame, grid_version
+from scenario_archive import ScenarioArchive
+from serving_metrics import METRICS, CountingCache, register_metrics_endpoint, timed_callback
 
 
-# read in external data
-df_input = import_all_data()
-
 # initialize values ONLY FOR HTML
 initial_start_date, initial_stop_date = datetime(2018, 1, 1), datetime.now()
-model_env, model = setup_model(initial_start_date, initial_stop_date, df_input)
+
+# read in external data, or attach the aligned data published to INPUT_STORE (shared by all workers)
+input_store = os.environ.get("INPUT_STORE")
+input_version = None
+
+
+def attach_inputs():
+    """ Build the model on the current version of INPUT_STORE, again whenever a refresh has published a new one
+    Called by every callback that runs the model, so all workers swap to refreshed data at their next request
+    """
+    global model_env, model, input_version
+    store = InputStore(input_store)
+    version = store.current()
+    if version == input_version:
+        return
+    input_grid = store.attach(version)
+    model_env, model = setup_model(initial_start_date, initial_stop_date, columns_frame(input_grid),
+                                   input_grid=input_grid)
+    input_version = version
+
+
+if input_store:
+    attach_inputs()
+else:
+    df_input = import_all_data()
+    input_grid = build_input_grid(df_input, *datetime_to_serial([initial_start_date, initial_stop_date]), 1.0)
+    input_version = grid_version(input_grid)
+    model_env, model = setup_model(initial_start_date, initial_stop_date, df_input, input_grid=input_grid)
+output_options = {"dtype": "float32"}
 variables = [str(var) for var in model.stocks] \
             + [str(var) for var in model.flows] \
             + [str(var) for var in model.converters]
+current_model_hash = model_hash(model)
 min_date = serial_to_datetime(1.0)
 max_date = datetime.now()
 
@@ -33,6 +68,38 @@ external_stylesheets = [
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 app.title = "Ethiopia Livestock SD model"
 server = app.server
+register_metrics_endpoint(server)
+# scenario runs by constants, dates and input data version, and decoded stored-runs payloads by content
+run_cache = CountingCache("runs", maxsize=16)
+unpacked_cache = CountingCache("unpacked_runs", maxsize=8)
+# with SCENARIO_ARCHIVE set, runs are archived there (shared by all workers) and stored-runs only holds their ids
+scenario_archive = os.environ.get("SCENARIO_ARCHIVE")
+archive = ScenarioArchive(scenario_archive) if scenario_archive else None
+
+
+def cached_run(scenario, constants, start_date, stop_date):
+    def run():
+        METRICS.record_simulation()
+        return run_model(model_env, model, scenario, constants, start_date, stop_date, output_options)
+    key = (scenario, tuple(sorted(constants.items())), start_date, stop_date, input_version)
+    return run_cache.get(key, run)
+
+
+def cached_unpack(stored_runs):
+    """ Decoded stored-runs, shared between callbacks: copy before changing it """
+    key = hashlib.sha1(stored_runs.encode()).hexdigest()
+    return unpacked_cache.get(key, lambda: unpack_runs(stored_runs))
+
+
+def archived_run(scenario, constants, start_date, stop_date):
+    """ Archive id of a scenario run, running it only if no worker has archived it yet """
+    scenario_id = archive.lookup(scenario, constants, current_model_hash, start_date, stop_date, input_version)
+    if scenario_id is None:
+        scenario_id = archive.add(cached_run(scenario, constants, start_date, stop_date), scenario, constants,
+                                  current_model_hash, start_date=start_date, stop_date=stop_date,
+                                  input_version=input_version)
+    return scenario_id
+
 
 # app layout
 app.layout = html.Div(
@@ -186,20 +253,27 @@ app.layout = html.Div(
         dcc.Store(
             id="stored-runs",
         ),
+        # input data version the stored runs were made with
+        dcc.Store(
+            id="stored-input-version",
+        ),
     ]
 )
 
 
 @app.callback(
     Output("stored-runs", "data"),
+    Output("stored-input-version", "data"),
     Input("date-range", "start_date"),
     Input("date-range", "end_date"),
     Input("scenario-A-var-1", "value"),
     Input("scenario-A-var-2", "value"),
     Input("scenario-B-var-1", "value"),
     Input("scenario-B-var-2", "value"),
-    State("stored-runs", "data")
+    State("stored-runs", "data"),
+    State("stored-input-version", "data")
 )
+@timed_callback("run_scenario_x")
 def run_scenario_x(
         start_date_str,
         stop_date_str,
@@ -207,44 +281,49 @@ def run_scenario_x(
         scenario_A_var_2,
         scenario_B_var_1,
         scenario_B_var_2,
-        stored_runs
+        stored_runs,
+        stored_input_version
 ):
     ctx = dash.callback_context
+    if input_store:
+        attach_inputs()
     start_date = datetime.fromisoformat(start_date_str)
     stop_date = datetime.fromisoformat(stop_date_str)
-    run_scenario_a, run_scenario_b = False, False
-    if not ctx.triggered:
-        df = run_model(model_env, model, "startup", {}, start_date, stop_date)
-        trigger_variable = "date-range"
-    else:
-        df = pd.read_json(stored_runs, orient="split")
-        trigger_variable = ctx.triggered[0]["prop_id"].split(".")[0]
-    if trigger_variable == "date-range":
-        run_scenario_a, run_scenario_b = True, True
-    if "scenario-A" in trigger_variable: run_scenario_a = True
-    if "scenario-B" in trigger_variable: run_scenario_b = True
-    if run_scenario_a:
-        scenario = "A"
-        constants = {
+    trigger_variable = ctx.triggered[0]["prop_id"].split(".")[0] if ctx.triggered else "date-range"
+    scenarios = {
+        "A": {
             "Animal Health": scenario_A_var_1,
             "Fertility Baseline": scenario_A_var_2 / 365.0,
-        }
-        run_df = run_model(model_env, model, scenario, constants, start_date, stop_date)
-        df.drop(df[df["Scenario"] == scenario].index, inplace=True)
-        df = df.append(run_df, ignore_index=True)
-    if run_scenario_b:
-        scenario = "B"
-        constants = {
+        },
+        "B": {
             "Animal Health": scenario_B_var_1,
             "Fertility Baseline": scenario_B_var_2 / 365.0,
-        }
-        run_df = run_model(model_env, model, scenario, constants, start_date, stop_date)
+        },
+    }
+    # after a data refresh every scenario is run again, not only the one whose slider moved
+    if trigger_variable != "date-range" and stored_input_version == input_version:
+        scenarios = {scenario: constants for scenario, constants in scenarios.items()
+                     if f"scenario-{scenario}" in trigger_variable}
+    if archive is not None:
+        scenario_ids = json.loads(stored_runs)["archived"] if ctx.triggered else {}
+        for scenario, constants in scenarios.items():
+            scenario_ids[scenario] = archived_run(scenario, constants, start_date, stop_date)
+        stored_runs = json.dumps({"archived": scenario_ids})
+        METRICS.observe_payload(stored_runs)
+        return stored_runs, input_version
+    if not ctx.triggered:
+        df = cached_run("startup", {}, start_date, stop_date).copy()
+    else:
+        df = cached_unpack(stored_runs).copy()
+    for scenario, constants in scenarios.items():
+        run_df = cached_run(scenario, constants, start_date, stop_date)
         df.drop(df[df["Scenario"] == scenario].index, inplace=True)
-        df = df.append(run_df, ignore_index=True)
+        df = concat_results([df, run_df])
     # terrible terrible bodge
     df.drop(df[df["Scenario"] == "startup"].index, inplace=True)
-    stored_runs = df.to_json(date_format='iso', orient='split')
-    return stored_runs
+    stored_runs = pack_runs(df)
+    METRICS.observe_payload(stored_runs)
+    return stored_runs, input_version
 
 
 @app.callback(
@@ -252,8 +331,14 @@ def run_scenario_x(
     Input("chart-1-y", "value"),
     Input("stored-runs", "data")
 )
+@timed_callback("update_chart_1")
 def update_chart_1(chart_1_y, stored_runs):
-    df = pd.read_json(stored_runs, orient="split")
+    if archive is not None:
+        # only the plotted variable is read from the archive
+        scenario_ids = json.loads(stored_runs)["archived"]
+        df = archive.read_frame(list(scenario_ids.values()), [chart_1_y])
+    else:
+        df = cached_unpack(stored_runs)
     fig = px.line(
         df.sort_values(["Scenario", "t"]),
         x="Date",
@@ -0,0 +1,209 @@
+""" Batches of model runs in parallel worker processes
+
+Each point of a batch is a dict of build-time parameters (DEFAULT_PARAMETERS
+in model_config2.py) and model constants. Every worker builds the input
+grid once, then for each point builds the model (a few milliseconds), runs
+it with the stepping engine and returns the requested variables, or the
+result of a summary function applied to them in the worker, so only small
+results travel back between processes.
+
+    runner = BatchRunner(df_input, start_date, stop_date, variables=["Retailer Price"])
+    prices = runner.run([{"trader_leadtime": 5.0}, {"trader_leadtime": 10.0}])
+    losses = runner.run(points, summary=functools.partial(price_loss, observed))
+
+summary must be picklable (a module-level function or a functools.partial of one).
+With steady_state=True each point's model starts from its steady state, with
+the inputs held at their mean over the year before the start (see
+steady_state.py), instead of the hand-set initial stocks. Points without a
+steady state run from the hand-set stocks (or, with steady_state="best", from
+the best state the solver reached) and are listed in runner.issues.
+With input_store (a directory, see input_store.py) the input grid is built
+once and published there, and workers attach to it memory-mapped instead of
+each receiving the data and building their own copy. The published version
+is pinned while the runner is open, and removed by close unless it is the
+store's current version or pinned by another process.
+Points whose run diverges (an arithmetic error such as a division by zero, or a
+guardrail with the abort policy, see guardrails.py) give None. After each batch,
+runner.issues lists why each aborted, flagged or unsteady run did so, by point index.
+"""
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from equation_optimizer import optimize_model
+from general_functions import datetime_to_serial
+from input_grid import build_input_grid
+from input_store import InputStore, columns_frame, grid_version
+from model_config2 import set_model_logic, DEFAULT_PARAMETERS
+from steady_state import initialize_steady_state, input_means
+from stepping import simulate_stepwise
+
+# state of a worker process, set once by _initialize_worker
+_worker = {}
+
+
+def _initialize_worker(df, start_serial, stop_serial, time_step_in_days, variables, guardrails=None,
+                       held_inputs=None, input_store=None, apply_unconverged=False, input_version=None):
+    """ held_inputs: inputs held to solve each point's steady state, None to keep the built initial values
+    apply_unconverged: start points without a steady state from the best state found
+    input_store, input_version: attach that version of the store's grid, df then only needs its columns
+    """
+    if input_store is not None:
+        input_grid = InputStore(input_store).attach(input_version)
+    else:
+        input_grid = build_input_grid(df, start_serial, stop_serial, time_step_in_days)
+    _worker.update(
+        guardrails=guardrails,
+        held_inputs=held_inputs,
+        apply_unconverged=apply_unconverged,
+        df=df,
+        start_serial=start_serial,
+        stop_serial=stop_serial,
+        time_step_in_days=time_step_in_days,
+        variables=list(variables),
+        input_grid=input_grid,
+    )
+
+
+def split_point(point):
+    """ Split a point into build-time parameters and model constants """
+    parameters = {key: value for key, value in point.items() if key in DEFAULT_PARAMETERS}
+    constants = {key: value for key, value in point.items() if key not in DEFAULT_PARAMETERS}
+    return parameters, constants
+
+
+def run_point(point, summary=None):
+    """ Build and run the model for one point in a worker, return (times, values) or its summary
+    Returns None if the run fails with an arithmetic error (the model diverged for these values)
+    and leaves why in _worker["issue"], as it does for a run with violations flagged by guardrails
+    """
+    _worker["issue"] = None
+    parameters, constants = split_point(point)
+    model = set_model_logic(
+        _worker["start_serial"], _worker["stop_serial"], _worker["df"], _worker["time_step_in_days"],
+        _worker["input_grid"], parameters=parameters
+    )
+    for name, value in constants.items():
+        if name not in model.constants:
+            raise KeyError(f"{name!r} is neither a model parameter nor a model constant")
+        model.constants[name].equation = value
+    optimize_model(model)
+    steady_issue = None
+    if _worker["held_inputs"] is not None:
+        # recorded as an issue of the point rather than warned about in every worker
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            report = initialize_steady_state(model, _worker["held_inputs"],
+                                             apply_unconverged=_worker["apply_unconverged"])
+        if not report["converged"]:
+            steady_issue = {"status": "unsteady", "applied": report["applied"], "residual": report["residual"]}
+    _worker["issue"] = steady_issue
+    guardrails = _worker["guardrails"]
+    try:
+        times, values = simulate_stepwise(model, _worker["variables"], guardrails=guardrails)
+    except ArithmeticError as error:
+        _worker["issue"] = {
+            "status": "aborted",
+            "reason": str(error),
+            "variable": getattr(error, "variable", None),
+            "t": getattr(error, "t", None),
+        }
+        return None
+    if guardrails is not None and guardrails.violations:
+        _worker["issue"] = {"status": "flagged", "violations": guardrails.violations}
+    if summary is not None:
+        return summary(times, values)
+    return times, values
+
+
+def _run_chunk(points, summary):
+    """ Results of a chunk of points, and the issues of the runs that had any """
+    results, issues = [], []
+    for i, point in enumerate(points):
+        results.append(run_point(point, summary))
+        if _worker["issue"] is not None:
+            issues.append((i, _worker["issue"]))
+    return results, issues
+
+
+class BatchRunner:
+    def __init__(self, df, start_date, stop_date, time_step_in_days=1.0, variables=("Retailer Price",),
+                 processes=None, guardrails=None, steady_state=False, input_store=None):
+        start_serial, stop_serial = datetime_to_serial([start_date, stop_date])
+        held_inputs = input_means(df, start_serial, time_step_in_days=time_step_in_days) if steady_state else None
+        apply_unconverged = steady_state == "best"
+        self.input_grid, self.input_pin = None, None
+        if input_store is not None:
+            self.input_grid = build_input_grid(df, start_serial, stop_serial, time_step_in_days)
+            df = columns_frame(self.input_grid)
+        # the input version is added by _publish_inputs
+        self.initargs = (df, start_serial, stop_serial, time_step_in_days, list(variables), guardrails,
+                         held_inputs, input_store, apply_unconverged)
+        self.input_store = input_store
+        self.variables = list(variables)
+        self.issues = []
+        self.processes = processes or os.cpu_count() or 1
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.input_pin is not None:
+            InputStore(self.input_store).unpin(self.input_pin, remove=True)
+            self.input_pin = None
+            if _worker.get("runner") == id(self):
+                # attach again (to a version published again) if the runner is reused
+                _worker.pop("runner")
+
+    def _publish_inputs(self):
+        """ Worker arguments, with the input grid published and pinned until close if it uses a store """
+        if self.input_grid is None:
+            return self.initargs + (None,)
+        version = grid_version(self.input_grid)
+        if self.input_pin is None:
+            store = InputStore(self.input_store)
+            self.input_pin = store.pin(version)
+            # published by name only: CURRENT is the version the dashboard attaches
+            store.publish(self.input_grid, make_current=False)
+        return self.initargs + (version,)
+
+    def run(self, points, summary=None, chunk_size=None):
+        """ Results of run_point for every point, in order (issues of the runs in self.issues) """
+        results, self.issues = [], []
+        for chunk_results, chunk_issues in self.map_chunks(_run_chunk, points, summary, chunk_size=chunk_size):
+            self.issues.extend({"index": len(results) + i, **issue} for i, issue in chunk_issues)
+            results.extend(chunk_results)
+        return results
+
+    def map_chunks(self, function, points, *args, chunk_size=None):
+        """ Yield function(chunk, *args) for chunks of points, in order, as the chunks finish
+        function runs in a worker (it may call run_point) and must be picklable
+        With processes=1 chunks run in this process, otherwise in a pool kept open between batches
+        """
+        points = list(points)
+        if self.processes == 1:
+            if _worker.get("runner") != id(self):
+                _initialize_worker(*self._publish_inputs())
+                _worker["runner"] = id(self)
+            chunk_size = chunk_size or max(1, len(points))
+            for i in range(0, len(points), chunk_size):
+                yield function(points[i:i + chunk_size], *args)
+            return
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                self.processes, initializer=_initialize_worker, initargs=self._publish_inputs()
+            )
+        if chunk_size is None:
+            # a few chunks per worker balances the load without much pickling overhead
+            chunk_size = max(1, int(np.ceil(len(points) / (4 * self.processes))))
+        chunks = [points[i:i + chunk_size] for i in range(0, len(points), chunk_size)]
+        yield from self.executor.map(function, chunks, *[[arg] * len(chunks) for arg in args])
@@ -0,0 +1,327 @@
+""" Benchmark suite for data ingestion, model setup and model runs
+
+Each case is timed over a number of repeats. Results are appended to
+benchmarks/history.jsonl (one JSON record per case per session) and compared
+against benchmarks/baseline.json, so that a change to model_config2.py that
+slows the model down shows up as a regression.
+
+Usage:
+    python benchmark.py                   run all cases, compare to baseline
+    python benchmark.py --save-baseline   run all cases and store them as the new baseline
+    python benchmark.py --cases run_model --repeat 5
+    python benchmark.py --scaling         ingestion and model runs on growing synthetic inputs
+    python benchmark.py --cases import    start-up time of a fresh process importing each module
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+import import_data
+import synthetic_data
+from delta_store import pack_runs, unpack_runs
+from model_operations import setup_model, run_model, model_hash
+from results import concat_results
+
+BENCHMARK_DIR = "benchmarks"
+HISTORY_FILE = os.path.join(BENCHMARK_DIR, "history.jsonl")
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+START_DATE = datetime(2015, 1, 1)
+HORIZONS = {
+    "1m": timedelta(days=31),
+    "1y": timedelta(days=365),
+    "5y": timedelta(days=5 * 365),
+}
+TIME_STEPS = [1.0, 0.5]
+LONG_RUN_START = datetime(2009, 1, 1)
+# cases that build a model (or a frame) first and return the time of the run (or packing) only
+SELF_TIMED_CASES = ("run_model/", "pack_runs/")
+
+# synthetic input sizes for the scaling cases, from about the real data to all north-east states
+SCALING_SIZES = [
+    {"years": (2014, 2021), "n_markets": 1, "n_states": 1, "n_commodities": 1, "events_per_day": 2.0},
+    {"years": (2009, 2021), "n_markets": 10, "n_states": 3, "n_commodities": 6, "events_per_day": 5.0},
+    {"years": (2009, 2021), "n_markets": 50, "n_states": 6, "n_commodities": 10, "events_per_day": 20.0},
+    {"years": (2009, 2021), "n_markets": 200, "n_states": 6, "n_commodities": 20, "events_per_day": 50.0},
+]
+
+READERS = {
+    "read_vam": lambda: import_data.read_vam("Rice (local)", "Maiduguri", "Price (VAM)"),
+    "read_nbs_inflation": lambda: import_data.read_nbs_inflation([
+        "Food Inflation", "Transport Inflation", "Rural Inflation"
+    ]),
+    "read_ucdp_conflict": lambda: import_data.read_ucdp_conflict("Deaths (UCDP)"),
+    "read_usda": lambda: import_data.read_usda("Production (USDA)"),
+    "read_iom": lambda: import_data.read_iom("IDP Population (IOM)"),
+}
+
+
+# modules a fresh process imports, from the bare interpreter to the simulation path and the data path
+IMPORT_MODULES = ["sys", "general_functions", "model_operations", "batch", "import_data"]
+
+
+class SkipCase(Exception):
+    """ Raised by a case that cannot run in this environment (e.g. missing data file) """
+
+
+def time_case(function, repeat):
+    """ Call function repeat times, return list of wall times and last result """
+    times = []
+    result = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - tic)
+    return times, result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_cases():
+    """ Yield (case name, function) pairs, in the order they should run """
+    inputs = {}
+
+    for module in IMPORT_MODULES:
+        def import_module(module=module):
+            # a new interpreter each time, the modules are cached in this one
+            subprocess.run([sys.executable, "-c", f"import {module}"], check=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+        yield f"import/{module}", import_module
+
+    for reader_name, reader in READERS.items():
+        def read(reader_name=reader_name, reader=reader):
+            try:
+                inputs[reader_name] = reader()
+            except FileNotFoundError as error:
+                raise SkipCase(str(error))
+            return inputs[reader_name]
+        yield f"ingest/{reader_name}", read
+
+    def read_all():
+        try:
+            inputs["all"] = import_data.import_all_data()
+        except FileNotFoundError as error:
+            raise SkipCase(str(error))
+        return inputs["all"]
+    yield "ingest/import_all_data", read_all
+
+    def model_inputs():
+        # fall back on the readers that did succeed, the model only needs some of the columns
+        if "all" in inputs:
+            return inputs["all"]
+        return pd.concat(
+            [inputs[reader_name] for reader_name in READERS if reader_name in inputs], axis=1, sort=True
+        )
+
+    for checking in [False, True]:
+        def build(checking=checking):
+            # the checks print every variable, keep the report readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                return setup_model(START_DATE, START_DATE + HORIZONS["1y"], model_inputs(), checking)
+        yield f"setup_model/checking={checking}", build
+
+    for dt in TIME_STEPS:
+        for horizon_name, horizon in HORIZONS.items():
+            def run(dt=dt, horizon=horizon):
+                stop_date = START_DATE + horizon
+                model_env, model = setup_model(START_DATE, stop_date, model_inputs(), time_step_in_days=dt)
+                tic = time.perf_counter()
+                run_model(model_env, model, "benchmark", {}, START_DATE, stop_date)
+                return time.perf_counter() - tic
+            yield f"run_model/{horizon_name}/dt={dt}", run
+
+    def run_optimized():
+        stop_date = START_DATE + HORIZONS["1y"]
+        model_env, model = setup_model(START_DATE, stop_date, model_inputs(), optimize=True)
+        tic = time.perf_counter()
+        run_model(model_env, model, "benchmark", {}, START_DATE, stop_date)
+        return time.perf_counter() - tic
+    yield "run_model/1y/optimized", run_optimized
+
+    def pack_compact():
+        # the app's two-scenario float32 frame, run once and packed and unpacked at every repeat
+        if "runs" not in inputs:
+            stop_date = START_DATE + HORIZONS["1y"]
+            model_env, model = setup_model(START_DATE, stop_date, model_inputs())
+            inputs["runs"] = concat_results([
+                run_model(model_env, model, scenario, constants, START_DATE, stop_date, {"dtype": "float32"})
+                for scenario, constants in [("A", {}), ("B", {"Retailer Leadtime": 14.0})]
+            ])
+        tic = time.perf_counter()
+        unpack_runs(pack_runs(inputs["runs"]))
+        return time.perf_counter() - tic
+    yield "pack_runs/1y/float32", pack_compact
+
+    def run_long():
+        # from the start of the UCDP data to today, with the iterative engine
+        start_date, stop_date = LONG_RUN_START, datetime.combine(date.today(), datetime.min.time())
+        model_env, model = setup_model(start_date, stop_date, model_inputs())
+        tic = time.perf_counter()
+        run_model(model_env, model, "benchmark", {}, start_date, stop_date, engine="stepping")
+        return time.perf_counter() - tic
+    yield "run_model/2009-today/stepping", run_long
+
+
+def run_benchmarks(repeat=3, case_filter=None):
+    """ Run all cases, return dict of case name -> result record """
+    results = {}
+    for case_name, function in build_cases():
+        if case_filter and not any(part in case_name for part in case_filter):
+            # ingest cases still run once, later cases depend on their output
+            if not case_name.startswith("ingest/"):
+                continue
+            try:
+                function()
+            except SkipCase:
+                pass
+            continue
+        try:
+            if case_name.startswith(SELF_TIMED_CASES):
+                # the case returns the time of what it measures, without its setup
+                times = [function() for _ in range(repeat)]
+            else:
+                times, _ = time_case(function, repeat)
+        except SkipCase as error:
+            print(f"{case_name:40s} skipped ({error})")
+            results[case_name] = {"status": "skipped", "reason": str(error)}
+            continue
+        results[case_name] = {
+            "status": "ok",
+            "repeat": repeat,
+            "min_s": min(times),
+            "median_s": statistics.median(times),
+            "max_s": max(times),
+        }
+        print(f"{case_name:40s} median {results[case_name]['median_s']:.4f}s "
+              f"(min {results[case_name]['min_s']:.4f}s)")
+    return results
+
+
+def run_scaling_benchmarks(repeat=1, sizes=SCALING_SIZES):
+    """ Time import_all_data and a one year model run on synthetic inputs of growing size """
+    results = {}
+    for size in sizes:
+        label = (f"years={size['years'][0]}-{size['years'][1]}/markets={size['n_markets']}"
+                 f"/states={size['n_states']}/events={size['events_per_day']}")
+        with tempfile.TemporaryDirectory() as data_dir:
+            rows = synthetic_data.generate_all(data_dir, **size)
+            times, df_input = time_case(lambda: import_data.import_all_data(data_dir), repeat)
+            results[f"scaling/ingest/{label}"] = {
+                "status": "ok", "repeat": repeat, "rows": rows,
+                "min_s": min(times), "median_s": statistics.median(times), "max_s": max(times),
+            }
+
+        stop_date = START_DATE + HORIZONS["1y"]
+        times = []
+        for _ in range(repeat):
+            model_env, model = setup_model(START_DATE, stop_date, df_input)
+            tic = time.perf_counter()
+            run_model(model_env, model, "benchmark", {}, START_DATE, stop_date)
+            times.append(time.perf_counter() - tic)
+        results[f"scaling/run_model_1y/{label}"] = {
+            "status": "ok", "repeat": repeat, "input_shape": list(df_input.shape),
+            "min_s": min(times), "median_s": statistics.median(times), "max_s": max(times),
+        }
+        for case_name in [f"scaling/ingest/{label}", f"scaling/run_model_1y/{label}"]:
+            print(f"{case_name:90s} median {results[case_name]['median_s']:.4f}s")
+    return results
+
+
+def session_metadata():
+    """ Information recorded with every benchmark session """
+    try:
+        _, model = setup_model(START_DATE, START_DATE + HORIZONS["1m"],
+                               pd.DataFrame(import_data.read_usda()))
+        current_model_hash = model_hash(model)
+    except Exception:
+        current_model_hash = None
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "model_hash": current_model_hash,
+        "python": platform.python_version(),
+        "machine": platform.node(),
+    }
+
+
+def append_history(results, metadata, path=HISTORY_FILE):
+    """ Append one JSON line per case to the history file """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as file:
+        for case_name, result in results.items():
+            file.write(json.dumps({**metadata, "case": case_name, **result}) + "\n")
+
+
+def save_baseline(results, metadata, path=BASELINE_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump({"metadata": metadata, "results": results}, file, indent=2)
+
+
+def compare_to_baseline(results, tolerance, path=BASELINE_FILE):
+    """ Return list of (case, baseline median, current median) that are slower than allowed """
+    if not os.path.exists(path):
+        print(f"no baseline at {path}, run with --save-baseline to create one")
+        return []
+    with open(path) as file:
+        baseline = json.load(file)["results"]
+    regressions = []
+    for case_name, result in results.items():
+        base = baseline.get(case_name)
+        if result["status"] != "ok" or base is None or base.get("status") != "ok":
+            continue
+        if result["median_s"] > base["median_s"] * (1.0 + tolerance):
+            regressions.append((case_name, base["median_s"], result["median_s"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cases", nargs="*", help="only run cases whose name contains one of these strings")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown relative to baseline median (0.25 = 25%%)")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--scaling", action="store_true",
+                        help="run the synthetic data scaling cases instead of the standard cases")
+    args = parser.parse_args(argv)
+
+    metadata = session_metadata()
+    if args.scaling:
+        results = run_scaling_benchmarks(args.repeat)
+    else:
+        results = run_benchmarks(args.repeat, args.cases)
+    append_history(results, metadata)
+
+    if args.save_baseline:
+        save_baseline(results, metadata)
+        print(f"baseline saved to {BASELINE_FILE}")
+        return 0
+
+    regressions = compare_to_baseline(results, args.tolerance)
+    for case_name, base_median, median in regressions:
+        print(f"REGRESSION {case_name}: {base_median:.4f}s -> {median:.4f}s "
+              f"({median / base_median:.2f}x)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+""" Calibration of the model against observed VAM prices
+
+The model's Retailer Price is an index (1 at equilibrium) while Price (VAM)
+is in NGN/kg, so the simulated price is scaled by a Baseline Price. For any
+set of parameters the best Baseline Price has a closed form: the loss is the
+mean squared error of log prices, and the scale that minimises it is the
+geometric mean ratio of observed to simulated prices.
+
+The other parameters (leadtimes, smoothing time, model constants) are fitted
+by a parallel pattern search: each iteration polls points around the current
+best along every axis (and extra random directions if there are more cores
+than axes), evaluates all of them at once through BatchRunner, moves to the
+best improvement or halves the step. Every evaluated point is cached, and
+the cache and search state are checkpointed to JSON after each iteration,
+so an interrupted calibration resumes where it stopped:
+
+    observed = df_input["Price (VAM)"]
+    with BatchRunner(df_input, start_date, stop_date) as runner:
+        calibration = Calibration(runner, observed, checkpoint_path="calibration.json")
+        result = calibration.run()
+"""
+import functools
+import json
+import os
+
+import numpy as np
+
+from general_functions import datetime_to_serial
+
+# name: (lower, upper, log scale)
+CALIBRATION_PARAMETERS = {
+    "trader_leadtime": (1.0, 60.0, True),
+    "wholesaler_leadtime": (1.0, 60.0, True),
+    "retailer_leadtime": (1.0, 30.0, True),
+    "smoothing_time": (1.0, 120.0, True),
+}
+
+
+def observation_index(times, observed_serials):
+    """ Index of the model step at each observation, -1 outside the run """
+    dt = times[1] - times[0] if len(times) > 1 else 1.0
+    index = np.round((np.asarray(observed_serials) - times[0]) / dt).astype(int)
+    return np.where((index >= 0) & (index < len(times)), index, -1)
+
+
+def log_price_residuals(observed_serials, log_observed, times, values):
+    """ Summary run in the workers: log observed minus log simulated price at each observation """
+    index = observation_index(times, observed_serials)
+    inside = index >= 0
+    simulated = values[index[inside], 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return log_observed[inside] - np.log(simulated)
+
+
+def price_loss(residuals):
+    """ Loss and log Baseline Price of one run, from its log residuals (None if the run failed) """
+    if residuals is None:
+        return float("inf"), 0.0
+    residuals = np.asarray(residuals)
+    if len(residuals) == 0 or not np.all(np.isfinite(residuals)):
+        return float("inf"), 0.0
+    log_baseline_price = residuals.mean()
+    return float(np.mean((residuals - log_baseline_price) ** 2)), float(log_baseline_price)
+
+
+class Calibration:
+    def __init__(self, runner, observed, parameters=None, fixed=None, checkpoint_path=None, seed=0):
+        """ runner: BatchRunner whose first variable is Retailer Price
+        observed: Series of observed prices indexed by date (NaN dropped)
+        parameters: {name: (lower, upper, log scale)} to fit, default CALIBRATION_PARAMETERS
+        fixed: parameters and constants held at given values in every run
+        """
+        self.runner = runner
+        self.parameters = dict(parameters or CALIBRATION_PARAMETERS)
+        self.names = list(self.parameters)
+        self.fixed = fixed or {}
+        self.checkpoint_path = checkpoint_path
+        self.rng = np.random.default_rng(seed)
+        observed = observed.dropna()
+        self.summary = functools.partial(
+            log_price_residuals,
+            np.asarray(datetime_to_serial(list(observed.index)), dtype="float64"),
+            np.log(observed.to_numpy(dtype="float64")),
+        )
+        self.cache = {}
+        self.state = None
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            self._read_checkpoint()
+
+    def to_values(self, unit_point):
+        """ Parameter values of a point in the unit cube """
+        values = {}
+        for name, u in zip(self.names, unit_point):
+            lower, upper, log_scale = self.parameters[name]
+            if log_scale:
+                values[name] = float(np.exp(np.log(lower) + u * (np.log(upper) - np.log(lower))))
+            else:
+                values[name] = float(lower + u * (upper - lower))
+        return values
+
+    def to_unit(self, values):
+        unit_point = []
+        for name in self.names:
+            lower, upper, log_scale = self.parameters[name]
+            if log_scale:
+                unit_point.append((np.log(values[name]) - np.log(lower)) / (np.log(upper) - np.log(lower)))
+            else:
+                unit_point.append((values[name] - lower) / (upper - lower))
+        return np.clip(unit_point, 0.0, 1.0)
+
+    @staticmethod
+    def _key(unit_point):
+        return tuple(round(float(u), 9) for u in unit_point)
+
+    def evaluate(self, unit_points):
+        """ Losses of points in the unit cube, running the ones not cached as one parallel batch """
+        keys = [self._key(u) for u in unit_points]
+        missing = list(dict.fromkeys(key for key in keys if key not in self.cache))
+        if missing:
+            points = [{**self.fixed, **self.to_values(key)} for key in missing]
+            for key, residuals in zip(missing, self.runner.run(points, summary=self.summary)):
+                self.cache[key] = price_loss(residuals)
+        return np.array([self.cache[key][0] for key in keys])
+
+    def _poll_directions(self):
+        n = len(self.names)
+        directions = np.vstack([np.eye(n), -np.eye(n)])
+        n_extra = self.runner.processes - len(directions)
+        if n_extra > 0:
+            # spare cores poll random directions too
+            extra = self.rng.normal(size=(n_extra, n))
+            directions = np.vstack([directions, extra / np.linalg.norm(extra, axis=1, keepdims=True)])
+        return directions
+
+    def run(self, initial=None, step=0.25, min_step=0.005, max_evaluations=2000):
+        """ Pattern search from initial values (default the centre of the bounds) or the checkpoint """
+        if self.state is None:
+            center = self.to_unit(initial) if initial is not None else np.full(len(self.names), 0.5)
+            self.state = {"center": center.tolist(), "step": step, "iteration": 0}
+        center = np.array(self.state["center"])
+        center_loss = self.evaluate([center])[0]
+
+        while self.state["step"] >= min_step and len(self.cache) < max_evaluations:
+            polls = np.clip(center + self.state["step"] * self._poll_directions(), 0.0, 1.0)
+            losses = self.evaluate(polls)
+            best = int(np.argmin(losses))
+            if losses[best] < center_loss:
+                center, center_loss = polls[best], losses[best]
+            else:
+                self.state["step"] /= 2.0
+            self.state["center"] = center.tolist()
+            self.state["iteration"] += 1
+            self._write_checkpoint()
+        return self.result()
+
+    def result(self):
+        center = np.array(self.state["center"])
+        loss, log_baseline_price = self.cache[self._key(center)]
+        return {
+            "parameters": {**self.fixed, **self.to_values(center)},
+            "baseline_price": float(np.exp(log_baseline_price)),
+            "loss": loss,
+            "rmse_log_price": float(np.sqrt(loss)),
+            "evaluations": len(self.cache),
+            "iterations": self.state["iteration"],
+        }
+
+    def _write_checkpoint(self):
+        if self.checkpoint_path is None:
+            return
+        checkpoint = {
+            "parameters": self.parameters,
+            "fixed": self.fixed,
+            "state": self.state,
+            "cache": [[list(key), loss, log_baseline_price]
+                      for key, (loss, log_baseline_price) in self.cache.items()],
+        }
+        # write then rename, so an interruption never leaves a half written checkpoint
+        with open(self.checkpoint_path + ".tmp", "w") as file:
+            json.dump(checkpoint, file)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def _read_checkpoint(self):
+        with open(self.checkpoint_path) as file:
+            checkpoint = json.load(file)
+        if list(checkpoint["parameters"]) != self.names:
+            raise ValueError(f"checkpoint {self.checkpoint_path} fits other parameters: "
+                             f"{list(checkpoint['parameters'])}")
+        self.state = checkpoint["state"]
+        self.cache = {tuple(key): (loss, log_baseline_price)
+                      for key, loss, log_baseline_price in checkpoint["cache"]}
@@ -0,0 +1,133 @@
+""" Conflict exposure of each market from geolocated UCDP events
+
+read_ucdp_conflict sums the deaths of every event in Borno state. What a
+market feels is the violence near it, so ConflictExposure indexes the
+markets in a KD-tree and finds, for each event, the markets within the
+largest radius. Only these (event, market, distance) pairs are kept, and
+daily features per market are summed from them on demand:
+
+    Deaths within {r} km    deaths of events within r km, for each radius
+    Exposure                deaths weighted by exp(-distance / decay_km),
+                            over events within the largest radius
+
+New events are added incrementally (events already added, by UCDP id, are
+skipped), so a refreshed event file only costs its new events:
+
+    exposure = ConflictExposure(vam_markets())
+    exposure.add_events(read_ucdp_events())
+    exposure.frame("Deaths within 50 km")                # Date x market
+    df_input["Deaths (UCDP)"] = exposure.danger_input("Maiduguri")
+
+danger_input is a drop-in replacement for the read_ucdp_conflict column. Only
+the earlier model in model_config.py reads that column (into Perceived
+Danger): the model that set_model_logic in model_config2.py builds does not
+use conflict data, so the feature is prepared here for a model that does.
+Distances are on an equirectangular projection centred on the markets,
+accurate to well under 1% over a few hundred km.
+"""
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from import_data import DATA_DIR
+
+EARTH_RADIUS_KM = 6371.0
+DEFAULT_RADII_KM = (10.0, 25.0, 50.0, 100.0)
+EXPOSURE = "Exposure"
+
+
+def to_km(latitude, longitude, reference_latitude):
+    """ (n, 2) array of x, y in km on an equirectangular projection """
+    latitude = np.radians(np.asarray(latitude, dtype="float64"))
+    longitude = np.radians(np.asarray(longitude, dtype="float64"))
+    x = EARTH_RADIUS_KM * longitude * np.cos(np.radians(reference_latitude))
+    return np.column_stack([x, EARTH_RADIUS_KM * latitude])
+
+
+def radius_feature(radius_km):
+    return f"Deaths within {radius_km:g} km"
+
+
+def read_ucdp_events(data_dir=DATA_DIR):
+    """ Every UCDP event with its id, date, coordinates and best estimate of deaths """
+    df = pd.read_csv(f"{data_dir}/conflict_data_nga.csv", skiprows=[1])
+    df["Date"] = pd.to_datetime(df["date_start"]).dt.normalize()
+    return df[["id", "Date", "latitude", "longitude", "best"]].dropna(subset=["latitude", "longitude"])
+
+
+class ConflictExposure:
+    def __init__(self, markets, radii_km=DEFAULT_RADII_KM, decay_km=25.0):
+        """ markets: frame with market, latitude and longitude columns (as vam_markets returns) """
+        self.markets = list(markets["market"])
+        self.market_index = {market: i for i, market in enumerate(self.markets)}
+        self.radii_km = sorted(radii_km)
+        self.decay_km = decay_km
+        self.features = [radius_feature(r) for r in self.radii_km] + [EXPOSURE]
+        self.reference_latitude = float(markets["latitude"].mean())
+        self.tree = cKDTree(to_km(markets["latitude"], markets["longitude"], self.reference_latitude))
+        # (event, market) pairs within the largest radius
+        self.pair_day = np.empty(0, dtype="datetime64[D]")
+        self.pair_market = np.empty(0, dtype="int64")
+        self.pair_distance = np.empty(0)
+        self.pair_deaths = np.empty(0)
+        self.seen_ids = set()
+        self.first_day = self.last_day = None
+
+    def add_events(self, events):
+        """ Add events (id, Date, latitude, longitude, best), skipping ids already added
+        Returns the number of new events
+        """
+        if "id" in events:
+            new = ~events["id"].isin(self.seen_ids)
+            events = events[new.to_numpy()]
+            self.seen_ids.update(events["id"].dropna())
+        if len(events) == 0:
+            return 0
+        days = events["Date"].to_numpy().astype("datetime64[D]")
+        self.first_day = days.min() if self.first_day is None else min(self.first_day, days.min())
+        self.last_day = days.max() if self.last_day is None else max(self.last_day, days.max())
+
+        event_tree = cKDTree(to_km(events["latitude"], events["longitude"], self.reference_latitude))
+        pairs = event_tree.sparse_distance_matrix(self.tree, self.radii_km[-1], output_type="ndarray")
+        deaths = events["best"].to_numpy(dtype="float64")
+        self.pair_day = np.concatenate([self.pair_day, days[pairs["i"]]])
+        self.pair_market = np.concatenate([self.pair_market, pairs["j"]])
+        self.pair_distance = np.concatenate([self.pair_distance, pairs["v"]])
+        self.pair_deaths = np.concatenate([self.pair_deaths, deaths[pairs["i"]]])
+        return len(events)
+
+    def days(self):
+        if self.first_day is None:
+            return pd.DatetimeIndex([], name="Date")
+        return pd.date_range(self.first_day, self.last_day, freq="D", name="Date")
+
+    def _weights(self, feature):
+        if feature == EXPOSURE:
+            return self.pair_deaths * np.exp(-self.pair_distance / self.decay_km)
+        radius = self.radii_km[[radius_feature(r) for r in self.radii_km].index(feature)]
+        return np.where(self.pair_distance <= radius, self.pair_deaths, 0.0)
+
+    def frame(self, feature=EXPOSURE, markets=None):
+        """ Daily feature of every market (or of the given markets), Date x market, zero without events """
+        if feature not in self.features:
+            raise ValueError(f"feature must be one of {self.features}, not {feature!r}")
+        markets = self.markets if markets is None else list(markets)
+        days = self.days()
+        columns = np.array([self.market_index[market] for market in markets], dtype="int64")
+        # position of each market in the output, -1 for markets not asked for
+        position = np.full(len(self.markets), -1)
+        position[columns] = np.arange(len(columns))
+        keep = position[self.pair_market] >= 0
+        day = (self.pair_day[keep] - self.first_day).astype("int64") if len(days) else np.empty(0, dtype="int64")
+        flat = day * len(columns) + position[self.pair_market[keep]]
+        values = np.bincount(flat, weights=self._weights(feature)[keep], minlength=len(days) * len(columns))
+        return pd.DataFrame(values.reshape(len(days), len(columns)), index=days, columns=markets)
+
+    def series(self, market, feature=EXPOSURE):
+        return self.frame(feature, [market])[market].rename(feature)
+
+    def danger_input(self, market, feature=None, output_col="Deaths (UCDP)"):
+        """ Daily feature of a market named and shaped like the read_ucdp_conflict column
+        (feature defaults to deaths within the largest radius)
+        """
+        return self.series(market, feature or radius_feature(self.radii_km[-1])).rename(output_col)
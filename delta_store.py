@@ -0,0 +1,137 @@
+""" Scenario runs as compressed deltas against a baseline run
+
+Scenarios usually differ from the baseline in a handful of constants, so most
+of their columns are identical to the baseline and the rest differ only in
+the low bits or after some date. A delta stores, per column, the XOR of the
+value bits with the baseline's, byte-shuffled and zlib-compressed. Identical
+columns are not stored at all, and reconstruction is exact.
+
+ScenarioArchive (see scenario_archive.py) stores the runs that share a
+baseline's time grid this way, one variable at a time with value_bits,
+compress_bits and decompress_bits. pack_runs / unpack_runs do the same for a
+multi-scenario frame held in a JSON session store (e.g. the app's
+dcc.Store). Values are stored as their bits, never as decimal text, so a
+compact_results frame keeps its dtypes (float32 values take half the payload
+of float64) and comes back exactly.
+"""
+import base64
+import json
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from results import ID_COLUMNS, DEBUG_COLUMNS, serials_to_datetime64
+
+
+def value_bits(values):
+    """ Unsigned integer view of a float array, with the same item size """
+    values = np.ascontiguousarray(values)
+    return values.view(f"u{values.dtype.itemsize}")
+
+
+def compress_bits(array):
+    """ zlib-compressed bytes of an unsigned integer array (from value_bits, or an XOR of two) """
+    # byte shuffle: group the n-th byte of every value together, zeros then compress well
+    shuffled = array.view("u1").reshape(-1, array.dtype.itemsize).T.copy()
+    return zlib.compress(shuffled.tobytes(), 6)
+
+
+def decompress_bits(blob, dtype, length):
+    """ Array of length values of dtype from compress_bits """
+    itemsize = np.dtype(dtype).itemsize
+    shuffled = np.frombuffer(zlib.decompress(blob), dtype="u1").reshape(itemsize, length)
+    return shuffled.T.copy().view(dtype).ravel()
+
+
+def value_columns(df):
+    return [column for column in df.columns if column not in ID_COLUMNS + DEBUG_COLUMNS]
+
+
+def same_time_grid(base_df, df):
+    return len(df) == len(base_df) and np.array_equal(df["t"].to_numpy(), base_df["t"].to_numpy())
+
+
+def encode_delta(base_df, df):
+    """ Delta of a wide result frame against a baseline frame on the same time grid
+    With base_df None, every column (and t) is stored in full
+    """
+    if base_df is not None and not same_time_grid(base_df, df):
+        raise ValueError("delta encoding needs the same time grid as the baseline")
+    columns = value_columns(df) if base_df is not None else ["t"] + value_columns(df)
+    changed = {}
+    for column in columns:
+        values = df[column].to_numpy()
+        if base_df is not None and column in base_df.columns and base_df[column].dtype == values.dtype:
+            difference = value_bits(values) ^ value_bits(base_df[column].to_numpy())
+            if not difference.any():
+                continue
+            changed[column] = {"mode": "xor", "dtype": values.dtype.str, "data": compress_bits(difference)}
+        else:
+            changed[column] = {"mode": "raw", "dtype": values.dtype.str, "data": compress_bits(value_bits(values))}
+    return {"length": len(df), "columns": columns, "changed": changed}
+
+
+def decode_delta(base_df, delta, scenario_name):
+    """ Rebuild a wide result frame from the baseline frame (or None) and a delta """
+    data = {} if "t" in delta["columns"] else {"t": base_df["t"].to_numpy()}
+    for column in delta["columns"]:
+        change = delta["changed"].get(column)
+        if change is None:
+            data[column] = base_df[column].to_numpy()
+            continue
+        dtype = np.dtype(change["dtype"])
+        bits = decompress_bits(change["data"], f"u{dtype.itemsize}", delta["length"])
+        if change["mode"] == "xor":
+            bits = bits ^ value_bits(base_df[column].to_numpy())
+        data[column] = bits.view(dtype)
+    df = pd.DataFrame(data)
+    df["Scenario"] = scenario_name
+    df["Date"] = serials_to_datetime64(df["t"])
+    return df
+
+
+def delta_size(delta):
+    return sum(len(change["data"]) for change in delta["changed"].values())
+
+
+def pack_runs(df):
+    """ JSON string of a multi-scenario wide frame: the first scenario in full,
+    the others as deltas against it where they share its time grid
+    Value columns keep their dtype, and a categorical Scenario comes back categorical
+    """
+    runs = []
+    base_df = None
+    for name in pd.unique(df["Scenario"]):
+        run_df = df[df["Scenario"] == name].reset_index(drop=True)
+        if base_df is not None and same_time_grid(base_df, run_df):
+            delta, is_delta = encode_delta(base_df, run_df), True
+        else:
+            delta, is_delta = encode_delta(None, run_df), False
+            if base_df is None:
+                base_df = run_df
+        for change in delta["changed"].values():
+            change["data"] = base64.b64encode(change["data"]).decode()
+        runs.append({"scenario": str(name), "is_delta": is_delta, **delta})
+    categorical = isinstance(df["Scenario"].dtype, pd.CategoricalDtype) if "Scenario" in df.columns else False
+    return json.dumps({"runs": runs, "categorical_scenario": categorical})
+
+
+def unpack_runs(text):
+    """ Multi-scenario wide frame from a pack_runs JSON string """
+    frames = []
+    base_df = None
+    packed = json.loads(text)
+    for run in packed["runs"]:
+        for change in run["changed"].values():
+            change["data"] = base64.b64decode(change["data"])
+        frame = decode_delta(base_df if run["is_delta"] else None, run, run["scenario"])
+        if base_df is None:
+            base_df = frame
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    if packed.get("categorical_scenario"):
+        df["Scenario"] = df["Scenario"].astype("category")
+    return df
@@ -0,0 +1,227 @@
+""" Percentile bands of large ensembles, without keeping the runs
+
+EnsembleAggregator consumes runs as they finish and keeps, for every
+(timestep, variable), a quantile sketch and running moments, never the runs
+themselves. The sketch counts values in logarithmically spaced buckets
+(as DDSketch does), so any quantile is within relative_accuracy of the true
+value, and two sketches merge exactly by adding their counts. Buckets cover
+every finite value (nothing is clamped), and only the buckets that hold
+values are stored, as sorted (cell, bucket) keys and counts: memory grows
+with the spread of the members, not with their number.
+
+Each worker aggregates its own chunk of the ensemble, and only the partial
+aggregators travel back to be merged:
+
+    with BatchRunner(df_input, start_date, stop_date, variables=["Retailer Price"]) as runner:
+        ensemble = run_ensemble(runner, points)
+    bands = ensemble.to_frame(quantiles=(0.05, 0.5, 0.95))
+    fig = band_figure(bands, "Retailer Price")
+"""
+import numpy as np
+import pandas as pd
+
+from batch import run_point
+from results import serials_to_datetime64
+
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+
+
+class EnsembleAggregator:
+    def __init__(self, variables, times, relative_accuracy=0.02, min_value=1e-9):
+        """ Values with magnitude below min_value count as 0, there is no upper limit
+        (the exact minimum and maximum are kept too, and bound every quantile)
+        """
+        self.variables = list(variables)
+        self.times = np.asarray(times, dtype="float64")
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.log_gamma = np.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.min_key = int(np.ceil(np.log(min_value) / self.log_gamma))
+        # keys up to the largest float, so no finite value is ever clamped
+        self.n_keys = int(np.ceil(np.log(np.finfo("float64").max) / self.log_gamma)) - self.min_key + 1
+        # buckets ordered by value: negative keys (largest magnitude first), zero, positive keys
+        self.zero_bucket = self.n_keys
+        self.stride = 2 * self.n_keys + 1
+        shape = (len(self.times), len(self.variables))
+        # sparse counts: sorted cell * stride + bucket keys of the buckets that hold values
+        self.keys = np.empty(0, dtype="int64")
+        self.counts = np.empty(0, dtype="int64")
+        self._pending_keys, self._pending_counts = [], []
+        self._pending_size = 0
+        self.n = np.zeros(shape, dtype="int64")
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.members = 0
+        self.failed = 0
+
+    def _buckets(self, values):
+        magnitude = np.abs(values)
+        with np.errstate(divide="ignore"):
+            keys = np.ceil(np.log(np.maximum(magnitude, self.min_value)) / self.log_gamma)
+        offset = keys.astype("int64") - self.min_key + 1
+        return np.where(magnitude < self.min_value, self.zero_bucket,
+                        self.zero_bucket + np.where(values < 0, -offset, offset))
+
+    def _add_counts(self, keys, counts=None):
+        self._pending_keys.append(keys)
+        self._pending_counts.append(np.ones(len(keys), dtype="int64") if counts is None else counts)
+        self._pending_size += len(keys)
+        # compact once the buffer outgrows the counts, so each value is compacted a few times at most
+        if self._pending_size > len(self.keys) + 2 ** 20:
+            self._compact()
+
+    def _compact(self):
+        if not self._pending_keys:
+            return
+        keys = np.concatenate([self.keys] + self._pending_keys)
+        counts = np.concatenate([self.counts] + self._pending_counts)
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(self.keys)).astype("int64")
+        self._pending_keys, self._pending_counts, self._pending_size = [], [], 0
+
+    @property
+    def nbytes(self):
+        """ Memory used by the bucket counts """
+        self._compact()
+        return self.keys.nbytes + self.counts.nbytes
+
+    def add(self, values):
+        """ Add one run (n_steps, n_variables) or a batch of runs (n_runs, n_steps, n_variables)
+        NaN values are skipped
+        """
+        values = np.asarray(values, dtype="float64")
+        if values.ndim == 2:
+            values = values[None]
+        if values.shape[1:] != self.n.shape:
+            raise ValueError(f"runs must be (n_steps, n_variables) = {self.n.shape}, not {values.shape[1:]}")
+        finite = np.isfinite(values)
+        cells = np.broadcast_to(np.arange(self.n.size).reshape(self.n.shape), values.shape)
+        self._add_counts(cells[finite] * self.stride + self._buckets(values[finite]))
+
+        # moments of the batch, merged into the running moments (Chan et al.)
+        n = finite.sum(axis=0)
+        masked = np.where(finite, values, 0.0)
+        batch_mean = np.divide(masked.sum(axis=0), n, out=np.zeros(self.n.shape), where=n > 0)
+        batch_m2 = np.where(finite, (values - batch_mean) ** 2, 0.0).sum(axis=0)
+        self._merge_moments(n, batch_mean, batch_m2)
+        self.min = np.minimum(self.min, np.where(finite, values, np.inf).min(axis=0))
+        self.max = np.maximum(self.max, np.where(finite, values, -np.inf).max(axis=0))
+        self.members += len(values)
+        return self
+
+    def _merge_moments(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean = np.where(total > 0, self.mean + delta * n / total, 0.0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.n * n / total, 0.0)
+        self.n = total
+
+    def merge(self, other):
+        """ Add the members of another aggregator with the same variables, times and buckets """
+        if (other.variables != self.variables or not np.array_equal(other.times, self.times)
+                or other.log_gamma != self.log_gamma or other.min_value != self.min_value):
+            raise ValueError("can only merge aggregators of the same variables, times and sketch settings")
+        other._compact()
+        self._add_counts(other.keys, other.counts)
+        self._merge_moments(other.n, other.mean, other.m2)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.members += other.members
+        self.failed += other.failed
+        return self
+
+    def _bucket_values(self, buckets):
+        """ Representative value of buckets, within relative_accuracy of the values they count """
+        offset = buckets - self.zero_bucket
+        keys = np.abs(offset) - 1 + self.min_key
+        with np.errstate(over="ignore"):
+            magnitude = 2 * np.exp(keys * self.log_gamma) / (1 + np.exp(self.log_gamma))
+        return np.where(offset == 0, 0.0, np.sign(offset) * magnitude)
+
+    def quantiles(self, quantiles=DEFAULT_QUANTILES):
+        """ (n_quantiles, n_steps, n_variables) array, NaN where a cell has no values """
+        self._compact()
+        # keys are sorted by cell then value, so the counts before a cell are the values of earlier cells
+        cumulative = np.cumsum(self.counts)
+        n = self.n.ravel()
+        before = np.cumsum(n) - n
+        result = np.empty((len(quantiles),) + self.n.shape)
+        for i, q in enumerate(quantiles):
+            rank = np.floor(q * (n - 1))
+            index = np.searchsorted(cumulative, before + rank + 1, side="left")
+            index = np.minimum(index, max(len(self.keys) - 1, 0))
+            buckets = self.keys[index] % self.stride if len(self.keys) else np.zeros(len(n), dtype="int64")
+            value = self._bucket_values(buckets).reshape(self.n.shape)
+            result[i] = np.where(self.n > 0, np.clip(value, self.min, self.max), np.nan)
+        return result
+
+    def std(self):
+        return np.sqrt(np.divide(self.m2, self.n - 1, out=np.full(self.n.shape, np.nan), where=self.n > 1))
+
+    def to_frame(self, quantiles=DEFAULT_QUANTILES):
+        """ Long frame: t, Date, Variable, Mean, Std, Min, Max and a column per quantile (P5, P50, ...) """
+        n_steps, n_variables = self.n.shape
+        df = pd.DataFrame({
+            "t": np.repeat(self.times, n_variables),
+            "Variable": np.tile(self.variables, n_steps),
+            "Members": self.n.ravel(),
+            "Mean": self.mean.ravel(),
+            "Std": self.std().ravel(),
+            "Min": self.min.ravel(),
+            "Max": self.max.ravel(),
+        })
+        for q, values in zip(quantiles, self.quantiles(quantiles)):
+            df[f"P{100 * q:g}"] = values.ravel()
+        df["Date"] = serials_to_datetime64(df["t"])
+        return df
+
+
+def _aggregate_chunk(points, variables, sketch_options):
+    """ Run a chunk of ensemble members in a worker, return their aggregator (None if all failed) """
+    aggregator, failed = None, 0
+    for point in points:
+        result = run_point(point)
+        if result is None:
+            failed += 1
+            continue
+        times, values = result
+        if aggregator is None:
+            aggregator = EnsembleAggregator(variables, times, **sketch_options)
+        aggregator.add(values)
+    if aggregator is not None:
+        aggregator.failed = failed
+    return aggregator, failed
+
+
+def run_ensemble(runner, points, chunk_size=None, **sketch_options):
+    """ Aggregate runs of every point through runner, merging the workers' aggregators as they finish """
+    ensemble, failed = None, 0
+    for aggregator, chunk_failed in runner.map_chunks(
+            _aggregate_chunk, points, runner.variables, sketch_options, chunk_size=chunk_size):
+        if aggregator is None:
+            failed += chunk_failed
+        elif ensemble is None:
+            ensemble = aggregator
+        else:
+            ensemble.merge(aggregator)
+    if ensemble is not None:
+        ensemble.failed += failed
+    return ensemble
+
+
+def band_figure(bands, variable, low="P5", middle="P50", high="P95"):
+    """ Plotly figure of a variable's median and band from EnsembleAggregator.to_frame """
+    import plotly.graph_objects as go
+
+    df = bands[bands["Variable"] == variable]
+    fig = go.Figure([
+        go.Scatter(x=df["Date"], y=df[high], mode="lines", line={"width": 0}, showlegend=False),
+        go.Scatter(x=df["Date"], y=df[low], mode="lines", line={"width": 0}, fill="tonexty",
+                   fillcolor="rgba(99, 110, 250, 0.2)", name=f"{low}-{high}"),
+        go.Scatter(x=df["Date"], y=df[middle], mode="lines", line={"color": "rgb(99, 110, 250)"}, name=middle),
+    ])
+    fig.update_layout(yaxis_title=variable)
+    return fig
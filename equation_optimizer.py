@@ -0,0 +1,272 @@
+""" Simplification of a built model's equations before it runs
+
+The actors build their equations incrementally (revenue.equation = 0.0, then
++= each cashflow; cash stocks start from a Zero Flow), so the equation trees
+carry 0.0 seeds, references to elements that are only a number, and
+converters that only rename another element (Revenue Forecast = Revenue).
+optimize_model rewrites every equation once the model is built:
+
+    folding      numbers summed or multiplied together are folded into one,
+                 0.0 terms and 1.0 factors dropped; elements whose equation
+                 is a number (other than constants) are replaced by it
+    aliases      a reference to a converter whose equation is just another
+                 element is replaced by that element
+    flattening   nested sums and products are flattened before folding
+    sharing      a subexpression used in more than one equation becomes one
+                 converter, evaluated (and memoized) once per step
+
+Constants are never folded, since scenarios and batches set them after the
+model is built (nor are elements named in keep). Converters whose equation
+is a number are inlined though, so a scenario value for one of them would
+change nothing: optimize_model records the inlined elements in
+model.inlined_elements, and register_scenario refuses scenario constants
+that name one (put such converters in keep). Terms keep their order, so
+results are unchanged to the last bit unless numbers are folded together.
+Optimize after every change to the equations (a model from setup_model is
+ready; the intervention terms that schedules add later are only added to
+the equations, see interventions.py):
+
+    report = optimize_model(model)
+    report["nodes_removed"]
+"""
+import BPTK_Py.sddsl.operators as operators
+from BPTK_Py.sddsl.converter import Converter
+from BPTK_Py.sddsl.element import Element
+
+SHARED_PREFIX = "Common Subexpression"
+
+
+# equations as tuples: ("num", value), ("ref", element or opaque operator),
+# ("sum", ((sign, node), ...)), ("prod", (node, ...)), ("div", a, b), ("min", a, b), ("max", a, b)
+
+def to_tree(equation):
+    """ Tuple tree of a BPTK equation """
+    if isinstance(equation, (int, float)) and not isinstance(equation, bool):
+        return ("num", float(equation))
+    if type(equation) is operators.UnaryOperator:
+        return to_tree(equation.element)
+    if isinstance(equation, operators.AdditionOperator):
+        return ("sum", ((1, to_tree(equation.element_1)), (1, to_tree(equation.element_2))))
+    if isinstance(equation, operators.SubtractionOperator):
+        return ("sum", ((1, to_tree(equation.element_1)), (-1, to_tree(equation.element_2))))
+    if isinstance(equation, operators.NumericalMultiplicationOperator):
+        return ("prod", (to_tree(equation.element_1), ("num", float(equation.element_2))))
+    if isinstance(equation, operators.MultiplicationOperator):
+        return ("prod", (to_tree(equation.element_1), to_tree(equation.element_2)))
+    if isinstance(equation, operators.DivisionOperator):
+        return ("div", to_tree(equation.element_1), to_tree(equation.element_2))
+    if isinstance(equation, operators.MinOperator):
+        return ("min", to_tree(equation.element_1), to_tree(equation.element_2))
+    if isinstance(equation, operators.MaxOperator):
+        return ("max", to_tree(equation.element_1), to_tree(equation.element_2))
+    # elements, and operators this pass leaves alone (functions, arrays, ...)
+    return ("ref", equation)
+
+
+def count_nodes(tree):
+    kind = tree[0]
+    if kind in ("num", "ref"):
+        return 1
+    if kind == "sum":
+        return 1 + sum(count_nodes(node) for _, node in tree[1])
+    if kind == "prod":
+        return 1 + sum(count_nodes(node) for node in tree[1])
+    return 1 + count_nodes(tree[1]) + count_nodes(tree[2])
+
+
+def key(tree):
+    """ Hashable identity of a tree, elements by name """
+    kind = tree[0]
+    if kind == "num":
+        return tree
+    if kind == "ref":
+        return ("ref", tree[1].name if isinstance(tree[1], Element) else tree[1].term())
+    if kind == "sum":
+        return ("sum", tuple((sign, key(node)) for sign, node in tree[1]))
+    if kind == "prod":
+        return ("prod", tuple(key(node) for node in tree[1]))
+    return (kind, key(tree[1]), key(tree[2]))
+
+
+def simplify(tree, substitutions):
+    """ Folded, flattened tree, with references in substitutions (name -> tree) replaced """
+    kind = tree[0]
+    if kind == "num":
+        return tree
+    if kind == "ref":
+        element = tree[1]
+        if isinstance(element, Element) and element.name in substitutions:
+            return substitutions[element.name]
+        return tree
+    if kind == "sum":
+        terms, number = [], 0.0
+        for sign, node in tree[1]:
+            node = simplify(node, substitutions)
+            if node[0] == "sum":
+                inner = [(sign * inner_sign, inner_node) for inner_sign, inner_node in node[1]]
+            else:
+                inner = [(sign, node)]
+            for inner_sign, inner_node in inner:
+                if inner_node[0] == "num":
+                    number += inner_sign * inner_node[1]
+                else:
+                    terms.append((inner_sign, inner_node))
+        if number != 0.0 or not terms:
+            terms.append((1, ("num", number)))
+        if len(terms) == 1 and terms[0][0] == 1:
+            return terms[0][1]
+        return ("sum", tuple(terms))
+    if kind == "prod":
+        factors, number = [], 1.0
+        for node in tree[1]:
+            node = simplify(node, substitutions)
+            for factor in (node[1] if node[0] == "prod" else (node,)):
+                if factor[0] == "num":
+                    number *= factor[1]
+                else:
+                    factors.append(factor)
+        if number != 1.0 or not factors:
+            factors.append(("num", number))
+        return factors[0] if len(factors) == 1 else ("prod", tuple(factors))
+    a, b = simplify(tree[1], substitutions), simplify(tree[2], substitutions)
+    if kind == "div" and b == ("num", 1.0):
+        return a
+    if a[0] == "num" and b[0] == "num":
+        if kind == "div" and b[1] != 0.0:
+            return ("num", a[1] / b[1])
+        if kind in ("min", "max"):
+            return ("num", min(a[1], b[1]) if kind == "min" else max(a[1], b[1]))
+    return (kind, a, b)
+
+
+def subtrees(tree):
+    """ Every operation node of a tree (not numbers or references) """
+    kind = tree[0]
+    if kind in ("num", "ref"):
+        return
+    yield tree
+    children = [node for _, node in tree[1]] if kind == "sum" else tree[1] if kind == "prod" else tree[1:]
+    for child in children:
+        yield from subtrees(child)
+
+
+def replace(tree, replacements):
+    """ Tree with subtrees whose key is in replacements replaced by them """
+    if tree[0] in ("num", "ref"):
+        return tree
+    if key(tree) in replacements:
+        return replacements[key(tree)]
+    return replace_below(tree, replacements)
+
+
+def replace_below(tree, replacements):
+    """ replace, except for the tree itself """
+    kind = tree[0]
+    if kind in ("num", "ref"):
+        return tree
+    if kind == "sum":
+        return ("sum", tuple((sign, replace(node, replacements)) for sign, node in tree[1]))
+    if kind == "prod":
+        return ("prod", tuple(replace(node, replacements) for node in tree[1]))
+    return (kind, replace(tree[1], replacements), replace(tree[2], replacements))
+
+
+def to_equation(tree):
+    """ BPTK equation of a tuple tree """
+    kind = tree[0]
+    if kind in ("num", "ref"):
+        return tree[1]
+    if kind == "sum":
+        # BPTK renders a + b and a - b without brackets, which is safe
+        # because no term of a flattened sum is itself a sum
+        terms = tree[1]
+        sign, first = terms[0]
+        equation = to_equation(first) if sign > 0 else operators.SubtractionOperator(0.0, to_equation(first))
+        for sign, node in terms[1:]:
+            operator = operators.AdditionOperator if sign > 0 else operators.SubtractionOperator
+            equation = operator(equation, to_equation(node))
+        return equation
+    if kind == "prod":
+        equation = to_equation(tree[1][0])
+        for node in tree[1][1:]:
+            equation = operators.MultiplicationOperator(equation, to_equation(node))
+        return equation
+    operator = {"div": operators.DivisionOperator, "min": operators.MinOperator, "max": operators.MaxOperator}[kind]
+    return operator(to_equation(tree[1]), to_equation(tree[2]))
+
+
+def optimize_model(model, share_subexpressions=True, keep=()):
+    """ Rewrite the equations of a built model, return a report of what changed
+    keep: names of elements never replaced by their equation (e.g. converters a scenario sets)
+    """
+    elements = {**model.converters, **model.flows, **model.stocks}
+    trees = {name: to_tree(element.equation) for name, element in elements.items()
+             if element.equation is not None and not element.arrayed}
+    nodes_before = sum(count_nodes(tree) for tree in trees.values())
+
+    # substitute numbers and aliases until nothing changes (an alias may point to an alias)
+    substitutions = {}
+    while True:
+        trees = {name: simplify(tree, substitutions) for name, tree in trees.items()}
+        found = {}
+        for name, tree in trees.items():
+            if name in substitutions or name in model.stocks or name in keep:
+                continue
+            is_number = tree[0] == "num"
+            is_alias = tree[0] == "ref" and isinstance(elements[name], Converter) and isinstance(tree[1], Element)
+            if is_number or is_alias:
+                found[name] = tree
+        if not found:
+            break
+        substitutions.update(found)
+
+    shared = []
+    if share_subexpressions:
+        # the whole equation of an element (not a stock: its equation is its change) defines that
+        # subexpression, so other uses refer to the element instead of a new converter
+        definitions = {key(tree): name for name, tree in trees.items()
+                       if name not in model.stocks and tree[0] not in ("num", "ref")}
+        while True:
+            uses = {}
+            for name, tree in trees.items():
+                for subtree in subtrees(tree):
+                    if subtree is tree and definitions.get(key(tree)) == name:
+                        continue
+                    uses.setdefault(key(subtree), [subtree, 0])[1] += 1
+            # the largest subexpression used twice, or used once and defined by an element
+            candidates = [subtree for subtree_key, (subtree, count) in uses.items()
+                          if count > 1 or subtree_key in definitions]
+            if not candidates:
+                break
+            subtree = max(candidates, key=count_nodes)
+            if key(subtree) not in definitions:
+                converter = model.converter(f"{SHARED_PREFIX} {len(shared) + 1}")
+                converter.equation = to_equation(subtree)
+                elements[converter.name] = converter
+                trees[converter.name] = subtree
+                definitions[key(subtree)] = converter.name
+                shared.append(converter.name)
+            definer = definitions[key(subtree)]
+            replacements = {key(subtree): ("ref", elements[definer])}
+            trees = {name: (replace_below(tree, replacements) if name == definer else replace(tree, replacements))
+                     for name, tree in trees.items()}
+
+    model.inlined_elements = set(getattr(model, "inlined_elements", set())) | set(substitutions)
+    changed = []
+    for name, tree in trees.items():
+        element = elements[name]
+        before = to_tree(element.equation)
+        if key(tree) != key(before):
+            element.equation = to_equation(tree)
+            changed.append(name)
+    model.reset_cache()
+
+    nodes_after = sum(count_nodes(tree) for tree in trees.values())
+    return {
+        "nodes_before": nodes_before,
+        "nodes_after": nodes_after,
+        "nodes_removed": nodes_before - nodes_after,
+        "equations_changed": len(changed),
+        "elements_inlined": sorted(substitutions),
+        "shared_subexpressions": shared,
+    }
@@ -32,15 +32,6 @@ def serial_to_datetime(serials):
         dates = datetime.utcfromtimestamp(seconds)
     return dates
 
-serial = [1000, 2000]
-date = serial_to_datetime(serial)
-serial2 = datetime_to_serial(date)
-date2 = serial_to_datetime(serial2)
-
-print(f"serial {serial}, date {date}, serial2 {serial2}, date2 {date2}")
-print(date == date2)
-
-
 
 def df_to_lookup(df, var_name):
     """ Create list for model lookup from central external data df """
@@ -58,9 +49,15 @@ def create_model_stock(model, stock_name):
     return stock_var, stock_initial_value_var
 
 
-def create_model_data_variable(model, df, data_name):
-    """ Create a variable that reads external data from the central df """
+def create_model_data_variable(model, df, data_name, input_grid=None):
+    """ Create a variable that reads external data from the central df
+    (or from the pre-aligned input_grid array, if it has the variable)
+    """
     data_var = model.converter(data_name)
+    if input_grid is not None and data_name in input_grid.column_index:
+        grid_value = model.function("input_grid", input_grid.lookup_function())
+        data_var.equation = grid_value(input_grid.column_index[data_name])
+        return data_var
     model.points[data_name] = df_to_lookup(df, data_name)
     data_var.equation = sd.lookup(sd.time(), data_name)
     return data_var
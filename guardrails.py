@@ -0,0 +1,107 @@
+""" Per-step health checks of a model run
+
+Some parameter values drive the model into a division by zero (a supply or
+a price reaching zero) or into values that grow without bound, after which
+the rest of the run is wasted. Guardrails checks, at every step of the
+stepping engine, every stock and output variable for NaN or inf values and
+for values outside their bounds (by default, stocks other than cash must
+not be negative). Each variable has a policy:
+
+    abort   raise ModelDivergenceError at the first violation
+    clamp   clip the value to its bounds and carry on with the clipped value
+            (from the next step for flows and converters, see _guarded_step)
+    flag    record the violation and carry on
+
+NaN and inf values abort the run under any policy, unless clamp brings an
+inf value back to a finite bound. The first violation of each variable is
+recorded, with its time and value:
+
+    guardrails = Guardrails(bounds={"Retailer Price": (0.0, 100.0)}, policies={"Retailer Price": "clamp"})
+    df = run_model(model_env, model, "base", {}, start_date, stop_date, engine="stepping",
+                   guardrails=guardrails)
+    guardrails.violations
+"""
+import numpy as np
+
+from general_functions import serial_to_datetime
+
+POLICIES = ["abort", "clamp", "flag"]
+
+
+class ModelDivergenceError(ArithmeticError):
+    """ Raised when a run violates a guardrail with the abort policy, or divides by zero """
+
+    def __init__(self, variable, t, value=None, kind=None, message=None):
+        self.variable = variable
+        self.t = float(t)
+        self.value = value
+        self.kind = kind
+        self.date = serial_to_datetime(t)
+        super().__init__(message or f"{variable} is {kind} ({value}) at t={t} ({self.date:%Y-%m-%d})")
+
+
+class Guardrails:
+    def __init__(self, bounds=None, policy="abort", policies=None, non_negative_stocks=True):
+        """ bounds: {variable: (lower, upper)}, either may be None
+        policy: default policy, policies: {variable: policy} for exceptions
+        non_negative_stocks: bound stocks other than cash stocks below by 0 (unless given bounds)
+        """
+        for value in [policy, *(policies or {}).values()]:
+            if value not in POLICIES:
+                raise ValueError(f"policy must be one of {POLICIES}, not {value!r}")
+        self.bounds = dict(bounds or {})
+        self.policy = policy
+        self.policies = dict(policies or {})
+        self.non_negative_stocks = non_negative_stocks
+        self.violations = []
+
+    def reset(self):
+        self.violations = []
+
+    @property
+    def first_violation(self):
+        return self.violations[0] if self.violations else None
+
+    def prepare(self, model, names):
+        """ Arrays of bounds and policies of names, checked together at every step """
+        lower = np.full(len(names), -np.inf)
+        upper = np.full(len(names), np.inf)
+        for i, name in enumerate(names):
+            if self.non_negative_stocks and name in model.stocks and not name.endswith(" Cash"):
+                lower[i] = 0.0
+            low, high = self.bounds.get(name, (None, None))
+            lower[i] = lower[i] if low is None else low
+            upper[i] = upper[i] if high is None else high
+        policies = np.array([self.policies.get(name, self.policy) for name in names])
+        return {"names": list(names), "lower": lower, "upper": upper, "clamp": policies == "clamp",
+                "abort": policies == "abort", "seen": np.zeros(len(names), dtype=bool)}
+
+    def check(self, checks, t, values):
+        """ Check the values of one step, return them (clamped where the policy is clamp) """
+        nan = np.isnan(values)
+        below, above = values < checks["lower"], values > checks["upper"]
+        bad = ~np.isfinite(values) | below | above
+        if not bad.any():
+            return values
+        values = values.copy()
+        for i in np.flatnonzero(bad):
+            name, value = checks["names"][i], values[i]
+            if nan[i]:
+                kind = "nan"
+            elif np.isinf(value):
+                kind = "inf"
+            else:
+                kind = "below bound" if below[i] else "above bound"
+            clamped = np.clip(value, checks["lower"][i], checks["upper"][i]) if checks["clamp"][i] else value
+            if nan[i] or checks["abort"][i] or not np.isfinite(clamped):
+                policy = "abort"
+            else:
+                policy = "clamp" if checks["clamp"][i] else "flag"
+            if not checks["seen"][i]:
+                checks["seen"][i] = True
+                self.violations.append({"variable": name, "t": float(t), "date": serial_to_datetime(t),
+                                        "value": float(value), "kind": kind, "policy": policy})
+            if policy == "abort":
+                raise ModelDivergenceError(name, t, value, kind)
+            values[i] = clamped
+        return values
@@ -0,0 +1,168 @@
+""" Rolling-origin hindcasts against observed VAM prices
+
+A hindcast starts the model at a historical origin and runs it forward with
+only the data known at the origin: every input is held at its last value
+(rates, such as Deaths (UCDP), at their mean over the rate_window days
+before the origin). The forecast Retailer Price index is scaled to NGN/kg
+by the last observed price at or before the origin, and compared with every
+observation up to the horizon.
+
+Rather than spinning up every origin from hand-set initial stocks, one base
+trajectory is run once on the observed data through all origins, and each
+hindcast starts from the base trajectory's stocks at its origin (a warm
+start). The hindcasts are independent and run in parallel:
+
+    origins = monthly_origins(datetime(2015, 1, 1), datetime(2021, 6, 1))
+    errors = run_hindcasts(df_input, origins, horizon_months=6, path="hindcast_errors.csv")
+    lead_time_summary(errors)
+"""
+import numpy as np
+import pandas as pd
+
+from batch import BatchRunner, _worker
+from general_functions import datetime_to_serial, serial_to_datetime
+from input_grid import InputGrid, build_input_grid
+from model_config2 import set_model_logic
+from stepping import simulate_stepwise, starts_one_step_in
+
+OBSERVED_COLUMN = "Price (VAM)"
+PRICE_VARIABLE = "Retailer Price"
+DAYS_PER_MONTH = 365.25 / 12
+
+
+def monthly_origins(start_date, stop_date):
+    """ First day of every month from start_date to stop_date """
+    return list(pd.date_range(start_date, stop_date, freq="MS").to_pydatetime())
+
+
+def persistence_grid(grid, origin_serial, rate_window=90.0):
+    """ Copy of an input grid with every series held after origin_serial at what was known then """
+    k = min(max(int(round((origin_serial - grid.start) / grid.dt)), 0), len(grid.values) - 1)
+    values = grid.values.copy()
+    for column, i in grid.column_index.items():
+        if grid.rules.get(column) == "sum_to_rate":
+            window = max(1, int(round(rate_window / grid.dt)))
+            values[k + 1:, i] = grid.values[max(0, k + 1 - window):k + 1, i].mean()
+        else:
+            values[k + 1:, i] = grid.values[k, i]
+    return InputGrid(grid.start, grid.dt, grid.columns, values, grid.rules)
+
+
+def warm_start(model, stock_values):
+    """ Set the initial value of model stocks (see checkpoint_step for which values continue a run) """
+    for name, value in stock_values.items():
+        model.stocks[name].initial_value = float(value)
+    model.reset_cache()
+    return model
+
+
+def checkpoint_step(model, step):
+    """ Step of a run whose stock values make a warm-started model continue that run from step
+    When stocks report their start one step in, the values of the step before are the ones that
+    step forward to the run's values at step
+    """
+    return step - 1 if starts_one_step_in(model) and step > 0 else step
+
+
+def _hindcast_chunk(items, rate_window):
+    """ Run hindcasts (origin serial, stop serial, stock values) in a worker, return their price runs """
+    results = []
+    for origin_serial, stop_serial, stock_values in items:
+        grid = persistence_grid(_worker["input_grid"], origin_serial, rate_window)
+        model = set_model_logic(origin_serial, stop_serial, _worker["df"], _worker["time_step_in_days"], grid)
+        warm_start(model, stock_values)
+        try:
+            times, values = simulate_stepwise(model, [PRICE_VARIABLE], guardrails=_worker["guardrails"])
+        except ArithmeticError:
+            times, values = None, None
+        results.append((times, None if values is None else values[:, 0]))
+    return results
+
+
+def score_hindcast(origin_serial, times, prices, observed_serials, observed_prices):
+    """ Rows of the error table for one hindcast: every observation after the origin within the run """
+    known = observed_serials <= origin_serial
+    if not known.any():
+        return []
+    last_serial, last_price = observed_serials[known][-1], observed_prices[known][-1]
+    target = (observed_serials > origin_serial) & (observed_serials <= times[-1])
+    # the index is scaled so the forecast at the origin equals the last known price
+    scale = last_price / np.interp(origin_serial, times, prices)
+    rows = []
+    for serial, observed in zip(observed_serials[target], observed_prices[target]):
+        forecast = scale * np.interp(serial, times, prices)
+        lead_in_days = serial - origin_serial
+        rows.append({
+            "Lead (days)": lead_in_days,
+            "Lead (months)": int(np.ceil(lead_in_days / DAYS_PER_MONTH)),
+            "Observed Date": serial_to_datetime(serial),
+            "Observed": observed,
+            "Forecast": forecast,
+            "Naive Forecast": last_price,
+            "Log Error": np.log(forecast) - np.log(observed),
+            "Naive Log Error": np.log(last_price) - np.log(observed),
+            "Last Observed Date": serial_to_datetime(last_serial),
+        })
+    return rows
+
+
+def run_hindcasts(df, origins, horizon_months=6, warm_up_days=365, time_step_in_days=1.0, rate_window=90.0,
+                  processes=None, path=None):
+    """ Error table of hindcasts from every origin, by origin and lead time (written to path as CSV if given)
+    The base trajectory starts warm_up_days before the first origin, to settle the hand-set initial stocks
+    """
+    origins = sorted(origins)
+    base_start = origins[0] - pd.Timedelta(days=warm_up_days)
+    stops = [origin + pd.DateOffset(months=horizon_months) for origin in origins]
+    base_stop = max(stops)
+    start_serial, stop_serial = datetime_to_serial([base_start, base_stop])
+
+    # base trajectory of every stock on the observed data
+    grid = build_input_grid(df, start_serial, stop_serial, time_step_in_days)
+    base_model = set_model_logic(start_serial, stop_serial, df, time_step_in_days, grid)
+    stocks = list(base_model.stocks)
+    base_times, base_values = simulate_stepwise(base_model, stocks)
+
+    items = []
+    for origin, stop in zip(origins, stops):
+        origin_serial, origin_stop_serial = datetime_to_serial([origin, stop])
+        step = int(round((origin_serial - base_times[0]) / time_step_in_days))
+        checkpoint = checkpoint_step(base_model, step)
+        items.append((base_times[step], origin_stop_serial, dict(zip(stocks, base_values[checkpoint]))))
+
+    runner = BatchRunner(df, base_start, base_stop, time_step_in_days, [PRICE_VARIABLE], processes)
+    with runner:
+        runs = []
+        for chunk_results in runner.map_chunks(_hindcast_chunk, items, rate_window):
+            runs.extend(chunk_results)
+
+    observed = df[OBSERVED_COLUMN].dropna()
+    observed_serials = np.asarray(datetime_to_serial(list(observed.index)), dtype="float64")
+    observed_prices = observed.to_numpy(dtype="float64")
+    rows = []
+    for origin, (origin_serial, _, _), (times, prices) in zip(origins, items, runs):
+        if times is None:
+            rows.append({"Origin": origin, "Status": "diverged"})
+            continue
+        for row in score_hindcast(origin_serial, times, prices, observed_serials, observed_prices):
+            rows.append({"Origin": origin, "Status": "ok", **row})
+    errors = pd.DataFrame(rows)
+    if path is not None:
+        errors.to_csv(path, index=False)
+    return errors
+
+
+def lead_time_summary(errors):
+    """ Error statistics by lead month, with the naive (last observed price) forecast for reference """
+    errors = errors[errors["Status"] == "ok"]
+    grouped = errors.groupby("Lead (months)")
+    summary = pd.DataFrame({
+        "Hindcasts": grouped["Origin"].nunique(),
+        "Observations": grouped.size(),
+        "Bias (log)": grouped["Log Error"].mean(),
+        "MAE (log)": grouped["Log Error"].apply(lambda e: e.abs().mean()),
+        "RMSE (log)": grouped["Log Error"].apply(lambda e: np.sqrt((e ** 2).mean())),
+        "Naive RMSE (log)": grouped["Naive Log Error"].apply(lambda e: np.sqrt((e ** 2).mean())),
+    })
+    summary["Skill"] = 1.0 - summary["RMSE (log)"] / summary["Naive RMSE (log)"]
+    return summary
@@ -1,27 +1,26 @@
-import hdx.hdx_configuration
 import pandas as pd
-import plotly.express as px
 import numpy as np
 from datetime import datetime
 
-from hdx.utilities.easy_logging import setup_logging
-from hdx.hdx_configuration import Configuration
-from hdx.data.dataset import Dataset
+from instrumentation import phase
 
+DATA_DIR = "data"
 
-def import_all_data():
+
+def import_all_data(data_dir=DATA_DIR):
     """ Read all data from CSV files and store in one df
     Units must be: kg, day, NGN, USD, single death
     """
-    df = pd.DataFrame()
-    df = pd.concat([df, read_vam("Rice (local)", "Maiduguri", "Price (VAM)")], axis=1)
-    df = pd.concat([df, read_nbs_inflation([
-        "Food Inflation", "Transport Inflation", "Rural Inflation"
-    ])], axis=1)
-    df = pd.concat([df, read_ucdp_conflict("Deaths (UCDP)")], axis=1)
-    df = pd.concat([df, read_usda("Production (USDA)")], axis=1)
-    df = pd.concat([df, read_iom("IDP Population (IOM)")], axis=1)
-    return df.sort_index()
+    with phase("ingest"):
+        df = pd.DataFrame()
+        df = pd.concat([df, read_vam("Rice (local)", "Maiduguri", "Price (VAM)", data_dir)], axis=1)
+        df = pd.concat([df, read_nbs_inflation([
+            "Food Inflation", "Transport Inflation", "Rural Inflation"
+        ], data_dir)], axis=1)
+        df = pd.concat([df, read_ucdp_conflict("Deaths (UCDP)", data_dir)], axis=1)
+        df = pd.concat([df, read_usda("Production (USDA)")], axis=1)
+        df = pd.concat([df, read_iom("IDP Population (IOM)", data_dir)], axis=1)
+        return df.sort_index()
 
 
 def download_all_data():
@@ -33,10 +32,15 @@ def download_all_data():
 
 def download_from_hdx(hdx_name, resource_number=0):
     """ Download most recent dataset from HDX and save as CSV """
+    # the HDX client is slow to import and only needed here, not by the simulation
+    from hdx.utilities.easy_logging import setup_logging
+    from hdx.hdx_configuration import Configuration, ConfigurationError
+    from hdx.data.dataset import Dataset
+
     setup_logging()
     try:
         Configuration.create(hdx_site='prod', user_agent='SD_model_demo', hdx_read_only=True)
-    except hdx.hdx_configuration.ConfigurationError:
+    except ConfigurationError:
         pass
     dataset = Dataset.read_from_hdx(hdx_name)
     resources = dataset.get_resources()
@@ -48,9 +52,9 @@ def download_from_hdx(hdx_name, resource_number=0):
     return
 
 
-def read_vam(commodities, market, output_col):
+def read_vam(commodities, market, output_col, data_dir=DATA_DIR):
     """ Read VAM data from CSV and output df """
-    filename = "data/wfp_food_prices_nga.csv"
+    filename = f"{data_dir}/wfp_food_prices_nga.csv"
     df = pd.read_csv(filename, skiprows=[1])
     df["Date"] = pd.to_datetime(df["date"])
 
@@ -83,9 +87,9 @@ def read_vam(commodities, market, output_col):
     return df
 
 
-def read_fao_inflation(type, output_col):
+def read_fao_inflation(type, output_col, data_dir=DATA_DIR):
     # read file and set date
-    filename = "data/consumer-price-indices_nga.csv"
+    filename = f"{data_dir}/consumer-price-indices_nga.csv"
     df = pd.read_csv(filename, skiprows=[1])
     df["Date"] = pd.to_datetime(df["StartDate"])
     # filter df
@@ -99,8 +103,8 @@ def read_fao_inflation(type, output_col):
     return df
 
 
-def read_nbs_inflation(output_cols):
-    filename = "data/cpi_1NewJULY2021.xlsx"
+def read_nbs_inflation(output_cols, data_dir=DATA_DIR):
+    filename = f"{data_dir}/cpi_1NewJULY2021.xlsx"
     sheet_start, sheet_stop = '1995-01-01', '2021-07-01'
     dates = pd.date_range(sheet_start, sheet_stop, freq='MS')
 
@@ -122,8 +126,8 @@ def read_nbs_inflation(output_cols):
     return df
 
 
-def read_ucdp_conflict(output_col="Deaths (UCDP)"):
-    filename = "data/conflict_data_nga.csv"
+def read_ucdp_conflict(output_col="Deaths (UCDP)", data_dir=DATA_DIR):
+    filename = f"{data_dir}/conflict_data_nga.csv"
     df = pd.read_csv(filename, skiprows=[1])
     df["Date"] = pd.to_datetime(df["date_start"])
     adm_1 = "Borno state"
@@ -158,10 +162,10 @@ def read_usda(output_col="Production (USDA)"):
     return dfo[output_col]
 
 
-def read_iom(output_col="IDP Population (IOM)"):
+def read_iom(output_col="IDP Population (IOM)", data_dir=DATA_DIR):
     """ Note: doesn't actually read HDX files, just reads previously processed sheet
     """
-    filename = "data/_IOM compile.xlsx"
+    filename = f"{data_dir}/_IOM compile.xlsx"
     df = pd.read_excel(filename)
     df.index = pd.to_datetime(df["Date"])
     df[output_col] = df["IDPs"]
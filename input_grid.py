@@ -0,0 +1,152 @@
+""" Input data aligned once onto the model's time grid
+
+import_all_data returns one sparse daily frame, mostly NaN, in which every
+series keeps its own frequency. The model's lookups interpolate each series
+again at every evaluation. build_input_grid instead resamples every series
+once onto the dt grid, with a rule per series, and keeps the result as one
+dense float array:
+
+    step         value of the last observation (monthly indices, counts)
+    linear       linear interpolation between observations, like sd.lookup
+    sum_to_rate  observations summed per step and divided by dt (events per day)
+
+Before the first and after the last observation, step and linear hold the
+end value, as sd.lookup does; sum_to_rate is zero where there are no events.
+
+The grid is anchored on the model start and extended to cover the data, so
+runs over other date ranges (with the same dt) use the same grid:
+
+    grid = build_input_grid(df, start_serial, stop_serial, dt)
+    model = set_model_logic(start_serial, stop_serial, df, dt, input_grid=grid)
+"""
+import numpy as np
+import pandas as pd
+
+from general_functions import datetime_to_serial
+
+SERIES_RULES = {
+    "Price (VAM)": "linear",
+    "Food Inflation": "step",
+    "Transport Inflation": "step",
+    "Rural Inflation": "step",
+    "Deaths (UCDP)": "sum_to_rate",
+    "Production (USDA)": "linear",
+    "IDP Population (IOM)": "linear",
+}
+DEFAULT_RULE = "linear"
+RULES = ["step", "linear", "sum_to_rate"]
+
+
+class InputGrid:
+    """ Dense (steps x series) array of inputs on the serial times start + dt * i """
+
+    def __init__(self, start, dt, columns, values, rules):
+        self.start = start
+        self.dt = dt
+        self.columns = list(columns)
+        self.values = values
+        self.rules = rules
+        self.column_index = {column: i for i, column in enumerate(self.columns)}
+
+    @property
+    def times(self):
+        return self.start + self.dt * np.arange(len(self.values))
+
+    def series(self, column):
+        return self.values[:, self.column_index[column]]
+
+    def value(self, column, t):
+        return self.lookup_function()(None, t, self.column_index[column])
+
+    def lookup_function(self):
+        """ Function for model.function: value of a column at time t
+        Times between grid points (other dt) are interpolated, outside the grid the end value is held
+        """
+        values, start, dt = self.values, self.start, self.dt
+        last = len(values) - 1
+
+        def grid_value(model, t, column):
+            position = (t - start) / dt
+            i = int(round(position))
+            if abs(position - i) > 1e-6:
+                # off the grid: interpolate between the neighbouring steps
+                i = min(max(int(np.floor(position)), 0), last)
+                j = min(i + 1, last)
+                fraction = min(max(position - i, 0.0), 1.0)
+                return float(values[i, column] * (1.0 - fraction) + values[j, column] * fraction)
+            return float(values[min(max(i, 0), last), column])
+
+        return grid_value
+
+    def covers(self, start_serial, stop_serial, dt):
+        """ Whether a run over these serials can use the grid without interpolation """
+        offset = (start_serial - self.start) / self.dt
+        return (
+            abs(dt - self.dt) < 1e-9
+            and abs(offset - round(offset)) < 1e-6
+            and start_serial >= self.start - 1e-6
+            and stop_serial <= self.times[-1] + 1e-6
+        )
+
+    def to_frame(self):
+        df = pd.DataFrame(self.values, columns=self.columns)
+        df.insert(0, "t", self.times)
+        return df
+
+    def save(self, path):
+        np.savez(path, start=self.start, dt=self.dt, columns=np.array(self.columns),
+                 values=self.values, rules=np.array([self.rules[column] for column in self.columns]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            columns = [str(column) for column in arrays["columns"]]
+            return cls(float(arrays["start"]), float(arrays["dt"]), columns, arrays["values"],
+                       dict(zip(columns, [str(rule) for rule in arrays["rules"]])))
+
+
+def align_series(serials, values, times, dt, rule):
+    """ One series of observations (serial times, values) resampled onto times """
+    if rule not in RULES:
+        raise ValueError(f"rule must be one of {RULES}, not {rule!r}")
+    if len(serials) == 0:
+        return np.zeros(len(times)) if rule == "sum_to_rate" else np.full(len(times), np.nan)
+    if rule == "linear":
+        return np.interp(times, serials, values)
+    if rule == "step":
+        index = np.searchsorted(serials, times + 1e-9, side="right") - 1
+        return values[np.maximum(index, 0)]
+    # sum_to_rate: step i collects the observations in [t_i, t_i + dt)
+    index = np.floor((serials - times[0]) / dt + 1e-9).astype(int)
+    inside = (index >= 0) & (index < len(times))
+    return np.bincount(index[inside], weights=values[inside], minlength=len(times)) / dt
+
+
+def build_input_grid(df, start_serial, stop_serial, dt, rules=None, columns=None):
+    """ Align the columns of an import_all_data frame onto the dt grid from start_serial
+    The grid is extended by whole steps on both sides to cover every observation
+    """
+    rules = {**SERIES_RULES, **(rules or {})}
+    if columns is None:
+        columns = list(df.columns)
+
+    observations = {}
+    first, last = start_serial, stop_serial
+    for column in columns:
+        series = df[column].dropna()
+        serials = np.asarray(datetime_to_serial(list(series.index)), dtype="float64")
+        observations[column] = (serials, series.to_numpy(dtype="float64"))
+        if len(serials):
+            first, last = min(first, serials[0]), max(last, serials[-1])
+
+    n_before = int(np.ceil((start_serial - first) / dt - 1e-9))
+    grid_start = start_serial - n_before * dt
+    n_steps = int(np.ceil((last - grid_start) / dt - 1e-9)) + 1
+    times = grid_start + dt * np.arange(n_steps)
+
+    values = np.empty((n_steps, len(columns)))
+    for i, column in enumerate(columns):
+        serials, series_values = observations[column]
+        values[:, i] = align_series(serials, series_values, times, dt, rules.get(column, DEFAULT_RULE))
+    return InputGrid(grid_start, dt, columns, values,
+                     {column: rules.get(column, DEFAULT_RULE) for column in columns})
@@ -0,0 +1,176 @@
+""" Versioned, memory-mapped input grids shared by worker processes
+
+Every dashboard worker and every process of a batch used to read and align
+the input data itself, holding a private copy of it. An InputStore keeps
+each aligned input grid (see input_grid.py) once on disk, as a .npy array
+that processes open memory-mapped and read-only, so they all share the
+same pages of the OS page cache instead of copying it:
+
+    store = InputStore("input_store")
+    store.publish(build_input_grid(df_input, start_serial, stop_serial, dt))   # once, after a data refresh
+    grid = store.attach()                                                      # in every worker
+    model = set_model_logic(start_serial, stop_serial, columns_frame(grid), dt, input_grid=grid)
+
+A version is the hash of the grid's content, in its own directory. CURRENT
+names the version to attach, and publish switches it atomically once the
+new version is complete, so a refresh never shows a half-written grid.
+Workers attached to an older version keep reading it (its files stay valid
+while mapped, even after prune removes them) until they attach again.
+With INPUT_STORE set, app.py attaches the current version instead of
+importing the data, and attaches again at the next request once
+update_data_sources.py has published a refresh.
+
+A process that needs a version that is not current (BatchRunner, whose
+workers may attach long after it published) pins it: prune keeps pinned
+versions, and unpin removes the version once nothing else pins it. Pins of
+processes that are gone no longer count.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from general_functions import datetime_to_serial
+from input_grid import InputGrid, build_input_grid
+
+CURRENT_FILE = "CURRENT"
+META_FILE = "meta.json"
+VALUES_FILE = "values.npy"
+PINS_DIR = "pins"
+
+
+def grid_version(grid):
+    """ Hash of a grid's content, the same for the same data """
+    digest = hashlib.sha1()
+    digest.update(json.dumps([grid.start, grid.dt, grid.columns, [grid.rules[column] for column in grid.columns]])
+                  .encode())
+    digest.update(np.ascontiguousarray(grid.values, dtype="float64").tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def columns_frame(grid):
+    """ Frame with the grid's columns and no rows, to build a model that reads every input from the grid """
+    return pd.DataFrame(columns=grid.columns, index=pd.DatetimeIndex([], name="Date"), dtype="float64")
+
+
+class InputStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _version_path(self, version, file_name=""):
+        return os.path.join(self.path, version, file_name)
+
+    def current(self):
+        """ Version that attach uses by default, None before anything is published """
+        current_path = os.path.join(self.path, CURRENT_FILE)
+        if not os.path.exists(current_path):
+            return None
+        with open(current_path) as file:
+            return file.read().strip()
+
+    def versions(self):
+        """ Published versions, oldest first """
+        versions = [name for name in os.listdir(self.path) if os.path.exists(self._version_path(name, META_FILE))]
+        return sorted(versions, key=lambda version: os.path.getmtime(self._version_path(version, META_FILE)))
+
+    def publish(self, grid, make_current=True):
+        """ Write a grid as a new version (unless it is already published), return its version
+        make_current: switch CURRENT to it, False to publish a version only attached by name
+        """
+        version = grid_version(grid)
+        if not os.path.exists(self._version_path(version, META_FILE)):
+            # write into a temporary directory, then rename it, so a version is complete or absent
+            tmp_path = os.path.join(self.path, f".{version}.{os.getpid()}.tmp")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            np.save(os.path.join(tmp_path, VALUES_FILE), np.ascontiguousarray(grid.values, dtype="float64"))
+            meta = {"start": grid.start, "dt": grid.dt, "columns": grid.columns, "rules": grid.rules,
+                    "published": datetime.now().isoformat(timespec="seconds")}
+            with open(os.path.join(tmp_path, META_FILE), "w") as file:
+                json.dump(meta, file, indent=1)
+            try:
+                os.rename(tmp_path, self._version_path(version))
+            except OSError:
+                # published by another process meanwhile
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        if make_current:
+            current_path = os.path.join(self.path, CURRENT_FILE)
+            tmp_path = f"{current_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as file:
+                file.write(version)
+            os.replace(tmp_path, current_path)
+        return version
+
+    def attach(self, version=None):
+        """ InputGrid of a version (the current one by default) whose values are a read-only memory map """
+        version = version or self.current()
+        if version is None:
+            raise FileNotFoundError(f"no input grid has been published to {self.path}")
+        with open(self._version_path(version, META_FILE)) as file:
+            meta = json.load(file)
+        values = np.load(self._version_path(version, VALUES_FILE), mmap_mode="r")
+        return InputGrid(meta["start"], meta["dt"], meta["columns"], values, meta["rules"])
+
+    def pin(self, version):
+        """ Keep a version from prune until unpin, return the pin (pin before publishing, so no unpin
+        of another process removes the version in between)
+        """
+        os.makedirs(os.path.join(self.path, PINS_DIR), exist_ok=True)
+        pin = os.path.join(self.path, PINS_DIR, f"{version}.{os.getpid()}.{uuid.uuid4().hex[:8]}")
+        open(pin, "w").close()
+        return pin
+
+    def pinned(self):
+        """ Versions pinned by running processes, pins of processes that are gone are removed """
+        pins_path = os.path.join(self.path, PINS_DIR)
+        versions = set()
+        for name in os.listdir(pins_path) if os.path.isdir(pins_path) else []:
+            version, pid, _ = name.split(".")
+            if _process_alive(int(pid)):
+                versions.add(version)
+            else:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(pins_path, name))
+        return versions
+
+    def unpin(self, pin, remove=False):
+        """ Release a pin, with remove also remove its version unless it is current or still pinned """
+        version = os.path.basename(pin).split(".")[0]
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(pin)
+        if remove and version != self.current() and version not in self.pinned():
+            shutil.rmtree(self._version_path(version), ignore_errors=True)
+
+    def prune(self, keep=2):
+        """ Remove all but the newest keep versions, the current one and the pinned ones,
+        return the removed versions
+        """
+        versions = self.versions()
+        kept = set(versions[-keep:] if keep > 0 else []) | {self.current()} | self.pinned()
+        removed = [version for version in versions if version not in kept]
+        for version in removed:
+            shutil.rmtree(self._version_path(version), ignore_errors=True)
+        return removed
+
+
+def publish_inputs(path, df, start_date=datetime(2018, 1, 1), stop_date=None, time_step_in_days=1.0):
+    """ Align an import_all_data frame and publish it as the current version of the store at path """
+    start_serial, stop_serial = datetime_to_serial([start_date, stop_date or datetime.now()])
+    return InputStore(path).publish(build_input_grid(df, start_serial, stop_serial, time_step_in_days))
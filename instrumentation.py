@@ -0,0 +1,192 @@
+""" Opt-in instrumentation of model phases and equation evaluations
+
+Nothing is recorded unless profiling is switched on:
+
+    profiler = enable_profiling()
+    df_input = import_all_data()
+    model_env, model = setup_model(start_date, stop_date, df_input)
+    df = run_model(model_env, model, "base", {}, start_date, stop_date)
+    disable_profiling()
+    print(profiler.report())
+    profiler.to_json("profile.json")
+    profiler.to_collapsed("profile.folded")  # input for flamegraph.pl / speedscope
+
+Phases are wall-clock timers around ingest, build, check, register, simulate
+and post-process. Variables are timed by wrapping the model's compiled
+equations, so a count is one actual evaluation (a memo miss), and time is
+split into inclusive time and self time (excluding the variables it called).
+BPTK may evaluate on several threads, in which case variable times can add
+up to more than the wall time of the simulate phase.
+"""
+import contextlib
+import json
+import threading
+import time
+from collections import defaultdict
+
+_profiler = None
+
+
+class Profiler:
+    def __init__(self):
+        self.phases = {}
+        self.variables = defaultdict(lambda: {"count": 0, "total_s": 0.0, "self_s": 0.0})
+        self.stacks = defaultdict(float)
+        self._open_phases = []
+        # BPTK evaluates scenarios on worker threads, so each thread keeps its own stack
+        self._local = threading.local()
+
+    def _state(self):
+        local = self._local
+        if not hasattr(local, "stack"):
+            # a worker thread starts inside whatever phase was open when it first evaluated
+            local.stack = list(self._open_phases)
+            local.child_time = [0.0] * len(local.stack)
+        return local.stack, local.child_time
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time a block of code as a named phase """
+        stack, child_time = self._state()
+        depth = len(stack)
+        stack.append(name)
+        child_time.append(0.0)
+        self._open_phases.append(name)
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - tic
+            self._record_stack(stack[:depth + 1], elapsed - child_time[depth])
+            del stack[depth:]
+            del child_time[depth:]
+            self._open_phases.pop()
+            if child_time:
+                child_time[-1] += elapsed
+            record = self.phases.setdefault(name, {"calls": 0, "total_s": 0.0})
+            record["calls"] += 1
+            record["total_s"] += elapsed
+
+    def instrument_model(self, model):
+        """ Wrap every compiled equation of the model with a counting timer """
+        for name, function in list(model.equations.items()):
+            if getattr(function, "_profiled", False):
+                continue
+            model.equations[name] = self._wrap(name, function)
+
+    def _wrap(self, name, function):
+        record = self.variables[name]
+
+        def wrapped(t):
+            stack, child_time = self._state()
+            depth = len(stack)
+            stack.append(name)
+            child_time.append(0.0)
+            tic = time.perf_counter()
+            finished = False
+            try:
+                result = function(t)
+                finished = True
+                return result
+            finally:
+                # no Python-level calls until the bookkeeping is consistent: this can run
+                # at the recursion limit, while BPTK unwinds a cold evaluation to retry it
+                # forward, and a RecursionError here would skip the rest of the block
+                elapsed = time.perf_counter() - tic
+                children = child_time[depth] if len(child_time) > depth else 0.0
+                del stack[depth + 1:]
+                path = stack[:]
+                del stack[depth:]
+                del child_time[depth:]
+                if child_time:
+                    child_time[-1] += elapsed
+                record["self_s"] += elapsed - children
+                if finished:
+                    record["count"] += 1
+                # recursive calls (a stock asking for its previous timestep) are already
+                # inside the outer call's time, only count the outermost one
+                if name not in stack:
+                    record["total_s"] += elapsed
+                try:
+                    self._record_stack(path, elapsed - children)
+                except RecursionError:
+                    pass
+        wrapped._profiled = True
+        return wrapped
+
+    def _record_stack(self, stack, self_time):
+        # fold recursion so that a stock reaching back through every timestep is one frame
+        frames = []
+        for frame in stack:
+            if frame in frames:
+                frames = frames[:frames.index(frame) + 1]
+            else:
+                frames.append(frame)
+        self.stacks[";".join(frames)] += self_time
+
+    def to_dict(self):
+        return {
+            "phases": self.phases,
+            "variables": dict(sorted(
+                self.variables.items(), key=lambda item: item[1]["self_s"], reverse=True
+            )),
+        }
+
+    def to_json(self, path=None):
+        """ Return profile as JSON string, and write it to path if given """
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, "w") as file:
+                file.write(text)
+        return text
+
+    def to_collapsed(self, path=None):
+        """ Return profile in collapsed-stack format (microseconds), write to path if given """
+        lines = [
+            f"{stack} {round(self_time * 1e6)}"
+            for stack, self_time in self.stacks.items() if self_time > 0
+        ]
+        text = "\n".join(sorted(lines)) + "\n"
+        if path is not None:
+            with open(path, "w") as file:
+                file.write(text)
+        return text
+
+    def report(self, top=20):
+        """ Human readable summary of phases and the most expensive variables """
+        lines = ["phase                          calls    total s"]
+        for name, record in self.phases.items():
+            lines.append(f"{name:30s} {record['calls']:5d} {record['total_s']:10.4f}")
+        lines.append("")
+        lines.append("variable                                          evals     self s    total s")
+        for name, record in list(self.to_dict()["variables"].items())[:top]:
+            lines.append(f"{name[:48]:48s} {record['count']:7d} "
+                         f"{record['self_s']:10.4f} {record['total_s']:10.4f}")
+        return "\n".join(lines)
+
+
+def enable_profiling():
+    """ Start recording, return the active profiler """
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable_profiling():
+    """ Stop recording, return the profiler that was active """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def phase(name):
+    """ Context manager timing a phase, does nothing unless profiling is enabled """
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.phase(name)
+
+
+def instrument(model):
+    """ Instrument the model's equations, does nothing unless profiling is enabled """
+    if _profiler is not None:
+        _profiler.instrument_model(model)
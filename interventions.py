@@ -0,0 +1,164 @@
+""" Time-indexed interventions applied to a built model
+
+Applying a schedule gives each variable it names (any stock, flow or
+converter of the model) an intervention term, a piecewise linear function
+of time read from model.points. Stocks get the term as an extra inflow,
+other variables have it added to their equation. Models are built without
+any terms, so runs without interventions do not pay for them, and a
+scenario model keeps its terms (cleared to zero) for the next schedule. An
+InterventionSchedule is compiled into those points per scenario, so any
+number of intervention scenarios run on one built model:
+
+    schedule = InterventionSchedule()
+    schedule.pulse("Retailer Stock", datetime(2020, 1, 1), 2e6, duration_in_days=7)   # aid distribution (kg)
+    schedule.step("Retailer Price", datetime(2020, 3, 1), 0.2)                         # price shock
+    schedule.ramp("Host Population Income", datetime(2020, 1, 1), datetime(2020, 6, 1), -0.1)
+    run_model(model_env, model, "aid", {}, start_date, stop_date, schedule=schedule)
+
+Values are added to the variable, in its units. For a stock they are added
+to its inflow (per day), except for pulse, where value is the total quantity
+delivered over the duration of the pulse. Converters that optimize_model
+inlined cannot be scheduled (build the model with them in keep).
+"""
+import bisect
+
+from general_functions import datetime_to_serial
+
+NO_INTERVENTION = [[0.0, 0.0]]
+# width of the jump at a step change, much smaller than any dt
+EPSILON = 1e-6
+
+
+def term_name(target):
+    return f"{target} Intervention"
+
+
+def evaluate_points(points, t):
+    """ Piecewise linear interpolation of [[t, value], ...], holding the end values """
+    if len(points) == 1 or t <= points[0][0]:
+        return points[0][1]
+    if t >= points[-1][0]:
+        return points[-1][1]
+    i = bisect.bisect_right(points, [t, float("inf")])
+    (t0, value0), (t1, value1) = points[i - 1], points[i]
+    return value0 + (value1 - value0) * (t - t0) / (t1 - t0)
+
+
+def schedule_function(points_name):
+    def schedule_value(model, t):
+        return evaluate_points(model.points[points_name], t)
+    return schedule_value
+
+
+def schedulable_variables(model):
+    """ Variables a schedule can change: the model's stocks, flows and converters, except intervention terms """
+    return [name for elements in [model.stocks, model.flows, model.converters] for name in elements
+            if not name.endswith(" Intervention")]
+
+
+def add_intervention_terms(model, targets):
+    """ Add an intervention term to each target that does not have one yet """
+    for target in targets:
+        name = term_name(target)
+        # model.points is shared with the base model and its other scenario models, the elements are not
+        if name in model.flows or name in model.converters:
+            continue
+        model.points[name] = NO_INTERVENTION
+        intervention = model.function(name, schedule_function(name))()
+        if target in model.stocks:
+            inflow = model.flow(name)
+            inflow.equation = intervention
+            model.stocks[target].equation += inflow
+        else:
+            term = model.converter(name)
+            term.equation = intervention
+            element = model.flows[target] if target in model.flows else model.converters[target]
+            element.equation += term
+
+
+def intervention_targets(model):
+    """ Variables that have an intervention term in model """
+    return [name[:-len(" Intervention")] for name in list(model.flows) + list(model.converters)
+            if name.endswith(" Intervention")]
+
+
+class InterventionSchedule:
+    """ List of step, pulse and ramp changes to named variables """
+
+    def __init__(self):
+        self.changes = []
+
+    def step(self, variable, date, value):
+        """ Add value to variable from date on """
+        self.changes.append({"variable": variable, "kind": "step", "start": date, "value": value})
+        return self
+
+    def pulse(self, variable, date, value, duration_in_days=1.0):
+        """ Add value to variable for duration_in_days from date (for stocks, value is the total quantity) """
+        self.changes.append({"variable": variable, "kind": "pulse", "start": date, "value": value,
+                             "duration": duration_in_days})
+        return self
+
+    def ramp(self, variable, start_date, stop_date, value):
+        """ Add an amount rising linearly from 0 at start_date to value at stop_date, then held """
+        self.changes.append({"variable": variable, "kind": "ramp", "start": start_date, "stop": stop_date,
+                             "value": value})
+        return self
+
+    def variables(self):
+        return sorted({change["variable"] for change in self.changes})
+
+    def compile(self, stock_names=()):
+        """ Lookup points of the intervention term of every scheduled variable """
+        compiled = {}
+        for variable in self.variables():
+            pieces = []
+            for change in self.changes:
+                if change["variable"] != variable:
+                    continue
+                start = datetime_to_serial(change["start"])
+                if change["kind"] == "step":
+                    pieces.append([(start - EPSILON, 0.0), (start, change["value"])])
+                elif change["kind"] == "pulse":
+                    stop = start + change["duration"]
+                    value = change["value"] / change["duration"] if variable in stock_names else change["value"]
+                    pieces.append([(start - EPSILON, 0.0), (start, value),
+                                   (stop - EPSILON, value), (stop, 0.0)])
+                else:
+                    pieces.append([(start, 0.0), (datetime_to_serial(change["stop"]), change["value"])])
+            # the sum of piecewise linear pieces is linear between their breakpoints
+            times = sorted({t for piece in pieces for t, _ in piece})
+            compiled[term_name(variable)] = [
+                [t, sum(evaluate_points([list(point) for point in piece], t) for piece in pieces)]
+                for t in times
+            ]
+        return compiled
+
+    def apply(self, model, inlined=()):
+        """ Set the intervention points of a (scenario) model, clearing variables not scheduled
+        inlined: converters that optimize_model inlined, which a schedule could no longer change
+        """
+        schedulable = set(schedulable_variables(model))
+        unknown = [variable for variable in self.variables() if variable not in schedulable]
+        if unknown:
+            raise ValueError(f"{unknown} are not stocks, flows or converters of the model")
+        inlined = [variable for variable in self.variables() if variable in set(inlined)]
+        if inlined:
+            raise ValueError(f"{inlined} were inlined by optimize_model, a schedule cannot change them: "
+                             f"build the model with them in keep")
+        add_intervention_terms(model, self.variables())
+        targets = intervention_targets(model)
+        compiled = self.compile(stock_names=list(model.stocks))
+        for target in targets:
+            model.points[term_name(target)] = compiled.get(term_name(target), NO_INTERVENTION)
+        model.reset_cache()
+        return model
+
+
+def apply_schedule(model, schedule=None, inlined=()):
+    """ Apply schedule to a scenario model, or clear its interventions if schedule is None
+    inlined: model.inlined_elements of the optimized model the scenario model was made from
+    """
+    if schedule is None:
+        schedule = InterventionSchedule()
+    return schedule.apply(model, inlined)
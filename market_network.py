@@ -0,0 +1,228 @@
+""" Supply chains over many markets as arrays
+
+set_model_logic builds one named BPTK variable per actor quantity, which does
+not scale to every monitored market. MarketNetwork holds the same actor
+logic as SupplyChainActor, with every quantity a vector over nodes (market x
+tier) and the links between nodes an adjacency matrix:
+
+    links[u, d] > 0  where node u sells to node d (weights are the share of d's
+                     purchases bought from u, normalised per buyer)
+
+Each step is a handful of array operations per tier level, over nodes and
+links. A single chain Trader -> Wholesaler -> Retailer with one consumer
+population reproduces the BPTK model (whose first reported step is already
+one Euler step past the initial values, so simulate from one step before
+its start to compare). With several suppliers, a buyer's demand is split by
+the link weights, a supplier fills all its buyers in proportion to their
+demand (as connect_to_consumers does), and the upstream price factor is the
+weighted mean of the suppliers' prices.
+
+    markets = vam_markets()
+    network = MarketNetwork.chains(markets["market"], cross_links=cross_links)
+    results = network.simulate(times, production, population=populations)
+    df = network.to_frame(results, "base", times)
+"""
+import numpy as np
+import pandas as pd
+
+from import_data import DATA_DIR
+from results import serials_to_datetime64
+
+NORTH_EAST_STATES = ["Adamawa", "Bauchi", "Borno", "Gombe", "Taraba", "Yobe"]
+TIERS = ["Trader", "Wholesaler", "Retailer"]
+OUTPUT_VARIABLES = {
+    "Stock": "{node} Stock",
+    "Cash": "{node} Cash",
+    "Supply": "{node} Supply",
+    "Price": "{node} Price",
+    "Total Demand": "Total Demand on {node}",
+    "Demand-to-Supply Ratio": "{node} Demand-to-Supply Ratio",
+    "Revenue": "{node} Revenue",
+    "Sold Volume": "{node} Sold Volume",
+    "Bought Volume": "{node} Bought Volume",
+    "Consumer Demand": "{node} Consumer Demand",
+}
+
+
+class MarketNetwork:
+    def __init__(self, node_names, links, leadtime=7.0, smoothing_time=7.0):
+        self.node_names = list(node_names)
+        n_nodes = len(self.node_names)
+        links = np.asarray(links, dtype="float64")
+        if links.shape != (n_nodes, n_nodes):
+            raise ValueError(f"links must be a ({n_nodes}, {n_nodes}) matrix, not {links.shape}")
+        bought_from = links.sum(axis=0)
+        # share of each buyer's purchases bought from each supplier
+        self.weights = np.divide(links, bought_from, out=np.zeros_like(links), where=bought_from > 0)
+        self.has_supplier = bought_from > 0
+        # links as edge arrays, so each step costs O(links) rather than O(nodes ** 2)
+        self.supplier, self.buyer = np.nonzero(links > 0)
+        self.edge_weight = self.weights[self.supplier, self.buyer]
+        self.leadtime = np.broadcast_to(np.asarray(leadtime, dtype="float64"), n_nodes).copy()
+        self.smoothing_time = smoothing_time
+        self.levels = self._levels(links > 0)
+        node_level = np.empty(n_nodes, dtype=int)
+        for i, level in enumerate(self.levels):
+            node_level[level] = i
+        # edges grouped by the level of their buyer
+        self.level_edges = [np.flatnonzero(node_level[self.buyer] == i) for i in range(len(self.levels))]
+
+    @staticmethod
+    def _levels(adjacency):
+        """ Node indices grouped by distance from the most downstream nodes (buyers before suppliers) """
+        n_nodes = len(adjacency)
+        level = np.zeros(n_nodes, dtype=int)
+        for _ in range(n_nodes):
+            # a supplier is one level above each of its buyers
+            above_buyers = np.where(adjacency, level[None, :] + 1, 0).max(axis=1)
+            if np.array_equal(above_buyers, level):
+                break
+            level = np.maximum(level, above_buyers)
+        else:
+            raise ValueError("links contain a cycle")
+        return [np.flatnonzero(level == i) for i in range(level.max() + 1)]
+
+    @classmethod
+    def chains(cls, markets, tiers=TIERS, cross_links=None, leadtime=7.0, smoothing_time=7.0):
+        """ One chain of tiers per market; cross_links[a, b] > 0 lets the second to last tier of
+        market a supply the last tier of market b (weight relative to b's own supplier, which is 1)
+        """
+        n_markets, n_tiers = len(markets), len(tiers)
+        names = [f"{market} {tier}" for market in markets for tier in tiers]
+        links = np.zeros((len(names), len(names)))
+        node = np.arange(len(names)).reshape(n_markets, n_tiers)
+        for tier in range(n_tiers - 1):
+            links[node[:, tier], node[:, tier + 1]] = 1.0
+        if cross_links is not None:
+            cross_links = np.asarray(cross_links, dtype="float64")
+            off_diagonal = ~np.eye(n_markets, dtype=bool)
+            links[np.ix_(node[:, -2], node[:, -1])] += np.where(off_diagonal, cross_links, 0.0)
+        return cls(names, links, leadtime, smoothing_time)
+
+    def _sum_over_edges(self, nodes, edge_values):
+        """ Sum of edge values per supplier or buyer node """
+        return np.bincount(nodes, weights=edge_values, minlength=len(self.node_names))
+
+    def _initial_supplier_price(self, smoothed_ratio):
+        """ Supplier prices at the start, where each smoothed supplier price starts at the supplier price """
+        price = smoothed_ratio.copy()
+        supplier_price = np.ones(len(price))
+        for level in reversed(self.levels):
+            weighted = self._sum_over_edges(self.buyer, self.edge_weight * price[self.supplier])
+            supplier_price[level] = np.where(self.has_supplier[level], weighted[level], 1.0)
+            price[level] = smoothed_ratio[level] * supplier_price[level]
+        return supplier_price
+
+    def needs_served(self, consumer_needs):
+        """ Consumer needs each node supplies, directly or through its buyers """
+        needs = np.array(consumer_needs, dtype="float64")
+        for level in self.levels[1:]:
+            passed_on = self._sum_over_edges(self.supplier, self.edge_weight * needs[self.buyer])
+            needs[level] = consumer_needs[level] + passed_on[level]
+        return needs
+
+    def node_index(self, names):
+        return np.array([self.node_names.index(name) for name in names])
+
+    def simulate(self, times, production, population=0.0, comm_needs=1.0, income=1.0,
+                 max_fraction_of_income=1.0, initial_stock=None, initial_cash=0.0,
+                 production_share=None, inflows=None):
+        """ Euler integration over times (serials, spacing dt)
+        production: (n_steps,) total production per day, split over the nodes without supplier by
+        production_share (equal by default), or (n_steps, n_nodes) per node
+        population, comm_needs, income, max_fraction_of_income: consumers buying from each node,
+        scalars or (n_nodes,) vectors (income may be (n_steps, n_nodes))
+        inflows: optional (n_steps, n_nodes) extra inflow per day, e.g. aid distributions
+        Returns a dict of (n_steps, n_nodes) arrays, keyed like OUTPUT_VARIABLES
+        """
+        times = np.asarray(times, dtype="float64")
+        n_steps, n_nodes = len(times), len(self.node_names)
+        dt = times[1] - times[0] if n_steps > 1 else 1.0
+
+        def per_node(value):
+            return np.broadcast_to(np.asarray(value, dtype="float64"), n_nodes)
+
+        population, comm_needs = per_node(population), per_node(comm_needs)
+        max_fraction_of_income = per_node(max_fraction_of_income)
+        income = np.broadcast_to(np.asarray(income, dtype="float64"), (n_steps, n_nodes))
+        production = np.asarray(production, dtype="float64")
+        if production.ndim == 1:
+            if production_share is None:
+                production_share = (~self.has_supplier) / (~self.has_supplier).sum()
+            production = production[:, None] * per_node(production_share)[None, :]
+        inflows = np.zeros((n_steps, n_nodes)) if inflows is None else np.asarray(inflows, dtype="float64")
+
+        # stocks: goods, cash, smoothed demand-to-supply ratio, smoothed supplier price
+        if initial_stock is None:
+            initial_stock = self.leadtime * self.needs_served(comm_needs * population)
+        stock = per_node(initial_stock).copy()
+        cash = per_node(initial_cash).copy()
+        smoothed_ratio = np.ones(n_nodes)
+        smoothed_supplier_price = self._initial_supplier_price(smoothed_ratio)
+
+        results = {key: np.empty((n_steps, n_nodes)) for key in OUTPUT_VARIABLES}
+        supplier, buyer, edge_weight = self.supplier, self.buyer, self.edge_weight
+        time_constant = self.smoothing_time
+        for step in range(n_steps):
+            supply = stock / self.leadtime
+            price = smoothed_ratio * np.where(self.has_supplier, smoothed_supplier_price, 1.0)
+
+            # demand and sales, from the most downstream level up
+            consumer_demand = population * np.minimum(
+                comm_needs, income[step] * max_fraction_of_income / price
+            )
+            edge_demand = np.zeros(len(supplier))  # demand of each buyer on each of its suppliers
+            total_demand = consumer_demand.copy()
+            fill_rate = np.zeros(n_nodes)
+            revenue = np.zeros(n_nodes)
+            for level, edges in zip(self.levels, self.level_edges):
+                total_demand[level] += self._sum_over_edges(supplier, edge_demand)[level]
+                sold = np.minimum(total_demand[level], supply[level])
+                fill_rate[level] = np.divide(sold, total_demand[level], out=np.zeros(len(level)),
+                                             where=total_demand[level] > 0)
+                revenue[level] = price[level] * sold
+                # buyers spend their revenue forecast (their revenue) on their suppliers
+                edge_demand[edges] = edge_weight[edges] * revenue[buyer[edges]] / price[supplier[edges]]
+
+            volume = fill_rate[supplier] * edge_demand
+            bought = self._sum_over_edges(buyer, volume)
+            sold = fill_rate * total_demand
+            paid = self._sum_over_edges(buyer, price[supplier] * volume)
+            supplier_price = self._sum_over_edges(buyer, edge_weight * price[supplier])
+
+            results["Stock"][step] = stock
+            results["Cash"][step] = cash
+            results["Supply"][step] = supply
+            results["Price"][step] = price
+            results["Total Demand"][step] = total_demand
+            results["Demand-to-Supply Ratio"][step] = total_demand / supply
+            results["Revenue"][step] = revenue
+            results["Sold Volume"][step] = sold
+            results["Bought Volume"][step] = bought
+            results["Consumer Demand"][step] = consumer_demand
+
+            # Euler step; flows are non-negative, so of the smoothing up and down flows only one is open
+            stock = stock + dt * (production[step] + inflows[step] + bought - sold)
+            cash = cash + dt * (revenue - paid)
+            smoothed_ratio = smoothed_ratio + dt * (total_demand / supply - smoothed_ratio) / time_constant
+            smoothed_supplier_price = smoothed_supplier_price + dt * (
+                supplier_price - smoothed_supplier_price) / time_constant
+        return results
+
+    def to_frame(self, results, scenario_name, times, variables=None):
+        """ Wide frame with run_model column names ("{node} Stock", ...) """
+        columns = {"t": np.asarray(times, dtype="float64")}
+        for key in variables or OUTPUT_VARIABLES:
+            for i, node in enumerate(self.node_names):
+                columns[OUTPUT_VARIABLES[key].format(node=node)] = results[key][:, i]
+        df = pd.DataFrame(columns)
+        df["Scenario"] = scenario_name
+        df["Date"] = serials_to_datetime64(df["t"])
+        return df
+
+
+def vam_markets(states=NORTH_EAST_STATES, data_dir=DATA_DIR):
+    """ Markets monitored in the WFP VAM price file, in the given states, with their coordinates """
+    df = pd.read_csv(f"{data_dir}/wfp_food_prices_nga.csv", skiprows=[1])
+    df = df[df["admin1"].str.startswith(tuple(states))]
+    return df.groupby("market", as_index=False)[["admin1", "latitude", "longitude"]].first()
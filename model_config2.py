@@ -1,6 +1,7 @@
+import numpy as np
+import pandas as pd
 from BPTK_Py import Model
 from BPTK_Py import sd_functions as sd
-from import_data import *
 from general_functions import *
 
 
@@ -59,6 +60,100 @@ class Consumer(ModelActor):
 
         self.initial_total_needs = self.model.constant(f"{name} Initial Total Needs")
         self.initial_total_needs.equation = comm_needs * population
+        self.total_needs = comm_needs * population
+
+    def connect_demand(self, price):
+        # per capita demand is limited by needs and by income
+        self.pc_demand.equation = sd.min(
+            self.comm_needs,
+            self.income * self.max_fraction_of_income / price
+        )
+
+
+class ConsumerCohorts(ModelActor):
+    """ N consumer cohorts (income deciles, host/IDP, LGAs) as one actor
+    Income, needs, fraction of income and population are vectors over cohorts, and the total
+    demand of all cohorts is one array operation per step instead of a set of variables per cohort.
+    The scalar "{name} Income" and the two scale constants multiply every cohort's value.
+    """
+
+    def __init__(
+            self,
+            model: Model,
+            name: str,
+            cohort_names: list,
+            max_fraction_of_income,
+            comm_needs,
+            income_baseline,
+            population
+    ):
+        super().__init__(model, name)
+        self.cohort_names = list(cohort_names)
+        n_cohorts = len(self.cohort_names)
+        self.cohort_max_fraction_of_income = np.broadcast_to(
+            np.asarray(max_fraction_of_income, dtype="float64"), n_cohorts).copy()
+        self.cohort_comm_needs = np.broadcast_to(np.asarray(comm_needs, dtype="float64"), n_cohorts).copy()
+        self.cohort_income = np.broadcast_to(np.asarray(income_baseline, dtype="float64"), n_cohorts).copy()
+        self.cohort_population = np.broadcast_to(np.asarray(population, dtype="float64"), n_cohorts).copy()
+
+        self.income = self.model.converter(f"{name} Income")
+        self.income.equation = 1.0
+        self.max_fraction_of_income = self.model.constant(f"{name} Max Fraction of Income Scale")
+        self.max_fraction_of_income.equation = 1.0
+        self.comm_needs = self.model.constant(f"{name} Commodity Needs Scale")
+        self.comm_needs.equation = 1.0
+        self.population = self.model.constant(f"{name} Population")
+        self.population.equation = float(self.cohort_population.sum())
+
+        self.demand = self.model.converter(f"{name} Total Demand")
+        self.total_needs = float(self.cohort_comm_needs @ self.cohort_population)
+        self.initial_total_needs = self.model.constant(f"{name} Initial Total Needs")
+        self.initial_total_needs.equation = self.total_needs
+
+    @classmethod
+    def from_frame(cls, model: Model, name: str, df):
+        """ Cohorts from a df with a row per cohort and columns cohort, population, income,
+        comm_needs and max_fraction_of_income
+        """
+        return cls(model, name, df["cohort"], df["max_fraction_of_income"], df["comm_needs"],
+                   df["income"], df["population"])
+
+    def cohort_demand(self, price, income=1.0, needs_scale=1.0, fraction_scale=1.0):
+        """ Per capita demand of every cohort, for scalar or (n_steps, 1) column arguments """
+        return np.minimum(
+            needs_scale * self.cohort_comm_needs,
+            income * self.cohort_income * fraction_scale * self.cohort_max_fraction_of_income / price
+        )
+
+    def connect_demand(self, price):
+        def total_demand(model, t, price, income, needs_scale, fraction_scale):
+            return float(self.cohort_demand(price, income, needs_scale, fraction_scale) @ self.cohort_population)
+
+        demand = self.model.function(f"{self.name} Cohort Demand", total_demand)
+        self.demand.equation = demand(price, self.income, self.comm_needs, self.max_fraction_of_income)
+
+    def cohort_frame(self, df, constants=None, supplier_name="Retailer"):
+        """ Per cohort demand and received volume over time, from a run_model df and its constants """
+        constants = constants or {}
+        price = df[f"{supplier_name} Price"].to_numpy()[:, None]
+        income = df[f"{self.name} Income"].to_numpy()[:, None]
+        fill_rate = df[f"{supplier_name} to Consumer Fill Rate"].to_numpy()[:, None]
+        demand = self.cohort_demand(
+            price, income,
+            constants.get(f"{self.name} Commodity Needs Scale", 1.0),
+            constants.get(f"{self.name} Max Fraction of Income Scale", 1.0)
+        ) * self.cohort_population
+        return pd.DataFrame({
+            "Date": np.repeat(df["Date"].to_numpy(), len(self.cohort_names)),
+            "Cohort": np.tile(self.cohort_names, len(df)),
+            "Demand": demand.ravel(),
+            "Received Volume": (fill_rate * demand).ravel(),
+        })
+
+
+def cohort_results(cohorts, df, constants=None, name="Host Population", supplier_name="Retailer"):
+    """ Per cohort demand and received volume of a run of a model built with cohorts """
+    return ConsumerCohorts.from_frame(Model(), name, cohorts).cohort_frame(df, constants, supplier_name)
 
 
 class SupplyChainActor(ModelActor):
@@ -66,9 +161,11 @@ class SupplyChainActor(ModelActor):
             self,
             model: Model,
             name: str,
-            leadtime: float = 7.0
+            leadtime: float = 7.0,
+            smoothing_time: float = 7.0
     ):
         super().__init__(model, name)
+        self.smoothing_time = smoothing_time
 
         zero_flow = model.flow("Zero Flow")
         zero_flow.equation = 0.0
@@ -102,7 +199,7 @@ class SupplyChainActor(ModelActor):
             smooth_model_variable(
                 model,
                 self.d2s_ratio,
-                7.0,
+                smoothing_time,
                 1.0
             )
         )
@@ -122,7 +219,7 @@ class SupplyChainActor(ModelActor):
         downstream_actor.price.equation *= smooth_model_variable(
             self.model,
             self.price,
-            7.0,
+            downstream_actor.smoothing_time,
             self.price
         )
 
@@ -136,11 +233,7 @@ class SupplyChainActor(ModelActor):
     def connect_to_consumers(self, consumers: list[ModelActor]):
         # demand
         for consumer in consumers:
-            # per capita consumer demand
-            consumer.pc_demand.equation = sd.min(
-                consumer.comm_needs,
-                consumer.income * consumer.max_fraction_of_income / self.price
-            )
+            consumer.connect_demand(self.price)
             # total consumer demand
             self.total_demand_on_actor.equation += consumer.demand
 
@@ -165,10 +258,24 @@ class SupplyChainActor(ModelActor):
             self.revenue.equation += cashflow
 
 
-def set_model_logic(start_serial, stop_serial, df):
-    """ Setup model based on start date, end date, and df containing input data """
+DEFAULT_PARAMETERS = {
+    "population": 5000000,
+    "comm_needs": 1.0,
+    "trader_leadtime": 7.0,
+    "wholesaler_leadtime": 7.0,
+    "retailer_leadtime": 7.0,
+    "smoothing_time": 7.0,
+}
+
 
-    time_step_in_days = 1.0
+def set_model_logic(start_serial, stop_serial, df, time_step_in_days=1.0, input_grid=None, cohorts=None,
+                    parameters=None):
+    """ Setup model based on start date, end date, and df containing input data
+    (data variables read from input_grid instead of df if it is given)
+    cohorts is an optional df of consumer cohorts (see ConsumerCohorts.from_frame)
+    that replaces the single host population consumer
+    parameters overrides values of DEFAULT_PARAMETERS, which are fixed when the model is built
+    """
 
     model = Model(
         starttime=start_serial,
@@ -177,26 +284,30 @@ def set_model_logic(start_serial, stop_serial, df):
     )
 
     # set parameters
-    population = 5000000
-    comm_needs = 1.0
-    leadtime = 7.0
+    parameters = {**DEFAULT_PARAMETERS, **(parameters or {})}
+    population = parameters["population"]
+    comm_needs = parameters["comm_needs"]
+    smoothing_time = parameters["smoothing_time"]
 
     # create actors
-    trader = SupplyChainActor(model, "Trader", leadtime=leadtime)
-    wholesaler = SupplyChainActor(model, "Wholesaler", leadtime=leadtime)
-    retailer = SupplyChainActor(model, "Retailer", leadtime=leadtime)
-    host_population = Consumer(
-        model,
-        "Host Population",
-        population=population,
-        comm_needs=comm_needs
-    )
+    trader = SupplyChainActor(model, "Trader", parameters["trader_leadtime"], smoothing_time)
+    wholesaler = SupplyChainActor(model, "Wholesaler", parameters["wholesaler_leadtime"], smoothing_time)
+    retailer = SupplyChainActor(model, "Retailer", parameters["retailer_leadtime"], smoothing_time)
+    if cohorts is None:
+        host_population = Consumer(
+            model,
+            "Host Population",
+            population=population,
+            comm_needs=comm_needs
+        )
+    else:
+        host_population = ConsumerCohorts.from_frame(model, "Host Population", cohorts)
     consumers = [
         host_population
     ]
 
     # connect to data
-    data_prod_usda = create_model_data_variable(model, df, "Production (USDA)")
+    data_prod_usda = create_model_data_variable(model, df, "Production (USDA)", input_grid)
     production = model.flow("Production")
     production.equation = data_prod_usda
     trader.stock.equation += production
@@ -207,9 +318,10 @@ def set_model_logic(start_serial, stop_serial, df):
     retailer.connect_to_consumers(consumers)
 
     # set parameters
-    trader.stock.initial_value = leadtime * comm_needs * population
-    wholesaler.stock.initial_value = leadtime * comm_needs * population
-    retailer.stock.initial_value = leadtime * comm_needs * population
+    total_needs = sum(consumer.total_needs for consumer in consumers)
+    trader.stock.initial_value = parameters["trader_leadtime"] * total_needs
+    wholesaler.stock.initial_value = parameters["wholesaler_leadtime"] * total_needs
+    retailer.stock.initial_value = parameters["retailer_leadtime"] * total_needs
 
     return model
 
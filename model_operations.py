@@ -1,12 +1,43 @@
 import BPTK_Py
+import hashlib
 from model_config2 import set_model_logic
 from datetime import datetime
+from equation_optimizer import SHARED_PREFIX, optimize_model
 from general_functions import *
+from input_grid import build_input_grid
+from instrumentation import phase, instrument
+from interventions import apply_schedule
+from results import compact_results
+from steady_state import initialize_steady_state, input_means
+from stepping import simulate_stepwise
 
 
-def setup_model(start_date, end_date, df, checking=False):
+def setup_model(start_date, end_date, df, checking=False, time_step_in_days=1.0, input_grid=True,
+                cohorts=None, parameters=None, optimize=False, keep=(), steady_state=False):
+    """ Build and register the model
+    input_grid: True to align the input data onto the time grid once (see input_grid.py),
+    an InputGrid to reuse, or False to look the data up in df at every evaluation
+    cohorts: optional df of consumer cohorts (see ConsumerCohorts in model_config2.py)
+    parameters: build-time parameters (see DEFAULT_PARAMETERS in model_config2.py)
+    optimize: simplify the equations once built (see equation_optimizer.py); constants are left as they are,
+    but converters whose equation is a number are inlined unless named in keep, so scenarios can no longer set them
+    steady_state: start the stocks at their steady state instead of the hand-set values (see steady_state.py),
+    with the inputs held at their mean over the year before start_date; without a steady state the hand-set
+    values are kept (with a warning), or with steady_state="best" the best state the solver reached is used
+    """
     start_serial, end_serial = datetime_to_serial([start_date, end_date])
-    model = set_model_logic(start_serial, end_serial, df)
+    with phase("align"):
+        if input_grid is True:
+            input_grid = build_input_grid(df, start_serial, end_serial, time_step_in_days)
+    with phase("build"):
+        model = set_model_logic(start_serial, end_serial, df, time_step_in_days, input_grid or None,
+                                cohorts, parameters)
+        if optimize:
+            optimize_model(model, keep=keep)
+    if steady_state:
+        with phase("initialize"):
+            initialize_steady_state(model, input_means(df, start_serial, time_step_in_days=time_step_in_days),
+                                    apply_unconverged=steady_state == "best")
     if checking:
         print("checking constants . . . ")
         for variable in model.constants:
@@ -44,25 +75,84 @@ def setup_model(start_date, end_date, df, checking=False):
             if not isinstance(model.evaluate_equation(variable, start_serial+10), float):
                 print(f"The variable '{variable}' has an equation "
                       "but it does not evaluate past 10 iterations!")
-    model_env = BPTK_Py.bptk()
-    model_env.register_model(model)
-    scenario_manager = {
-        "scenario_manager": {
-            "model": model
+    with phase("register"):
+        model_env = BPTK_Py.bptk()
+        model_env.register_model(model)
+        scenario_manager = {
+            "scenario_manager": {
+                "model": model
+            }
         }
-    }
-    model_env.register_scenario_manager(scenario_manager)
+        model_env.register_scenario_manager(scenario_manager)
     return model_env, model
 
 
-def run_model(model_env, model, scenario_name, constants, start_date, stop_date):
-    """ Run model with constants and dates, output df of results """
+def run_model(model_env, model, scenario_name, constants, start_date, stop_date, output_options=None,
+              engine="bptk", schedule=None, guardrails=None):
+    """ Run model with constants and dates, output df of results
+    output_options (dict of compact_results arguments) selects dtypes and layout of the df
+    engine "bptk" runs plot_scenarios, "stepping" advances the model step by step
+    (no recursion limit on long horizons, see stepping.py)
+    schedule is an InterventionSchedule of time-varying changes (see interventions.py)
+    guardrails checks every step of a stepping run for diverging values (see guardrails.py)
+    """
+    if engine not in ["bptk", "stepping"]:
+        raise ValueError(f"engine must be 'bptk' or 'stepping', not {engine!r}")
+    if guardrails is not None and engine != "stepping":
+        raise ValueError("guardrails need the stepping engine")
 
     # set dates
     model.starttime = datetime_to_serial(start_date)
     model.stoptime = datetime_to_serial(stop_date)
 
     # register scenario
+    with phase("register"):
+        if engine == "stepping":
+            scenario_model = prepare_scenario_model(
+                model_env, model, scenario_name, constants, start_date, stop_date
+            )
+        else:
+            register_scenario(model_env, scenario_name, constants, model)
+            scenario_model = get_scenario_model(model_env, scenario_name)
+        apply_schedule(scenario_model, schedule, getattr(model, "inlined_elements", ()))
+        instrument(scenario_model)
+
+    # choose variables to output
+    output_variables = output_variable_names(model)
+
+    # run model
+    if engine == "stepping":
+        times, values = simulate_stepwise(scenario_model, output_variables, guardrails=guardrails)
+        df = pd.DataFrame(values, columns=output_variables)
+        df.insert(0, "t", times)
+    else:
+        with phase("simulate"):
+            df = model_env.plot_scenarios(
+                scenarios=scenario_name,
+                scenario_managers="scenario_manager",
+                equations=output_variables,
+                return_df=True
+            ).reset_index()
+
+    # clean up df
+    with phase("post-process"):
+        df["Scenario"] = scenario_name
+        df["Date"] = serial_to_datetime(df["t"])
+        df["t_check"] = datetime_to_serial(df["Date"])
+        if output_options is not None:
+            df = compact_results(df, **output_options)
+    return df
+
+
+def register_scenario(model_env, scenario_name, constants, model=None):
+    """ Register scenario with constants in the model's scenario manager
+    Raises ValueError for constants naming elements that optimize_model inlined in model,
+    which the scenario could no longer change
+    """
+    inlined = sorted(set(constants) & getattr(model, "inlined_elements", set()))
+    if inlined:
+        raise ValueError(f"{inlined} were inlined by optimize_model, a scenario cannot set them: "
+                         f"build the model with them in keep")
     model_env.register_scenarios(
         scenarios={
             scenario_name: {
@@ -72,31 +162,52 @@ def run_model(model_env, model, scenario_name, constants, start_date, stop_date)
         scenario_manager="scenario_manager"
     )
 
-    # choose variables to output
+
+def output_variable_names(model):
+    """ Names of the variables included in model results """
     output_variables = [str(var) for var in model.stocks] \
         + [str(var) for var in model.flows] \
         + [str(var) for var in model.converters] \
         # + [str(var) for var in model.constants]
-    excluded_strings = ["bptk", "SMOOTH", "Zero Flow"]
+    excluded_strings = ["bptk", "SMOOTH", "Zero Flow", "Intervention", SHARED_PREFIX]
     for excluded_string in excluded_strings:
         output_variables = [
             variable for variable in output_variables if not excluded_string in variable
         ]
+    return output_variables
 
-    # run model
-    df = model_env.plot_scenarios(
-        scenarios=scenario_name,
-        scenario_managers="scenario_manager",
-        equations=output_variables,
-        return_df=True
-    ).reset_index()
 
-    # clean up df
-    df["Scenario"] = scenario_name
-    df["Date"] = serial_to_datetime(df["t"])
-    df["t_check"] = datetime_to_serial(df["Date"])
-    return df
+def get_scenario_model(model_env, scenario_name):
+    """ Model instance that BPTK simulates for a registered scenario (a copy of the base model) """
+    scenario = model_env.get_scenario("scenario_manager", scenario_name)
+    return getattr(scenario, "model", scenario)
 
 
+def prepare_scenario_model(model_env, model, scenario_name, constants, start_date, stop_date):
+    """ Register scenario and return its model, with dates set and constants applied,
+    ready to be evaluated step by step outside of plot_scenarios
+    """
+    model.starttime = datetime_to_serial(start_date)
+    model.stoptime = datetime_to_serial(stop_date)
+    register_scenario(model_env, scenario_name, constants, model)
+    scenario = model_env.get_scenario("scenario_manager", scenario_name)
+    scenario_model = getattr(scenario, "model", scenario)
+    scenario_model.starttime = model.starttime
+    scenario_model.stoptime = model.stoptime
+    scenario_model.dt = model.dt
+    # BPTK only applies scenario constants when plot_scenarios runs
+    if hasattr(scenario, "setup_constants"):
+        scenario.constants.update(constants)
+        scenario.setup_constants()
+    scenario_model.reset_cache()
+    return scenario_model
 
 
+def model_hash(model):
+    """ Short hash of the model structure (element names and equations), ignoring input data """
+    digest = hashlib.sha1()
+    for elements in [model.stocks, model.flows, model.converters, model.constants]:
+        for name in sorted(elements):
+            digest.update(name.encode())
+            digest.update(str(elements[name].function_string).encode())
+    return digest.hexdigest()[:12]
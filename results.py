@@ -0,0 +1,104 @@
+""" Compact, typed result frames
+
+run_model returns a wide frame with float64 values, object dtype scenario
+labels and a t_check debug column. compact_results converts such a frame to
+smaller dtypes and, optionally, to long layout:
+
+    df = run_model(model_env, model, "A", constants, start_date, stop_date,
+                   output_options={"dtype": "float32", "layout": "long"})
+    print(memory_report(df))
+
+output_options are keyword arguments of compact_results; an empty dict gives
+the compact defaults (float32, categorical scenario, datetime64 dates, no
+debug columns, wide layout).
+"""
+import numpy as np
+import pandas as pd
+
+ID_COLUMNS = ["Scenario", "Date", "t"]
+DEBUG_COLUMNS = ["t_check"]
+
+
+def serials_to_datetime64(serials):
+    """ Vectorized equivalent of serial_to_datetime, returns datetime64 values """
+    seconds = (np.asarray(serials, dtype="float64") - 25569.0) * 86400.0
+    # float serials carry sub-millisecond noise, which serial_to_datetime also does not keep
+    return pd.to_datetime(seconds, unit="s").round("ms")
+
+
+def compact_results(df, dtype="float32", categorical_scenario=True, datetime_dates=True,
+                    drop_debug=True, layout="wide"):
+    """ Convert a run_model frame to compact dtypes, in wide or long layout """
+    if layout not in ["wide", "long"]:
+        raise ValueError(f"layout must be 'wide' or 'long', not {layout!r}")
+    df = df.copy()
+    if drop_debug:
+        df = df.drop(columns=[column for column in DEBUG_COLUMNS if column in df.columns])
+    if datetime_dates and "Date" in df.columns:
+        df["Date"] = serials_to_datetime64(df["t"]) if "t" in df.columns else pd.to_datetime(df["Date"])
+    if categorical_scenario and "Scenario" in df.columns:
+        df["Scenario"] = df["Scenario"].astype("category")
+    value_columns = [column for column in df.columns if column not in ID_COLUMNS + DEBUG_COLUMNS]
+    df[value_columns] = df[value_columns].astype(dtype)
+    if layout == "long":
+        df = to_long(df)
+    return df
+
+
+def to_long(df):
+    """ Wide frame (one column per variable) to long frame (Variable, Value) """
+    id_columns = [column for column in ID_COLUMNS + DEBUG_COLUMNS if column in df.columns]
+    value_columns = [column for column in df.columns if column not in id_columns]
+    values = df[value_columns].to_numpy()
+    long_df = pd.DataFrame({
+        column: np.repeat(df[column].to_numpy(), len(value_columns)) for column in id_columns
+    })
+    long_df["Variable"] = pd.Categorical.from_codes(
+        np.tile(np.arange(len(value_columns)), len(df)), categories=value_columns
+    )
+    long_df["Value"] = values.ravel()
+    if "Scenario" in id_columns and isinstance(df["Scenario"].dtype, pd.CategoricalDtype):
+        long_df["Scenario"] = pd.Categorical(long_df["Scenario"], categories=df["Scenario"].cat.categories)
+    return long_df
+
+
+def to_wide(long_df):
+    """ Long frame back to wide frame """
+    id_columns = [column for column in ID_COLUMNS + DEBUG_COLUMNS if column in long_df.columns]
+    df = long_df.pivot(index=id_columns, columns="Variable", values="Value")
+    df.columns = list(df.columns)
+    return df.reset_index()
+
+
+def concat_results(frames):
+    """ Concatenate result frames, keeping categorical columns categorical """
+    frames = [frame for frame in frames if frame is not None and len(frame)]
+    if not frames:
+        return pd.DataFrame()
+    for column in ["Scenario", "Variable"]:
+        if all(column in frame.columns and isinstance(frame[column].dtype, pd.CategoricalDtype)
+               for frame in frames):
+            categories = pd.api.types.union_categoricals(
+                [frame[column] for frame in frames], ignore_order=True
+            ).categories
+            frames = [
+                frame.assign(**{column: frame[column].cat.set_categories(categories)})
+                for frame in frames
+            ]
+    return pd.concat(frames, ignore_index=True)
+
+
+def memory_report(df):
+    """ Memory used by a result frame, in total and by dtype """
+    usage = df.memory_usage(deep=True, index=True)
+    by_dtype = {}
+    for column, n_bytes in usage.items():
+        dtype = "index" if column == "Index" else str(df[column].dtype)
+        by_dtype[dtype] = by_dtype.get(dtype, 0) + int(n_bytes)
+    return {
+        "rows": len(df),
+        "columns": len(df.columns),
+        "bytes": int(usage.sum()),
+        "megabytes": round(float(usage.sum()) / 2 ** 20, 3),
+        "by_dtype": by_dtype,
+    }
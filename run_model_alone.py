@@ -5,11 +5,8 @@ import plotly.graph_objects as go
 from model_operations import *
 from datetime import datetime
 from import_data import *
-import sys
 import time
 
-#sys.setrecursionlimit(10**6)
-
 # read data into df
 tic = time.time()
 df_input = import_all_data()
@@ -26,7 +23,7 @@ print(f"setup took {round(toc - tic, 3)}s")
 # run base scenario
 tic = time.time()
 df = pd.DataFrame
-df = run_model(model_env, model, "base", {}, start_date, stop_date)
+df = run_model(model_env, model, "base", {}, start_date, stop_date, engine="stepping")
 toc = time.time()
 print(f"run took {round(toc - tic, 3)}s")
 df = df.drop(columns=["Scenario", "t", "t_check"]).set_index("Date")
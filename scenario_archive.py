@@ -0,0 +1,362 @@
+""" On-disk scenario archive with per-variable random access
+
+Every scenario run is stored as one .npy array per variable, next to the
+array of serial times, and opened memory-mapped on read. Slicing one
+variable over a date range therefore only touches those bytes on disk.
+A run on the same time grid, model and input data as a run already archived
+in full (its baseline) only stores the variables that differ from the
+baseline's, as compressed XOR deltas (see delta_store.py): scenarios change
+a few constants, so most variables are not stored at all and the rest
+compress well. A delta variable is decompressed whole when read.
+index.json holds the metadata of every scenario (constants, date range, dt,
+model hash, input data version, variables), so the library can be searched
+without opening any arrays.
+
+    archive = ScenarioArchive("archive")
+    scenario_id = archive.add(df, "A", constants, model_hash(model), input_version=grid_version(grid))
+    archive.scenarios(model_hash=model_hash(model))
+    archive.read(scenario_id, "Retailer Price", datetime(2019, 1, 1), datetime(2020, 1, 1))
+
+Results can also be streamed straight into the archive with ArchiveSink:
+
+    sink = archive.sink("base", {}, model_hash(model), start_date, stop_date, model.dt, variables)
+    stream_model(model_env, model, "base", {}, start_date, stop_date, sink)
+    sink.close()
+
+A run is archived under scenario_key of its scenario, constants, model hash,
+input data version (see input_store.grid_version) and requested date range,
+whether it was added or streamed, so lookup finds it again before the same
+scenario is run twice, and never once the inputs have been refreshed. With
+SCENARIO_ARCHIVE set, app.py archives the dashboard's runs this way, and its
+chart reads back only the plotted variable.
+
+Several processes can share an archive. A run is written into a directory of
+its own and only registered once complete, and the index is re-read and
+rewritten under a file lock, so concurrent writers never see each other's
+half-written arrays or drop each other's runs. Arrays replaced by a newer
+run stay readable by the processes that had them open.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from delta_store import value_bits, compress_bits, decompress_bits
+from general_functions import datetime_to_serial
+from results import ID_COLUMNS, DEBUG_COLUMNS, serials_to_datetime64
+
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+
+
+def scenario_key(scenario_name, constants, model_hash, start_serial, stop_serial, input_version=None):
+    """ Deterministic id for a scenario run, so re-archiving the same run replaces it
+    start_serial, stop_serial: serial times of the requested start and stop dates, not of the run's
+    first and last steps (the number of steps depends on the engine)
+    input_version: version of the input data the run used, model_hash ignores the data
+    """
+    text = json.dumps([scenario_name, constants or {}, model_hash, input_version,
+                       round(float(start_serial), 6), round(float(stop_serial), 6)],
+                      sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class ScenarioArchive:
+    def __init__(self, path, deltas=True):
+        """ deltas: store runs as deltas against a baseline run where one is archived, False to store them in full """
+        self.path = path
+        self.deltas = deltas
+        os.makedirs(path, exist_ok=True)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path) as file:
+            return json.load(file)
+
+    def _write_index(self):
+        # write then rename, so readers never see a half written index
+        index_path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.index, file, indent=1)
+        os.replace(tmp_path, index_path)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """ Latest index, under an exclusive lock between processes, written back on exit """
+        with open(os.path.join(self.path, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.index = self._read_index()
+                yield self.index
+                self._write_index()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _array_path(self, scenario_id, file_name):
+        # runs archived before runs had their own directories are in the directory named by their id
+        return os.path.join(self.path, self._metadata(scenario_id).get("directory", scenario_id), file_name)
+
+    def add(self, df, scenario_name, constants=None, model_hash=None, scenario_id=None,
+            start_date=None, stop_date=None, input_version=None):
+        """ Archive a wide run_model frame, return its scenario id
+        start_date, stop_date: dates the run was made for, by default those of its first and last step
+        """
+        value_columns = [column for column in df.columns if column not in ID_COLUMNS + DEBUG_COLUMNS]
+        times = df["t"].to_numpy(dtype="float64")
+        writer = self.sink(
+            scenario_name, constants, model_hash,
+            serials_to_datetime64(times[:1])[0] if start_date is None else start_date,
+            serials_to_datetime64(times[-1:])[0] if stop_date is None else stop_date,
+            float(times[1] - times[0]) if len(times) > 1 else 1.0,
+            value_columns, n_steps=len(times), scenario_id=scenario_id,
+            dtypes={column: df[column].dtype for column in value_columns}, input_version=input_version
+        )
+        writer(df)
+        writer.close()
+        return writer.scenario_id
+
+    def sink(self, scenario_name, constants, model_hash, start_date, stop_date, dt, variables,
+             n_steps=None, scenario_id=None, dtypes=None, input_version=None):
+        """ Writer that can be passed to stream_model as its sink
+        input_version: version of the input data of the run (see input_store.grid_version)
+        """
+        constants = constants or {}
+        start_serial, stop_serial = datetime_to_serial([start_date, stop_date])
+        if scenario_id is None:
+            scenario_id = scenario_key(scenario_name, constants, model_hash, start_serial, stop_serial,
+                                       input_version)
+        if n_steps is None:
+            n_steps = int(round((stop_serial - start_serial) / dt)) + 1
+        return ArchiveSink(self, scenario_id, {
+            "scenario": scenario_name,
+            "constants": constants,
+            "model_hash": model_hash,
+            "input_version": input_version,
+            "start_date": pd.Timestamp(start_date).isoformat(),
+            "stop_date": pd.Timestamp(stop_date).isoformat(),
+            "dt": dt,
+            "n_steps": n_steps,
+            "variables": {variable: f"v{i:05d}.npy" for i, variable in enumerate(variables)},
+            "created": datetime.now().isoformat(timespec="seconds"),
+        }, dtypes or {})
+
+    def _register(self, scenario_id, metadata, tmp_path):
+        """ Make a run completely written in tmp_path visible, replacing any earlier run of the same id """
+        with self._locked_index() as index:
+            # under the lock, so the baseline cannot be replaced while the run is encoded against it
+            if self.deltas:
+                self._encode_deltas(index, scenario_id, metadata, tmp_path)
+            os.rename(tmp_path, os.path.join(self.path, metadata["directory"]))
+            replaced = index.get(scenario_id)
+            index[scenario_id] = metadata
+            if replaced is not None:
+                self._remove_unreferenced(index, replaced)
+
+    def _remove_unreferenced(self, index, metadata):
+        """ Remove the directories of a run that has left the index, unless runs still use them as baseline
+        Processes that have the removed arrays mapped keep reading them
+        """
+        referenced = {other.get("directory", other_id) for other_id, other in index.items()} \
+            | {other["baseline_directory"] for other in index.values() if "baseline_directory" in other}
+        for directory in [metadata.get("directory"), metadata.get("baseline_directory")]:
+            if directory is not None and directory not in referenced:
+                shutil.rmtree(os.path.join(self.path, directory), ignore_errors=True)
+
+    def _find_baseline(self, index, scenario_id, metadata, times):
+        """ Id and metadata of a run archived in full on the same time grid, model and input data, or None """
+        for baseline_id, baseline in index.items():
+            if (baseline_id == scenario_id or "baseline_directory" in baseline
+                    or any(baseline.get(key) != metadata[key] for key in ["model_hash", "input_version", "n_steps"])):
+                continue
+            path = os.path.join(self.path, baseline.get("directory", baseline_id), "t.npy")
+            if np.array_equal(np.load(path, mmap_mode="r")[:len(times)], times):
+                return baseline_id, baseline
+        return None
+
+    def _encode_deltas(self, index, scenario_id, metadata, tmp_path):
+        """ Replace the arrays in tmp_path that a baseline run makes redundant by deltas against it """
+        n_steps = metadata["n_steps"]
+        times = np.load(os.path.join(tmp_path, "t.npy"))[:n_steps]
+        found = self._find_baseline(index, scenario_id, metadata, times)
+        if found is None:
+            return
+        baseline_id, baseline = found
+        baseline_directory = baseline.get("directory", baseline_id)
+        base_files = {}
+        for variable, file_name in metadata["variables"].items():
+            if variable not in baseline["variables"]:
+                continue
+            base_file = f"{baseline_directory}/{baseline['variables'][variable]}"
+            values = np.load(os.path.join(tmp_path, file_name))[:n_steps]
+            base = np.load(os.path.join(self.path, base_file), mmap_mode="r")[:n_steps]
+            if values.dtype != base.dtype:
+                continue
+            difference = value_bits(values) ^ value_bits(base)
+            delta_file = None
+            if difference.any():
+                blob = compress_bits(difference)
+                if len(blob) >= values.nbytes:
+                    continue
+                delta_file = file_name.replace(".npy", ".xor")
+                with open(os.path.join(tmp_path, delta_file), "wb") as file:
+                    file.write(blob)
+            os.remove(os.path.join(tmp_path, file_name))
+            metadata["variables"][variable] = delta_file
+            base_files[variable] = base_file
+        if base_files:
+            metadata.update(baseline=baseline_id, baseline_directory=baseline_directory, base_files=base_files)
+
+    def lookup(self, scenario_name, constants, model_hash, start_date, stop_date, input_version=None):
+        """ Id of the archived run of a scenario on that input data, None if it has not been archived """
+        start_serial, stop_serial = datetime_to_serial([start_date, stop_date])
+        scenario_id = scenario_key(scenario_name, constants, model_hash, start_serial, stop_serial, input_version)
+        try:
+            metadata = self._metadata(scenario_id)
+        except KeyError:
+            return None
+        if metadata.get("input_version") != input_version:
+            return None
+        return scenario_id
+
+    def _metadata(self, scenario_id):
+        if scenario_id not in self.index:
+            # archived by another process since the index was read
+            self.index = self._read_index()
+        return self.index[scenario_id]
+
+    def scenarios(self, **filters):
+        """ DataFrame of archived scenarios, optionally filtered on metadata values """
+        rows = []
+        for scenario_id, metadata in self.index.items():
+            if all(metadata.get(key) == value for key, value in filters.items()):
+                rows.append({"scenario_id": scenario_id, **{
+                    key: value for key, value in metadata.items() if key not in ["variables", "base_files"]
+                }})
+        return pd.DataFrame(rows)
+
+    def variables(self, scenario_id):
+        return list(self._metadata(scenario_id)["variables"])
+
+    def _open(self, scenario_id, file_name):
+        try:
+            return np.load(self._array_path(scenario_id, file_name), mmap_mode="r")
+        except FileNotFoundError:
+            # replaced by another process since the index was read
+            self.index = self._read_index()
+            return np.load(self._array_path(scenario_id, file_name), mmap_mode="r")
+
+    def _date_slice(self, scenario_id, start_date, stop_date):
+        times = self._open(scenario_id, "t.npy")[:self._metadata(scenario_id)["n_steps"]]
+        start = 0 if start_date is None else np.searchsorted(times, datetime_to_serial(start_date) - 1e-6)
+        stop = len(times) if stop_date is None else np.searchsorted(
+            times, datetime_to_serial(stop_date) + 1e-6, side="right")
+        return times, slice(start, stop)
+
+    def _read_values(self, scenario_id, variable):
+        metadata = self._metadata(scenario_id)
+        file_name = metadata["variables"][variable]
+        base_file = metadata.get("base_files", {}).get(variable)
+        if base_file is None:
+            return np.load(self._array_path(scenario_id, file_name), mmap_mode="r")
+        base = np.load(os.path.join(self.path, base_file), mmap_mode="r")[:metadata["n_steps"]]
+        if file_name is None:
+            # the same as the baseline's
+            return base
+        with open(self._array_path(scenario_id, file_name), "rb") as file:
+            difference = decompress_bits(file.read(), value_bits(base).dtype, metadata["n_steps"])
+        return (difference ^ value_bits(base)).view(base.dtype)
+
+    def _values(self, scenario_id, variable):
+        """ Array of one variable of a scenario, memory-mapped unless it is stored as a delta """
+        try:
+            return self._read_values(scenario_id, variable)
+        except FileNotFoundError:
+            # replaced by another process since the index was read
+            self.index = self._read_index()
+            return self._read_values(scenario_id, variable)
+
+    def read(self, scenario_id, variable, start_date=None, stop_date=None):
+        """ One variable of one scenario over a date range, as a Series indexed by Date """
+        times, date_slice = self._date_slice(scenario_id, start_date, stop_date)
+        values = self._values(scenario_id, variable)
+        return pd.Series(
+            np.array(values[date_slice]), index=serials_to_datetime64(times[date_slice]), name=variable
+        ).rename_axis("Date")
+
+    def read_frame(self, scenario_ids, variables, start_date=None, stop_date=None):
+        """ Several scenarios and variables as one wide frame with a Scenario column """
+        frames = []
+        for scenario_id in scenario_ids:
+            times, date_slice = self._date_slice(scenario_id, start_date, stop_date)
+            df = pd.DataFrame({
+                variable: np.array(self._values(scenario_id, variable)[date_slice]) for variable in variables
+            })
+            df.insert(0, "t", np.array(times[date_slice]))
+            df["Scenario"] = self._metadata(scenario_id)["scenario"]
+            df["Date"] = serials_to_datetime64(df["t"])
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True)
+
+    def remove(self, scenario_id):
+        with self._locked_index() as index:
+            metadata = index.pop(scenario_id, None)
+            if metadata is not None:
+                self._remove_unreferenced(index, metadata)
+
+
+class ArchiveSink:
+    """ Writes result chunks into preallocated memory-mapped arrays of one scenario
+    The arrays are written in a temporary directory, renamed to a directory of this run's own on close
+    """
+
+    def __init__(self, archive, scenario_id, metadata, dtypes):
+        self.archive = archive
+        self.scenario_id = scenario_id
+        self.metadata = metadata
+        self.dtypes = dtypes
+        self.position = 0
+        self.arrays = None
+        self.metadata["directory"] = f"{scenario_id}.{uuid.uuid4().hex[:12]}"
+        self.tmp_path = os.path.join(archive.path, f".{self.metadata['directory']}.tmp")
+
+    def _allocate(self, df):
+        directory = self.tmp_path
+        os.makedirs(directory)
+        n_steps = self.metadata["n_steps"]
+        self.arrays = {"t": np.lib.format.open_memmap(
+            os.path.join(directory, "t.npy"), mode="w+", dtype="float64", shape=(n_steps,)
+        )}
+        for variable, file_name in self.metadata["variables"].items():
+            dtype = self.dtypes.get(variable, df[variable].dtype)
+            self.arrays[variable] = np.lib.format.open_memmap(
+                os.path.join(directory, file_name), mode="w+", dtype=dtype, shape=(n_steps,)
+            )
+
+    def __call__(self, df):
+        if self.arrays is None:
+            self._allocate(df)
+        rows = slice(self.position, self.position + len(df))
+        self.arrays["t"][rows] = df["t"].to_numpy()
+        for variable in self.metadata["variables"]:
+            self.arrays[variable][rows] = df[variable].to_numpy()
+        self.position += len(df)
+
+    def close(self):
+        if self.arrays is None:
+            return
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = None
+        self.metadata["n_steps"] = self.position
+        self.archive._register(self.scenario_id, self.metadata, self.tmp_path)
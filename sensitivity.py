@@ -0,0 +1,187 @@
+""" Global sensitivity analysis of model outputs to its parameters and constants
+
+Two methods, both run as batches through BatchRunner:
+
+    Morris      elementary effects along random one-at-a-time trajectories,
+                cheap screening (trajectories x (factors + 1) runs)
+    Sobol       first order (Saltelli 2010) and total (Jansen) indices from an
+                A, B, AB_i design (n x (factors + 2) runs)
+
+Each run is reduced in the worker to the mean of every output variable over
+the run, and indices are reported with bootstrap confidence intervals:
+
+    with BatchRunner(df_input, start_date, stop_date, variables=OUTPUT_VARIABLES) as runner:
+        morris = run_morris(runner, n_trajectories=50)
+        sobol = run_sobol(runner, n=2048)
+
+Factors are {name: (lower, upper)} over model parameters (DEFAULT_PARAMETERS
+in model_config2.py) and model constants, sampled uniformly.
+"""
+import numpy as np
+import pandas as pd
+
+SENSITIVITY_FACTORS = {
+    "comm_needs": (0.5, 1.5),
+    "trader_leadtime": (3.0, 14.0),
+    "wholesaler_leadtime": (3.0, 14.0),
+    "retailer_leadtime": (3.0, 14.0),
+    "smoothing_time": (3.0, 30.0),
+    "Host Population Max Fraction of Income Spent on Commodity": (0.2, 1.0),
+}
+OUTPUT_VARIABLES = ["Retailer Price", "Retailer to Consumer Fill Rate"]
+
+
+def output_means(times, values):
+    """ Summary run in the workers: mean of each output variable over the run """
+    return values.mean(axis=0)
+
+
+def to_points(unit_design, factors):
+    """ Points (dicts of factor values) of a design in the unit cube """
+    bounds = np.array(list(factors.values()), dtype="float64")
+    values = bounds[:, 0] + unit_design * (bounds[:, 1] - bounds[:, 0])
+    return [dict(zip(factors, row.tolist())) for row in values]
+
+
+def run_design(runner, unit_design, factors, n_outputs):
+    """ Output means of every design row, NaN for runs that diverged """
+    results = runner.run(to_points(unit_design, factors), summary=output_means)
+    return np.array([np.full(n_outputs, np.nan) if result is None else result for result in results])
+
+
+def bootstrap_interval(samples, statistic, n_bootstrap, confidence, rng):
+    """ Percentile interval of statistic over bootstrap resamples of the rows of samples """
+    n = len(samples)
+    estimates = np.array([statistic(samples[rng.integers(0, n, n)]) for _ in range(n_bootstrap)])
+    tail = 100 * (1 - confidence) / 2
+    return np.nanpercentile(estimates, tail, axis=0), np.nanpercentile(estimates, 100 - tail, axis=0)
+
+
+def morris_design(n_factors, n_trajectories, levels, rng):
+    """ Unit-cube design of n_trajectories trajectories, each of n_factors + 1 points
+    moving one factor (in random order) by delta at each point
+    """
+    delta = levels / (2.0 * (levels - 1))
+    # base points on the grid, low enough to move up by delta
+    n_base_levels = levels // 2
+    design = np.empty((n_trajectories, n_factors + 1, n_factors))
+    order = np.empty((n_trajectories, n_factors), dtype=int)
+    for trajectory in range(n_trajectories):
+        point = rng.integers(0, n_base_levels, n_factors) / (levels - 1)
+        order[trajectory] = rng.permutation(n_factors)
+        design[trajectory, 0] = point
+        for step, factor in enumerate(order[trajectory]):
+            point = point.copy()
+            point[factor] += delta
+            design[trajectory, step + 1] = point
+    return design, order, delta
+
+
+def morris_indices(outputs, order, delta, factor_names, output_names, n_bootstrap=1000, confidence=0.95,
+                   rng=None):
+    """ mu, mu* and sigma of the elementary effects, with a bootstrap interval of mu*
+    outputs: (n_trajectories, n_factors + 1, n_outputs)
+    """
+    rng = rng or np.random.default_rng()
+    n_trajectories, n_factors = order.shape
+    effects = np.empty((n_trajectories, n_factors, outputs.shape[2]))
+    for trajectory in range(n_trajectories):
+        steps = np.diff(outputs[trajectory], axis=0) / delta
+        effects[trajectory, order[trajectory]] = steps
+    effects = effects[np.all(np.isfinite(effects), axis=(1, 2))]
+
+    def mu_star(sample):
+        return np.abs(sample).mean(axis=0)
+
+    low, high = bootstrap_interval(effects, mu_star, n_bootstrap, confidence, rng)
+    rows = []
+    for i, factor in enumerate(factor_names):
+        for j, output in enumerate(output_names):
+            rows.append({
+                "Factor": factor,
+                "Output": output,
+                "mu": effects[:, i, j].mean(),
+                "mu_star": np.abs(effects[:, i, j]).mean(),
+                "sigma": effects[:, i, j].std(ddof=1),
+                "mu_star_low": low[i, j],
+                "mu_star_high": high[i, j],
+                "trajectories": len(effects),
+            })
+    return pd.DataFrame(rows)
+
+
+def run_morris(runner, factors=None, n_trajectories=20, levels=4, n_bootstrap=1000, confidence=0.95, seed=0):
+    """ Morris screening of factors for the runner's variables """
+    factors = factors or SENSITIVITY_FACTORS
+    rng = np.random.default_rng(seed)
+    design, order, delta = morris_design(len(factors), n_trajectories, levels, rng)
+    outputs = run_design(runner, design.reshape(-1, len(factors)), factors, len(runner.variables))
+    outputs = outputs.reshape(n_trajectories, len(factors) + 1, -1)
+    return morris_indices(outputs, order, delta, list(factors), runner.variables, n_bootstrap, confidence, rng)
+
+
+def saltelli_design(n_factors, n, rng):
+    """ Rows of A, B and every AB_i (A with column i from B), stacked, for n base samples """
+    try:
+        from scipy.stats import qmc
+
+        samples = qmc.Sobol(2 * n_factors, scramble=True, seed=rng).random(n)
+    except ImportError:
+        samples = rng.random((n, 2 * n_factors))
+    a, b = samples[:, :n_factors], samples[:, n_factors:]
+    ab = np.repeat(a[None, :, :], n_factors, axis=0)
+    for i in range(n_factors):
+        ab[i, :, i] = b[:, i]
+    return np.vstack([a, b, ab.reshape(-1, n_factors)])
+
+
+def sobol_estimates(f_a, f_b, f_ab):
+    """ First order and total indices from outputs f_a, f_b (n, outputs) and f_ab (factors, n, outputs) """
+    variance = np.var(np.concatenate([f_a, f_b]), axis=0, ddof=1)
+    first_order = np.mean(f_b[None] * (f_ab - f_a[None]), axis=1) / variance
+    total = 0.5 * np.mean((f_a[None] - f_ab) ** 2, axis=1) / variance
+    return first_order, total
+
+
+def sobol_indices(outputs, n_factors, factor_names, output_names, n_bootstrap=1000, confidence=0.95,
+                  rng=None):
+    """ Sobol indices with bootstrap intervals, from the outputs of a saltelli_design """
+    rng = rng or np.random.default_rng()
+    n = len(outputs) // (n_factors + 2)
+    # one row per base sample: A, B and each AB_i side by side
+    samples = np.concatenate([
+        outputs[:n][:, None], outputs[n:2 * n][:, None],
+        outputs[2 * n:].reshape(n_factors, n, -1).transpose(1, 0, 2)
+    ], axis=1)
+    samples = samples[np.all(np.isfinite(samples), axis=(1, 2))]
+
+    def estimates(sample):
+        first_order, total = sobol_estimates(sample[:, 0], sample[:, 1], sample[:, 2:].transpose(1, 0, 2))
+        return np.stack([first_order, total])
+
+    point = estimates(samples)
+    low, high = bootstrap_interval(samples, estimates, n_bootstrap, confidence, rng)
+    rows = []
+    for i, factor in enumerate(factor_names):
+        for j, output in enumerate(output_names):
+            rows.append({
+                "Factor": factor,
+                "Output": output,
+                "S1": point[0, i, j],
+                "S1_low": low[0, i, j],
+                "S1_high": high[0, i, j],
+                "ST": point[1, i, j],
+                "ST_low": low[1, i, j],
+                "ST_high": high[1, i, j],
+                "samples": len(samples),
+            })
+    return pd.DataFrame(rows)
+
+
+def run_sobol(runner, factors=None, n=512, n_bootstrap=1000, confidence=0.95, seed=0):
+    """ Sobol indices of factors for the runner's variables, from n * (factors + 2) runs """
+    factors = factors or SENSITIVITY_FACTORS
+    rng = np.random.default_rng(seed)
+    design = saltelli_design(len(factors), n, rng)
+    outputs = run_design(runner, design, factors, len(runner.variables))
+    return sobol_indices(outputs, len(factors), list(factors), runner.variables, n_bootstrap, confidence, rng)
@@ -0,0 +1,232 @@
+""" Serving metrics of the dashboard in the Prometheus text format
+
+Everything the dashboard does per request is recorded in one registry of
+metrics, which register_metrics_endpoint serves from the Flask server
+behind the Dash app:
+
+    callback latency      histogram per callback (timed_callback)
+    in progress           callbacks running or waiting, per callback (the queue depth)
+    payload size          histogram of serialized stored-runs sizes in bytes
+    simulations           total model runs, and runs in the last minute
+    cache hits / misses   per cache (CountingCache), with the hit ratio
+
+    register_metrics_endpoint(app.server)          # GET /metrics
+
+    @app.callback(...)
+    @timed_callback("run_scenario_x")
+    def run_scenario_x(...):
+
+The registry can be read without a server, to test locally:
+
+    print(METRICS.render())
+
+Metrics are per process: with several gunicorn workers, each worker serves
+its own values (scrape them all, or sum the counters across workers).
+"""
+import functools
+import threading
+import time
+from collections import OrderedDict, deque
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "dashboard"
+LATENCY_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PAYLOAD_BUCKETS_BYTES = (1e3, 1e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+RATE_WINDOW_S = 60.0
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """ Cumulative bucket counts, sum and count of observed values """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels=()):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f"{name}_bucket{format_labels([*labels, ('le', format_value(bound))])} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {format_value(self.sum)}"
+        yield f"{name}_count{format_labels(labels)} {self.count}"
+
+
+class ServingMetrics:
+    def __init__(self, latency_buckets=LATENCY_BUCKETS_S, payload_buckets=PAYLOAD_BUCKETS_BYTES,
+                 clock=time.monotonic):
+        self.latency_buckets = latency_buckets
+        self.latency = {}
+        self.in_progress = {}
+        self.errors = {}
+        self.payload_bytes = Histogram(payload_buckets)
+        self.simulations = 0
+        self.recent_simulations = deque()
+        self.cache_hits = {}
+        self.cache_misses = {}
+        self.clock = clock
+        # callbacks run on several threads of a worker
+        self.lock = threading.Lock()
+
+    def start_callback(self, callback):
+        with self.lock:
+            self.in_progress[callback] = self.in_progress.get(callback, 0) + 1
+            self.latency.setdefault(callback, Histogram(self.latency_buckets))
+
+    def finish_callback(self, callback, seconds, failed=False):
+        with self.lock:
+            self.in_progress[callback] -= 1
+            self.latency[callback].observe(seconds)
+            if failed:
+                self.errors[callback] = self.errors.get(callback, 0) + 1
+
+    def observe_payload(self, payload):
+        """ Record the size of a serialized payload (str or bytes) """
+        size = len(payload.encode() if isinstance(payload, str) else payload)
+        with self.lock:
+            self.payload_bytes.observe(size)
+        return size
+
+    def record_simulation(self, count=1):
+        with self.lock:
+            self.simulations += count
+            now = self.clock()
+            self.recent_simulations.extend([now] * count)
+            self._expire(now)
+
+    def _expire(self, now):
+        while self.recent_simulations and self.recent_simulations[0] <= now - RATE_WINDOW_S:
+            self.recent_simulations.popleft()
+
+    def simulations_per_minute(self):
+        with self.lock:
+            self._expire(self.clock())
+            return len(self.recent_simulations) * 60.0 / RATE_WINDOW_S
+
+    def record_cache(self, cache, hit):
+        with self.lock:
+            counts = self.cache_hits if hit else self.cache_misses
+            counts[cache] = counts.get(cache, 0) + 1
+
+    def hit_ratio(self, cache):
+        hits, misses = self.cache_hits.get(cache, 0), self.cache_misses.get(cache, 0)
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+        simulations_per_minute = self.simulations_per_minute()
+        with self.lock:
+            lines = []
+
+            def family(name, kind, help_text):
+                lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+                lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+                return f"{PREFIX}_{name}"
+
+            name = family("callback_latency_seconds", "histogram", "Latency of Dash callbacks.")
+            for callback, histogram in sorted(self.latency.items()):
+                lines.extend(histogram.lines(name, [("callback", callback)]))
+            name = family("callbacks_in_progress", "gauge", "Callbacks running or waiting to run (queue depth).")
+            for callback, count in sorted(self.in_progress.items()):
+                lines.append(f"{name}{format_labels([('callback', callback)])} {count}")
+            name = family("callback_errors_total", "counter", "Callbacks that raised an exception.")
+            for callback, count in sorted(self.errors.items()):
+                lines.append(f"{name}{format_labels([('callback', callback)])} {count}")
+            name = family("stored_runs_bytes", "histogram", "Size of serialized stored-runs payloads.")
+            lines.extend(self.payload_bytes.lines(name))
+            name = family("simulations_total", "counter", "Model runs.")
+            lines.append(f"{name} {self.simulations}")
+            name = family("simulations_per_minute", "gauge", f"Model runs in the last {RATE_WINDOW_S:g} s, per minute.")
+            lines.append(f"{name} {format_value(simulations_per_minute)}")
+            caches = sorted(set(self.cache_hits) | set(self.cache_misses))
+            for suffix, counts, help_text in [("hits_total", self.cache_hits, "Cache hits."),
+                                              ("misses_total", self.cache_misses, "Cache misses.")]:
+                name = family(f"cache_{suffix}", "counter", help_text)
+                for cache in caches:
+                    lines.append(f"{name}{format_labels([('cache', cache)])} {counts.get(cache, 0)}")
+            name = family("cache_hit_ratio", "gauge", "Hits over lookups of each cache.")
+            for cache in caches:
+                lines.append(f"{name}{format_labels([('cache', cache)])} {format_value(self.hit_ratio(cache))}")
+            return "\n".join(lines) + "\n"
+
+
+METRICS = ServingMetrics()
+
+
+def timed_callback(name, metrics=None):
+    """ Decorator recording the latency and in-progress count of a callback """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapped(*args, **kwargs):
+            registry = metrics or METRICS
+            registry.start_callback(name)
+            tic = time.perf_counter()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                registry.finish_callback(name, time.perf_counter() - tic, failed)
+        return wrapped
+    return decorator
+
+
+class CountingCache:
+    """ Least recently used cache of at most maxsize values, counting hits and misses in metrics """
+
+    def __init__(self, name, maxsize=32, metrics=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.metrics = metrics or METRICS
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """ Cached value of key, or compute() stored under key """
+        with self.lock:
+            hit = key in self.values
+            if hit:
+                self.values.move_to_end(key)
+                value = self.values[key]
+        self.metrics.record_cache(self.name, hit)
+        if hit:
+            return value
+        value = compute()
+        with self.lock:
+            self.values[key] = value
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        return value
+
+
+def register_metrics_endpoint(server, path="/metrics", metrics=None):
+    """ Serve metrics from a Flask server (app.server of a Dash app) """
+    def metrics_view():
+        return (metrics or METRICS).render(), 200, {"Content-Type": CONTENT_TYPE}
+
+    server.add_url_rule(path, "serving_metrics", metrics_view)
+    return server
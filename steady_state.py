@@ -0,0 +1,171 @@
+""" Steady-state initial values of a built model
+
+set_model_logic starts every actor's stock at leadtime * total needs and
+every smoothed variable at 1.0, so a run starts out of equilibrium and its
+first months are transients. initialize_steady_state solves for the stocks
+(physical stocks and SMOOTHED states, which set the prices) at which every
+stock derivative is zero at the start, with the data inputs held at their
+mean over the window_days before it:
+
+    report = initialize_steady_state(model, input_means(df, model.starttime))
+    report["converged"], report["prices"]
+
+The derivatives are evaluated with the model's own equations, by seeding
+its memo at the first step with candidate stock values and input values.
+A hybrid Newton solver (scipy.optimize.root) works on the log of the
+stocks, which keeps them positive. If it fails, an accelerated burn-in
+steps the frozen model forward with a step that grows while the derivatives
+shrink. Cash stocks keep their values: they integrate profit and feed
+nothing back, so they have no steady state.
+
+With the inputs held, there is no steady state if supply exceeds what
+consumers can buy at any price (the stocks then grow without bound), which
+is the case for DEFAULT_PARAMETERS on the USDA production data. The model's
+initial values are then left as built, with a warning, and the report has
+applied False and the best state the burn-in reached; apply_unconverged
+starts the model from that state instead, which settles the fast
+transients (prices, smoothed ratios) even when the stocks keep drifting.
+"""
+import warnings
+
+import numpy as np
+
+from input_grid import build_input_grid
+from stepping import memo_time
+
+
+def solved_stocks(model):
+    """ Stocks that have a steady state: every stock but cash """
+    return [name for name in model.stocks if not name.endswith(" Cash")]
+
+
+def input_means(df, start_serial, window_days=365.0, time_step_in_days=1.0):
+    """ Mean of every input over the window_days before start_serial, as the model sees it """
+    grid = build_input_grid(df, start_serial - window_days, start_serial, time_step_in_days)
+    in_window = (grid.times >= start_serial - window_days) & (grid.times <= start_serial)
+    return {column: float(np.nanmean(grid.values[in_window, i])) for column, i in grid.column_index.items()}
+
+
+def stock_derivatives(model, names, held_inputs=None):
+    """ Function of stock values returning their derivatives at the start, inputs held """
+    start = memo_time(model, model.starttime)
+    after = start + model.dt
+    held = {name: float(value) for name, value in (held_inputs or {}).items() if name in model.equations}
+
+    def derivatives(values):
+        model.reset_cache()
+        for name, value in held.items():
+            model.memo.setdefault(name, {})[start] = value
+        for name, value in zip(names, values):
+            model.memo[name][start] = float(value)
+        # a stock one step on is its value plus dt times its derivative at the start
+        return np.array([(model.evaluate_equation(name, after) - value) / model.dt
+                         for name, value in zip(names, values)])
+
+    return derivatives
+
+
+def relative_residual(derivatives, values, scale):
+    """ Largest derivative relative to the scale of its stock (per day), inf if the model cannot be evaluated
+    (relative to a fixed scale, not to the stock, so stocks running away do not look steady)
+    """
+    try:
+        with np.errstate(all="ignore"):
+            rates = derivatives(values) / scale
+    except (ZeroDivisionError, OverflowError):
+        return np.inf
+    return float(np.max(np.abs(rates))) if np.all(np.isfinite(rates)) else np.inf
+
+
+def solve_newton(derivatives, initial):
+    """ Stocks where derivatives vanish, by a hybrid Newton method on their logs
+    Returns (values, residual, evaluations), as burn_in does
+    """
+    from scipy.optimize import root
+
+    evaluations = 0
+
+    def residual(logs):
+        nonlocal evaluations
+        evaluations += 1
+        values = np.exp(logs)
+        try:
+            with np.errstate(all="ignore"):
+                rates = derivatives(values) / values
+        except (ZeroDivisionError, OverflowError):
+            return np.full(len(values), 1e10)
+        return np.where(np.isfinite(rates), rates, 1e10)
+
+    solution = root(residual, np.log(initial), method="hybr", options={"xtol": 1e-12})
+    values = np.exp(solution.x)
+    return values, relative_residual(derivatives, values, initial), evaluations + 1
+
+
+def burn_in(derivatives, initial, dt, tol, max_steps):
+    """ Step the held model forward from initial, growing the step while the derivatives shrink
+    and shrinking it when they grow (a step that makes a stock negative is not taken)
+    Returns the best (values, residual) found and the number of evaluations
+    """
+    values, step = np.array(initial, dtype="float64"), dt
+    residual = relative_residual(derivatives, values, initial)
+    best_values, best_residual = values, residual
+    evaluations = 1
+    while best_residual > tol and evaluations < max_steps and step > 1e-6 * dt:
+        with np.errstate(all="ignore"):
+            proposed = values + step * derivatives(values)
+        evaluations += 2
+        proposed_residual = relative_residual(derivatives, proposed, initial) if np.all(proposed > 0) else np.inf
+        if not np.isfinite(proposed_residual):
+            step *= 0.5
+            continue
+        step *= 1.2 if proposed_residual < residual else 0.7
+        values, residual = proposed, proposed_residual
+        if residual < best_residual:
+            best_values, best_residual = values, residual
+    return best_values, best_residual, evaluations
+
+
+def initialize_steady_state(model, held_inputs=None, stocks=None, tol=1e-8, max_burn_in_steps=5000,
+                            apply_unconverged=False):
+    """ Set the initial values of stocks to their steady state at the start, return a report
+    held_inputs: {input variable: value} held while solving (see input_means), others as at the start
+    tol: largest derivative of a solved stock relative to its initial value, per day
+    apply_unconverged: without a steady state, start from the best state found instead of the built one
+    """
+    names = list(stocks or solved_stocks(model))
+    derivatives = stock_derivatives(model, names, held_inputs)
+    model.reset_cache()
+    start = memo_time(model, model.starttime)
+    initial = np.array([model.evaluate_equation(name, start) for name in names], dtype="float64")
+    # log-space solving needs positive stocks
+    initial = np.where(initial > 0, initial, 1e-6)
+
+    values, residual, evaluations = solve_newton(derivatives, initial)
+    method = "newton"
+    if not residual <= tol:
+        values, residual, burn_in_evaluations = burn_in(derivatives, initial, model.dt, tol, max_burn_in_steps)
+        evaluations += burn_in_evaluations
+        method = "burn-in"
+    converged = residual <= tol
+    applied = bool(converged or (apply_unconverged and np.isfinite(residual)))
+
+    prices = {}
+    if np.isfinite(residual):
+        derivatives(values)
+        prices = {name: model.evaluate_equation(name, start) for name in model.converters if name.endswith(" Price")}
+    if applied:
+        for name, value in zip(names, values):
+            model.stocks[name].initial_value = float(value)
+    else:
+        warnings.warn(f"no steady state found (residual {residual:.3g} per day after {method}), "
+                      f"the model starts from its built initial values")
+    model.reset_cache()
+    return {
+        "converged": converged,
+        "applied": applied,
+        "method": method,
+        "residual": residual,
+        "evaluations": evaluations,
+        "stocks": dict(zip(names, values.tolist())),
+        "prices": prices,
+    }
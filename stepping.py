@@ -0,0 +1,149 @@
+""" Iterative time stepping
+
+BPTK evaluates a stock at time t by asking for its value at t - dt, which
+recurses back to the start time the first time a late value is requested.
+Long horizons then hit Python's recursion limit. iterate_model instead
+advances the whole model one step at a time: at each step every stock is
+evaluated first (its previous value is already stored, so this is one level
+deep), then the requested variables. Only the last memo_steps steps are kept
+in the model's memo, so run cost is linear in the horizon and memory does
+not grow with it.
+
+    run_model(model_env, model, "base", {}, datetime(2009, 1, 1), datetime.now(), engine="stepping")
+"""
+import numpy as np
+
+from guardrails import ModelDivergenceError
+from instrumentation import phase
+
+
+def time_grid(model):
+    """ Serial times of every step from starttime to stoptime """
+    n_steps = int(round((model.stoptime - model.starttime) / model.dt)) + 1
+    return model.starttime + model.dt * np.arange(n_steps)
+
+
+def memo_time(model, t):
+    """ Time t as BPTK rounds it for its memo """
+    from BPTK_Py.util import floating_point as fp
+
+    precision = max(fp.scale(model.starttime), fp.scale(model.dt))
+    return fp.normalize(t, model.dt, model.starttime, precision)
+
+
+def starts_one_step_in(model):
+    """ Whether stocks report their start time one Euler step past their initial values
+    BPTK rounds times to the precision of starttime, which for most serials rounds starttime
+    itself up, past the t <= starttime test that returns the initial value
+    """
+    return memo_time(model, model.starttime) > model.starttime
+
+
+def trim_memo(model, keep_from):
+    """ Drop memoized values for times before keep_from """
+    for name, memo in model.memo.items():
+        if memo:
+            model.memo[name] = {t: value for t, value in memo.items() if t >= keep_from}
+
+
+def divergence(name, t, error):
+    """ ModelDivergenceError for an arithmetic error raised evaluating name at t """
+    message = f"evaluating {name} at t={t}: {error!r}"
+    return ModelDivergenceError(name, t, kind=type(error).__name__, message=message)
+
+
+def _raising_divergence(name, function):
+    def wrapped(t):
+        try:
+            return function(t)
+        except (ZeroDivisionError, OverflowError) as error:
+            raise divergence(name, t, error) from error
+    return wrapped
+
+
+def locate_divergence(model, name, t, error):
+    """ ModelDivergenceError naming the element whose own equation failed while evaluating name at t
+    Evaluating name again with every equation wrapped, only after a failure, so runs that do not
+    fail pay nothing for it
+    """
+    originals = dict(model.equations)
+    for element, function in originals.items():
+        model.equations[element] = _raising_divergence(element, function)
+    try:
+        model.evaluate_equation(name, t)
+    except ModelDivergenceError as located:
+        return located
+    except (ZeroDivisionError, OverflowError):
+        pass
+    finally:
+        model.equations.update(originals)
+    return divergence(name, t, error)
+
+
+def _guarded_step(model, guardrails, checks, names, t):
+    """ Values of names at t, checked by guardrails, clamped values written back to the memo
+    Names are checked once all of them are evaluated, so a clamped flow or converter is only seen
+    clamped by the stocks of the next step: variables of the same step evaluated with it have read
+    the value before clamping. Stocks are checked before any variable of their step is evaluated,
+    so a clamped stock is seen clamped from its own step.
+    """
+    values = np.empty(len(names))
+    for i, name in enumerate(names):
+        try:
+            values[i] = model.evaluate_equation(name, t)
+        except (ZeroDivisionError, OverflowError) as error:
+            raise locate_divergence(model, name, t, error) from error
+    checked = guardrails.check(checks, t, values)
+    if checked is not values:
+        key = memo_time(model, t)
+        for i in np.flatnonzero(checked != values):
+            model.memo[names[i]][key] = float(checked[i])
+    return checked
+
+
+def iterate_model(model, variables, chunk_size=365, memo_steps=2, guardrails=None):
+    """ Evaluate model forward step by step, yield (times, values) of chunk_size steps
+    values has one column per variable; memo_steps is how many past steps stay memoized
+    guardrails (see guardrails.py) checks every stock and variable at every step
+    A division by zero or an overflow raises ModelDivergenceError naming the variable whose equation
+    failed (not the variable being evaluated, which may depend on it) and the time
+    """
+    times = time_grid(model)
+    stocks = list(model.stocks)
+    model.reset_cache()
+    if guardrails is not None:
+        guardrails.reset()
+        # variables with bounds but not in the output are checked too
+        checked = list(variables) + [name for name in guardrails.bounds
+                                     if name not in variables and name not in model.stocks]
+        stock_checks = guardrails.prepare(model, stocks)
+        variable_checks = guardrails.prepare(model, checked)
+    for chunk_start in range(0, len(times), chunk_size):
+        chunk_times = times[chunk_start:chunk_start + chunk_size]
+        values = np.empty((len(chunk_times), len(variables)))
+        name, t = None, chunk_times[0]
+        with phase("simulate"):
+            try:
+                if guardrails is None:
+                    for i, t in enumerate(chunk_times):
+                        for name in stocks:
+                            model.evaluate_equation(name, t)
+                        for j, name in enumerate(variables):
+                            values[i, j] = model.evaluate_equation(name, t)
+                else:
+                    for i, t in enumerate(chunk_times):
+                        _guarded_step(model, guardrails, stock_checks, stocks, t)
+                        values[i] = _guarded_step(model, guardrails, variable_checks, checked, t)[:len(variables)]
+            except (ZeroDivisionError, OverflowError) as error:
+                raise locate_divergence(model, name, t, error) from error
+            trim_memo(model, chunk_times[-1] - memo_steps * model.dt)
+        yield chunk_times, values
+    model.reset_cache()
+
+
+def simulate_stepwise(model, variables, chunk_size=365, memo_steps=2, guardrails=None):
+    """ Whole run of iterate_model as (times, values) arrays """
+    chunks = list(iterate_model(model, variables, chunk_size, memo_steps, guardrails))
+    if not chunks:
+        return np.empty(0), np.empty((0, len(variables)))
+    return np.concatenate([times for times, _ in chunks]), np.concatenate([values for _, values in chunks])
@@ -0,0 +1,113 @@
+""" Stream model results in fixed-size time chunks
+
+run_model collects the whole run in one DataFrame at the end. stream_model
+instead evaluates the model forward one step at a time and hands a DataFrame
+of chunk_size steps to a sink as soon as the chunk is complete. The model's
+memo is trimmed to the last few steps after each chunk (see stepping.py), so
+memory does not grow with the horizon.
+
+A sink is any callable taking a DataFrame, or one of the file sinks below:
+
+    with ParquetSink("runs/base.parquet") as sink:
+        stream_model(model_env, model, "base", {}, start_date, stop_date, sink)
+
+    stream_model(model_env, model, "base", {}, start_date, stop_date, print, chunk_size=30)
+
+Chunks have the columns of run_model (without t_check), with Date as
+datetime64, and can be made compact with output_options (see results.py).
+"""
+import pandas as pd
+
+from instrumentation import phase
+from interventions import apply_schedule
+from model_operations import prepare_scenario_model, output_variable_names
+from results import compact_results, serials_to_datetime64
+from stepping import iterate_model
+
+
+def stream_model(model_env, model, scenario_name, constants, start_date, stop_date, sink,
+                 chunk_size=365, output_options=None, variables=None, memo_steps=2, schedule=None):
+    """ Run model and pass results to sink in chunks of chunk_size steps
+    memo_steps is how many past steps stay memoized between chunks (stocks need one)
+    schedule is an InterventionSchedule (see interventions.py)
+    Returns the number of steps written
+    """
+    with phase("register"):
+        scenario_model = prepare_scenario_model(
+            model_env, model, scenario_name, constants, start_date, stop_date
+        )
+        apply_schedule(scenario_model, schedule, getattr(model, "inlined_elements", ()))
+    if variables is None:
+        variables = output_variable_names(scenario_model)
+
+    n_steps = 0
+    for chunk_times, values in iterate_model(scenario_model, variables, chunk_size, memo_steps):
+        with phase("post-process"):
+            df = pd.DataFrame(values, columns=variables)
+            df.insert(0, "t", chunk_times)
+            df["Scenario"] = scenario_name
+            df["Date"] = serials_to_datetime64(chunk_times)
+            if output_options is not None:
+                df = compact_results(df, **output_options)
+        sink(df)
+        n_steps += len(chunk_times)
+    return n_steps
+
+
+class ParquetSink:
+    """ Append chunks as row groups of a Parquet file (readable once closed) """
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def __call__(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArrowStreamSink:
+    """ Append chunks to an Arrow IPC stream file, which readers can follow while it is written """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.writer = None
+
+    def __call__(self, df):
+        import pyarrow as pa
+
+        batch = pa.RecordBatch.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.file = pa.OSFile(self.path, "wb")
+            self.writer = pa.ipc.new_stream(self.file, batch.schema)
+        self.writer.write_batch(batch)
+        self.file.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.file.close()
+            self.writer, self.file = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
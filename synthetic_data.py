@@ -0,0 +1,206 @@
+""" Generate synthetic input files with the same layout as the files under data/
+
+The generated directory can be passed to import_all_data(data_dir=...) in place
+of data/, to test how ingestion and the model scale with more years, markets,
+states and conflict events than the real datasets contain.
+
+Usage:
+    python synthetic_data.py data_synthetic --years 2009 2021 --markets 50 --states 6
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# names the readers in import_data.py filter on, always included
+MAIN_MARKET = "Maiduguri"
+MAIN_STATE = "Borno state"
+MAIN_COMMODITY = "Rice (local)"
+OTHER_STATES = ["Adamawa state", "Yobe state", "Gombe state", "Bauchi state", "Taraba state"]
+OTHER_COMMODITIES = ["Rice (imported)", "Maize (white)", "Sorghum (white)", "Millet", "Cowpeas"]
+UNITS = ["KG", "50 KG", "100 KG"]
+UNIT_KGS = [1.0, 50.0, 100.0]
+
+# read_nbs_inflation assigns this fixed monthly range to the sheets, so it cannot vary
+NBS_SHEET_START, NBS_SHEET_STOP = "1995-01-01", "2021-07-01"
+
+# approximate centre of Borno state, events and markets are scattered around it
+CENTRE_LAT, CENTRE_LON = 11.85, 13.16
+
+
+def state_names(n_states):
+    names = [MAIN_STATE] + OTHER_STATES
+    names += [f"Synthetic state {i}" for i in range(len(names), n_states)]
+    return names[:n_states]
+
+
+def market_names(n_markets):
+    return [MAIN_MARKET] + [f"Market {i}" for i in range(1, n_markets)]
+
+
+def commodity_names(n_commodities):
+    names = [MAIN_COMMODITY] + OTHER_COMMODITIES
+    names += [f"Commodity {i}" for i in range(len(names), n_commodities)]
+    return names[:n_commodities]
+
+
+def hxl_row(columns, tags):
+    """ Second line of HDX CSVs, holding HXL hashtags (skipped by the readers) """
+    return pd.DataFrame([[tags.get(column, "") for column in columns]], columns=columns)
+
+
+def generate_wfp(path, years, n_markets, n_states, n_commodities, rng):
+    """ WFP VAM price file: one row per (month, market, commodity), as wfp_food_prices_nga.csv """
+    dates = pd.date_range(f"{years[0]}-01-01", f"{years[1]}-12-01", freq="MS") + pd.Timedelta(days=14)
+    markets = market_names(n_markets)
+    states = state_names(n_states)
+    commodities = commodity_names(n_commodities)
+
+    date_index, market_index, commodity_index = np.meshgrid(
+        np.arange(len(dates)), np.arange(len(markets)), np.arange(len(commodities)), indexing="ij"
+    )
+    date_index, market_index, commodity_index = (
+        date_index.ravel(), market_index.ravel(), commodity_index.ravel()
+    )
+    unit_index = rng.integers(0, len(UNITS), len(date_index))
+    units, kgs = np.array(UNITS)[unit_index], np.array(UNIT_KGS)[unit_index]
+    trend = np.exp(0.01 * date_index + rng.normal(0, 0.05, len(date_index)))
+    price_per_kg = 150.0 * (1.0 + 0.2 * commodity_index) * trend
+
+    df = pd.DataFrame({
+        "date": dates[date_index].strftime("%Y-%m-%d"),
+        "admin1": np.array(states)[market_index % len(states)],
+        "admin2": "",
+        "market": np.array(markets)[market_index],
+        "latitude": CENTRE_LAT + rng.normal(0, 1.0, len(markets))[market_index],
+        "longitude": CENTRE_LON + rng.normal(0, 1.0, len(markets))[market_index],
+        "category": "cereals and tubers",
+        "commodity": np.array(commodities)[commodity_index],
+        "unit": units,
+        "priceflag": "actual",
+        "pricetype": "Retail",
+        "currency": "NGN",
+        "price": np.round(price_per_kg * kgs, 2),
+        "usdprice": np.round(price_per_kg * kgs / 400.0, 4),
+    })
+    tags = {"date": "#date", "admin1": "#adm1+name", "market": "#loc+market+name",
+            "commodity": "#item+name", "unit": "#item+unit", "price": "#value"}
+    pd.concat([hxl_row(df.columns, tags), df]).to_csv(path, index=False)
+    return len(df)
+
+
+def generate_ucdp(path, years, n_states, events_per_day, rng):
+    """ UCDP GED event file: one row per event, as conflict_data_nga.csv """
+    days = pd.date_range(f"{years[0]}-01-01", f"{years[1]}-12-31", freq="D")
+    n_events = rng.poisson(events_per_day * len(days))
+    day_index = np.sort(rng.integers(0, len(days), n_events))
+    states = state_names(n_states)
+    dates = days[day_index].strftime("%Y-%m-%d 00:00:00.000")
+    latitude = CENTRE_LAT + rng.normal(0, 1.5, n_events)
+    longitude = CENTRE_LON + rng.normal(0, 1.5, n_events)
+    best = rng.negative_binomial(1, 0.2, n_events)
+
+    df = pd.DataFrame({
+        "id": np.arange(n_events) + 1,
+        "year": days[day_index].year,
+        "type_of_violence": rng.integers(1, 4, n_events),
+        "conflict_name": "Nigeria: Government",
+        "adm_1": np.array(states)[rng.integers(0, len(states), n_events)],
+        "adm_2": "",
+        "latitude": np.round(latitude, 6),
+        "longitude": np.round(longitude, 6),
+        "country": "Nigeria",
+        "date_prec": 1,
+        "date_start": dates,
+        "date_end": dates,
+        "best": best,
+        "high": best + rng.integers(0, 3, n_events),
+        "low": best,
+    })
+    tags = {"year": "#date+year", "adm_1": "#adm1+name", "latitude": "#geo+lat",
+            "longitude": "#geo+lon", "date_start": "#date+start", "best": "#affected+killed"}
+    pd.concat([hxl_row(df.columns, tags), df]).reset_index(drop=True).to_csv(path)
+    return len(df)
+
+
+def generate_nbs_cpi(path, rng):
+    """ NBS CPI workbook with the sheet layouts read_nbs_inflation expects """
+    dates = pd.date_range(NBS_SHEET_START, NBS_SHEET_STOP, freq="MS")
+    n = len(dates)
+
+    def index_series(growth):
+        return 14.0 * np.exp(np.cumsum(growth + rng.normal(0, 0.005, n)))
+
+    with pd.ExcelWriter(path) as writer:
+        # Table1: four title rows, a header ("Weights") row, food monthly index in column 12
+        table = np.full((5 + n, 19), np.nan, dtype=object)
+        table[0, 0] = "Table 1 Composite Consumer Price Index (synthetic)"
+        table[2, 2], table[2, 12] = "All Items Index", "Food"
+        table[4, 0] = "Weights"
+        table[5:, 0] = dates.year
+        table[5:, 1] = dates.strftime("%b")
+        table[5:, 2] = index_series(0.010)
+        table[5:, 12] = index_series(0.011)
+        pd.DataFrame(table).to_excel(writer, sheet_name="Table1", header=False, index=False)
+
+        # Table2 and Table3: title row, header row, weights row, then data
+        for sheet_name in ["Table2", "Table3"]:
+            columns = ["", "", "All Items", "Food", "Transport"]
+            table = np.full((3 + n, len(columns)), np.nan, dtype=object)
+            table[0, 0] = f"{sheet_name} Consumer Price Index (synthetic)"
+            table[1, :] = columns
+            table[2, 0] = "Weights"
+            table[3:, 0] = dates.year
+            table[3:, 1] = dates.strftime("%b")
+            for column in range(2, len(columns)):
+                table[3:, column] = index_series(0.010)
+            pd.DataFrame(table).to_excel(writer, sheet_name=sheet_name, header=False, index=False)
+    return n
+
+
+def generate_iom(path, years, rng):
+    """ Compiled IOM DTM sheet: monthly IDP counts, as _IOM compile.xlsx """
+    dates = pd.date_range(f"{years[0]}-01-01", f"{years[1]}-12-01", freq="MS")
+    idps = np.maximum(0, 1500000 + np.cumsum(rng.normal(0, 20000, len(dates)))).astype(int)
+    df = pd.DataFrame({"Date": dates, "IDPs": idps})
+    df.to_excel(path, index=False)
+    return len(df)
+
+
+def generate_all(data_dir, years=(2014, 2021), n_markets=1, n_states=1, n_commodities=1,
+                 events_per_day=2.0, seed=0):
+    """ Write a full set of synthetic input files to data_dir, return row counts per file """
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    return {
+        "wfp_food_prices_nga.csv": generate_wfp(
+            os.path.join(data_dir, "wfp_food_prices_nga.csv"),
+            years, n_markets, n_states, n_commodities, rng
+        ),
+        "conflict_data_nga.csv": generate_ucdp(
+            os.path.join(data_dir, "conflict_data_nga.csv"), years, n_states, events_per_day, rng
+        ),
+        "cpi_1NewJULY2021.xlsx": generate_nbs_cpi(os.path.join(data_dir, "cpi_1NewJULY2021.xlsx"), rng),
+        "_IOM compile.xlsx": generate_iom(os.path.join(data_dir, "_IOM compile.xlsx"), years, rng),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data_dir")
+    parser.add_argument("--years", nargs=2, type=int, default=[2014, 2021])
+    parser.add_argument("--markets", type=int, default=1)
+    parser.add_argument("--states", type=int, default=1)
+    parser.add_argument("--commodities", type=int, default=1)
+    parser.add_argument("--events-per-day", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    rows = generate_all(args.data_dir, args.years, args.markets, args.states,
+                        args.commodities, args.events_per_day, args.seed)
+    for filename, n_rows in rows.items():
+        print(f"{filename:30s} {n_rows} rows")
+
+
+if __name__ == "__main__":
+    main()
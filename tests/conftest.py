@@ -0,0 +1,21 @@
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import import_data
+import synthetic_data
+
+START_DATE = datetime(2015, 1, 1)
+STOP_DATE = datetime(2015, 7, 1)
+
+
+@pytest.fixture(scope="session")
+def df_input(tmp_path_factory):
+    """ import_all_data of a synthetic set of input files """
+    data_dir = str(tmp_path_factory.mktemp("data"))
+    synthetic_data.generate_all(data_dir)
+    return import_data.import_all_data(data_dir)
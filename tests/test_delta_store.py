@@ -0,0 +1,33 @@
+import pytest
+
+from delta_store import pack_runs, unpack_runs
+from model_operations import setup_model, run_model
+from results import concat_results
+from conftest import START_DATE, STOP_DATE
+
+
+@pytest.fixture(scope="module")
+def model(df_input):
+    return setup_model(START_DATE, STOP_DATE, df_input)
+
+
+def two_scenarios(model, dtype):
+    model_env, model = model
+    return concat_results([
+        run_model(model_env, model, scenario, constants, START_DATE, STOP_DATE, {"dtype": dtype})
+        for scenario, constants in [("A", {}), ("B", {"Retailer Leadtime": 14.0})]
+    ])
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_pack_runs_keeps_dtypes_and_values(model, dtype):
+    df = two_scenarios(model, dtype)
+    unpacked = unpack_runs(pack_runs(df))
+    assert unpacked.dtypes.to_dict() == df.dtypes.to_dict()
+    assert unpacked.drop(columns="Date").equals(df.drop(columns="Date"))
+
+
+def test_float32_halves_the_payload(model):
+    float32 = pack_runs(two_scenarios(model, "float32"))
+    float64 = pack_runs(two_scenarios(model, "float64"))
+    assert len(float32) < 0.6 * len(float64)
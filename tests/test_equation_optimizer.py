@@ -0,0 +1,36 @@
+import pytest
+
+from model_operations import setup_model, run_model
+from conftest import START_DATE, STOP_DATE
+
+# a converter the optimizer would inline, kept so a scenario can still set it
+SCENARIO_CONSTANTS = {"Retailer Leadtime": 14.0}
+
+
+@pytest.fixture(scope="module")
+def models(df_input):
+    return (setup_model(START_DATE, STOP_DATE, df_input),
+            setup_model(START_DATE, STOP_DATE, df_input, optimize=True, keep=list(SCENARIO_CONSTANTS)))
+
+
+def test_optimized_model_gives_the_same_results(models):
+    (model_env, model), (optimized_env, optimized) = models
+    reference = run_model(model_env, model, "base", {}, START_DATE, STOP_DATE)
+    result = run_model(optimized_env, optimized, "base", {}, START_DATE, STOP_DATE)
+    assert result["Retailer Price"].equals(reference["Retailer Price"])
+    assert result["Retailer Supply"].equals(reference["Retailer Supply"])
+
+
+def test_scenario_constants_change_the_optimized_model(models):
+    (model_env, model), (optimized_env, optimized) = models
+    reference = run_model(model_env, model, "scenario", SCENARIO_CONSTANTS, START_DATE, STOP_DATE)
+    base = run_model(optimized_env, optimized, "base", {}, START_DATE, STOP_DATE)
+    scenario = run_model(optimized_env, optimized, "scenario", SCENARIO_CONSTANTS, START_DATE, STOP_DATE)
+    assert not scenario["Retailer Supply"].equals(base["Retailer Supply"])
+    assert scenario["Retailer Supply"].equals(reference["Retailer Supply"])
+
+
+def test_scenario_cannot_set_an_inlined_converter(df_input):
+    model_env, model = setup_model(START_DATE, STOP_DATE, df_input, optimize=True)
+    with pytest.raises(ValueError, match="inlined"):
+        run_model(model_env, model, "scenario", SCENARIO_CONSTANTS, START_DATE, STOP_DATE)
@@ -0,0 +1,66 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+from batch import BatchRunner
+from input_grid import InputGrid
+from input_store import InputStore, PINS_DIR
+
+START_DATE = datetime(2015, 1, 1)
+STOP_DATE = datetime(2015, 3, 1)
+
+
+def grid(value):
+    return InputGrid(42000.0, 1.0, ["Price"], np.full((10, 1), value), {"Price": "interpolate"})
+
+
+def test_prune_keeps_pinned_versions(tmp_path):
+    store = InputStore(str(tmp_path))
+    old = store.publish(grid(1.0), make_current=False)
+    pin = store.pin(old)
+    for value in [2.0, 3.0, 4.0]:
+        store.publish(grid(value))
+    assert old not in store.prune(keep=1)
+    assert old in store.versions()
+    store.unpin(pin)
+    assert old in store.prune(keep=1)
+
+
+def test_unpin_removes_the_version_unless_pinned_or_current(tmp_path):
+    store = InputStore(str(tmp_path))
+    version = store.publish(grid(1.0), make_current=False)
+    first, second = store.pin(version), store.pin(version)
+    store.unpin(first, remove=True)
+    assert version in store.versions()
+    store.unpin(second, remove=True)
+    assert version not in store.versions()
+    current = store.publish(grid(2.0))
+    store.unpin(store.pin(current), remove=True)
+    assert current in store.versions()
+
+
+def test_pins_of_processes_that_are_gone_do_not_count(tmp_path):
+    store = InputStore(str(tmp_path))
+    version = store.publish(grid(1.0), make_current=False)
+    pid = os.fork()
+    if pid == 0:
+        store.pin(version)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert store.pinned() == set()
+    assert os.listdir(os.path.join(tmp_path, PINS_DIR)) == []
+
+
+def test_batch_runner_removes_its_version_on_close(df_input, tmp_path):
+    store = InputStore(str(tmp_path))
+    points = [{}, {"trader_leadtime": 5.0}]
+    with BatchRunner(df_input, START_DATE, STOP_DATE, input_store=str(tmp_path), processes=2) as runner:
+        assert store.versions() == []
+        results = runner.run(points)
+        assert len(store.versions()) == 1 and store.pinned() == set(store.versions())
+    assert store.versions() == [] and store.pinned() == set()
+    with BatchRunner(df_input, START_DATE, STOP_DATE, processes=1) as runner:
+        expected = runner.run(points)
+    for (times, values), (expected_times, expected_values) in zip(results, expected):
+        assert np.array_equal(values, expected_values)
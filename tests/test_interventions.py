@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from general_functions import datetime_to_serial
+from interventions import InterventionSchedule
+from model_operations import setup_model, run_model
+from conftest import START_DATE, STOP_DATE
+
+SHOCK_DATE = datetime(2015, 3, 1)
+
+
+@pytest.fixture(scope="module")
+def model(df_input):
+    return setup_model(START_DATE, STOP_DATE, df_input)
+
+
+def test_models_are_built_without_intervention_terms(model):
+    model_env, model = model
+    assert not [name for name in list(model.flows) + list(model.converters) if name.endswith("Intervention")]
+
+
+@pytest.mark.parametrize("engine", ["bptk", "stepping"])
+def test_schedule_changes_the_run_from_its_date_then_clears(model, engine):
+    model_env, model = model
+    reference = run_model(model_env, model, f"reference {engine}", {}, START_DATE, STOP_DATE, engine=engine)
+    schedule = InterventionSchedule().step("Retailer Price", SHOCK_DATE, 0.2)
+    shocked = run_model(model_env, model, f"shock {engine}", {}, START_DATE, STOP_DATE, engine=engine,
+                        schedule=schedule)
+    before = reference["t"].to_numpy() < datetime_to_serial(SHOCK_DATE) - 1e-6
+    assert np.array_equal(shocked["Retailer Price"][before], reference["Retailer Price"][before])
+    assert not np.allclose(shocked["Retailer Price"][~before], reference["Retailer Price"][~before])
+    # the scenario model keeps its term, cleared when the scenario runs without a schedule
+    cleared = run_model(model_env, model, f"shock {engine}", {}, START_DATE, STOP_DATE, engine=engine)
+    assert np.array_equal(cleared["Retailer Price"], reference["Retailer Price"])
+
+
+def test_schedule_rejects_variables_the_model_does_not_have(model):
+    model_env, model = model
+    schedule = InterventionSchedule().step("Unknown Stock", SHOCK_DATE, 1.0)
+    with pytest.raises(ValueError, match="not stocks, flows or converters"):
+        run_model(model_env, model, "unknown", {}, START_DATE, STOP_DATE, schedule=schedule)
+
+
+def test_schedule_rejects_inlined_converters(df_input):
+    model_env, model = setup_model(START_DATE, STOP_DATE, df_input, optimize=True)
+    schedule = InterventionSchedule().step("Retailer Leadtime", SHOCK_DATE, 1.0)
+    with pytest.raises(ValueError, match="inlined"):
+        run_model(model_env, model, "inlined", {}, START_DATE, STOP_DATE, schedule=schedule)
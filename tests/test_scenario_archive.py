@@ -0,0 +1,114 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from general_functions import datetime_to_serial
+from scenario_archive import ScenarioArchive
+
+START_DATE = datetime(2018, 1, 1)
+STOP_DATE = datetime(2018, 4, 1)
+
+
+def run_frame(scale=1.0):
+    """ Frame shaped like a run_model result, without running the model """
+    start_serial, stop_serial = datetime_to_serial([START_DATE, STOP_DATE])
+    times = np.arange(start_serial, stop_serial + 0.5)
+    return pd.DataFrame({
+        "t": times,
+        "Retailer Price": scale * np.linspace(1.0, 2.0, len(times)),
+        "Retailer Stock": scale * np.linspace(10.0, 5.0, len(times)).astype("float32"),
+        "Scenario": "A",
+    })
+
+
+def test_add_and_lookup_find_the_same_run(tmp_path):
+    archive = ScenarioArchive(str(tmp_path))
+    scenario_id = archive.add(run_frame(), "A", {"x": 1.0}, "model", start_date=START_DATE, stop_date=STOP_DATE,
+                              input_version="v1")
+    assert archive.lookup("A", {"x": 1.0}, "model", START_DATE, STOP_DATE, "v1") == scenario_id
+    assert archive.read(scenario_id, "Retailer Stock").dtype == "float32"
+
+
+def test_lookup_rejects_runs_on_other_input_data(tmp_path):
+    archive = ScenarioArchive(str(tmp_path))
+    archive.add(run_frame(), "A", {}, "model", start_date=START_DATE, stop_date=STOP_DATE, input_version="v1")
+    assert archive.lookup("A", {}, "model", START_DATE, STOP_DATE, "v2") is None
+    assert archive.lookup("A", {}, "model", START_DATE, STOP_DATE) is None
+
+
+def test_replacing_a_run_keeps_open_arrays_readable(tmp_path):
+    archive = ScenarioArchive(str(tmp_path))
+    scenario_id = archive.add(run_frame(), "A", {}, "model")
+    before = archive.read(scenario_id, "Retailer Price")
+    mapped = archive._open(scenario_id, archive.index[scenario_id]["variables"]["Retailer Price"])
+    assert archive.add(run_frame(2.0), "A", {}, "model") == scenario_id
+    assert np.array_equal(mapped, before.to_numpy())
+    assert np.allclose(archive.read(scenario_id, "Retailer Price"), 2.0 * before)
+    # only the new run's directory is left, and no temporary directory
+    assert sorted(name for name in os.listdir(tmp_path) if not name.startswith("index")) == \
+        [archive.index[scenario_id]["directory"]]
+
+
+def archive_runs(path, names):
+    archive = ScenarioArchive(path)
+    return [archive.add(run_frame(), name, {}, "model") for name in names]
+
+
+def test_concurrent_writers_keep_every_run(tmp_path):
+    names = [[f"{worker}-{i}" for i in range(10)] for worker in range(4)]
+    with ProcessPoolExecutor(4) as executor:
+        scenario_ids = sum(executor.map(archive_runs, [str(tmp_path)] * len(names), names), [])
+    archive = ScenarioArchive(str(tmp_path))
+    assert sorted(archive.index) == sorted(scenario_ids)
+    for scenario_id in scenario_ids:
+        assert archive.read(scenario_id, "Retailer Price").iloc[-1] == 2.0
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def scenario_frame():
+    """ run_frame of a scenario that changes Retailer Price after half the run """
+    df = run_frame()
+    df.loc[len(df) // 2:, "Retailer Price"] *= 1.1
+    return df
+
+
+def test_runs_on_a_baseline_grid_are_stored_as_deltas(tmp_path):
+    archive = ScenarioArchive(str(tmp_path))
+    base_id = archive.add(run_frame(), "base", {}, "model")
+    scenario_id = archive.add(scenario_frame(), "A", {"x": 1.0}, "model")
+    metadata = archive.index[scenario_id]
+    assert metadata["baseline"] == base_id
+    assert metadata["variables"]["Retailer Stock"] is None
+    assert metadata["variables"]["Retailer Price"].endswith(".xor")
+    assert directory_bytes(os.path.join(tmp_path, metadata["directory"])) < \
+        directory_bytes(os.path.join(tmp_path, archive.index[base_id]["directory"]))
+    df = archive.read_frame([scenario_id], ["Retailer Price", "Retailer Stock"])
+    expected = scenario_frame()
+    for variable in ["Retailer Price", "Retailer Stock"]:
+        assert df[variable].dtype == expected[variable].dtype
+        assert np.array_equal(df[variable], expected[variable])
+
+
+def test_deltas_stay_readable_when_the_baseline_goes(tmp_path):
+    archive = ScenarioArchive(str(tmp_path))
+    base_id = archive.add(run_frame(), "base", {}, "model")
+    scenario_id = archive.add(scenario_frame(), "A", {}, "model")
+    archive.add(run_frame(3.0), "base", {}, "model")
+    assert np.array_equal(archive.read(scenario_id, "Retailer Price"), scenario_frame()["Retailer Price"])
+    archive.remove(base_id)
+    assert np.array_equal(archive.read(scenario_id, "Retailer Price"), scenario_frame()["Retailer Price"])
+    archive.remove(scenario_id)
+    assert sorted(name for name in os.listdir(tmp_path) if not name.startswith("index")) == []
+
+
+def test_runs_on_other_input_data_are_stored_in_full(tmp_path):
+    archive = ScenarioArchive(str(tmp_path))
+    archive.add(run_frame(), "base", {}, "model", input_version="v1")
+    scenario_id = archive.add(scenario_frame(), "A", {}, "model", input_version="v2")
+    assert "baseline" not in archive.index[scenario_id]
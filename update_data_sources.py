@@ -1,4 +1,11 @@
+import os
+
 from import_data import *
+from input_store import publish_inputs
 
 # download_all_data()
-download_from_hdx("ucdp-data-for-nigeria")
\ No newline at end of file
+download_from_hdx("ucdp-data-for-nigeria")
+
+# publish the aligned data for the dashboard workers (see input_store.py)
+if os.environ.get("INPUT_STORE"):
+    publish_inputs(os.environ["INPUT_STORE"], import_all_data())